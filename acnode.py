@@ -3,9 +3,477 @@
 # An acnode client in python
 #
 
-import socket, time
+import socket, time, select, threading, collections, struct, random
+from metrics import Histogram, endpoint
 
-class Card:
+class ResponseParser:
+  """
+  An incremental http response parser.
+
+  feed() it data as it arrives, it returns True once the whole response
+  is in. If the server closes the connection first call eof(). When done
+  is set the response is usable unless error is set too.
+  """
+  def __init__(self):
+    self.buf = bytearray()
+    # how far we've looked for the end of the headers
+    self.scanned = 0
+    self.version = None
+    self.status = None
+    self.headers = None
+    self.length = None
+    self.chunked = False
+    # bytes left in the current chunk, None when expecting a size line
+    self.chunkleft = None
+    self.trailers = False
+    self.body = bytearray()
+    self.done = False
+    self.error = False
+    # bytes fed so far
+    self.received = 0
+
+  def feed(self, data):
+    if self.done:
+      return True
+    self.received += len(data)
+    self.buf += data
+    if self.headers == None:
+      if not self.parse_headers():
+        return self.done
+    if self.chunked:
+      self.parse_chunks()
+    elif self.length != None:
+      need = self.length - len(self.body)
+      self.body += self.buf[:need]
+      del self.buf[:need]
+      if len(self.body) == self.length:
+        self.done = True
+    else:
+      # no framing, the body runs until the server closes the connection
+      self.body += self.buf
+      del self.buf[:]
+    return self.done
+
+  def eof(self):
+    if self.done:
+      return
+    self.done = True
+    if self.headers == None or self.chunked or self.length != None:
+      # cut short
+      self.error = True
+
+  def fail(self):
+    self.done = True
+    self.error = True
+    return False
+
+  def parse_headers(self):
+    start = max(0, self.scanned - 2)
+    end = self.buf.find("\n\r\n", start)
+    sep = 3
+    end2 = self.buf.find("\n\n", start)
+    if end2 != -1 and (end == -1 or end2 < end):
+      end = end2
+      sep = 2
+    if end == -1:
+      self.scanned = len(self.buf)
+      return False
+
+    lines = str(self.buf[:end]).splitlines()
+    del self.buf[:end + sep]
+
+    parts = lines[0].split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith("HTTP/") or not parts[1].isdigit():
+      return self.fail()
+    self.version = parts[0]
+    self.status = int(parts[1])
+
+    self.headers = {}
+    for line in lines[1:]:
+      name, _, value = line.partition(":")
+      self.headers[name.strip().lower()] = value.strip()
+
+    if "chunked" in self.headers.get("transfer-encoding", "").lower():
+      self.chunked = True
+    elif "content-length" in self.headers:
+      try:
+        self.length = int(self.headers["content-length"])
+      except ValueError:
+        return self.fail()
+      if self.length == 0:
+        self.done = True
+    return True
+
+  def parse_chunks(self):
+    while not self.done:
+      if self.chunkleft == None:
+        nl = self.buf.find("\n")
+        if nl == -1:
+          return
+        line = str(self.buf[:nl]).split(";")[0].strip()
+        del self.buf[:nl + 1]
+        if self.trailers:
+          if line == "":
+            self.done = True
+          continue
+        if line == "":
+          # the crlf after the last chunk's data
+          continue
+        try:
+          size = int(line, 16)
+        except ValueError:
+          self.fail()
+          return
+        if size == 0:
+          self.trailers = True
+          continue
+        self.chunkleft = size
+
+      take = self.buf[:self.chunkleft]
+      self.body += take
+      del self.buf[:len(take)]
+      self.chunkleft -= len(take)
+      if self.chunkleft > 0:
+        return
+      self.chunkleft = None
+
+  def keepalive(self):
+    """
+    can the connection be used for another request after this response?
+    """
+    if self.error or (self.length == None and not self.chunked):
+      return False
+    connection = self.headers.get("connection", "").lower()
+    if self.version == "HTTP/1.1":
+      return connection != "close"
+    return connection == "keep-alive"
+
+def timeleft(c, deadline):
+  """
+  Give the socket c until deadline, a time.time(), raises socket.timeout
+  if that's already passed
+  """
+  left = deadline - time.time()
+  if left <= 0:
+    raise socket.timeout("timed out")
+  c.settimeout(left)
+
+def read_parser(c, data="", parser=None, deadline=None):
+  """
+  Read one HTTP response from the socket c, data is anything already
+  read from it. Any bytes after the response are left in parser.buf. If
+  deadline is set it raises socket.timeout if the response isn't all in
+  by then.
+  """
+  if parser == None:
+    parser = ResponseParser()
+  if len(data) > 0:
+    parser.feed(data)
+  while not parser.done:
+    if deadline != None:
+      timeleft(c, deadline)
+    data = c.recv(4096)
+    if len(data) == 0:
+      parser.eof()
+      break
+    parser.feed(data)
+  return parser
+
+def read_response(c):
+  """
+  Read one HTTP response from the socket c.
+
+  returns (status, headers, body, keepalive) or None if we didn't get a
+  complete response.
+  """
+  parser = read_parser(c)
+  if parser.error:
+    return None
+  return (parser.status, parser.headers, parser.body, parser.keepalive())
+
+class Clock:
+  """
+  Where ACNodes and CardCaches get the time from
+  """
+  def time(self):
+    return time.time()
+
+  def sleep(self, seconds):
+    time.sleep(seconds)
+
+class VirtualClock(Clock):
+  """
+  A clock that only moves when it's told to, so things that depend on
+  how long has passed can be tested without waiting for it.
+  """
+  def __init__(self, now=0.0):
+    self.now = now
+
+  def time(self):
+    return self.now
+
+  def sleep(self, seconds):
+    self.now += seconds
+
+  advance = sleep
+
+# what the transports return to ACNode.fetch when they couldn't connect,
+# so the request certainly didn't get to the server
+UNSENT = object()
+
+def body_result(body):
+  """
+  The acserver answers with a number, anything else is an error.
+  """
+  try:
+    return int(str(body).split(None, 1)[0])
+  except (IndexError, ValueError):
+    return -1
+
+def preferred(addrs, family):
+  """
+  getaddrinfo results with the ones in family first, so a node that's
+  found IPv6 doesn't work stops trying it first every time
+  """
+  if family == None:
+    return addrs
+  return [a for a in addrs if a[0] == family] + [a for a in addrs if a[0] != family]
+
+class ConnectionPool:
+  """
+  Keeps HTTP/1.1 connections to acservers open between requests, so a
+  busy node doesn't pay for a dns lookup and a tcp handshake on every swipe.
+
+  One pool can be shared between several ACNodes, connections are kept
+  per (servername, port).
+  """
+  def __init__(self, maxidle=4, dnsttl=300.0, timeout=10.0):
+    self.maxidle = maxidle
+    self.dnsttl = dnsttl
+    self.timeout = timeout
+    self.lock = threading.Lock()
+    # (servername, port) -> [socket, ...]
+    self.idle = {}
+    # (servername, port) -> (expires, getaddrinfo results)
+    self.addrs = {}
+
+  def resolve(self, servername, port):
+    key = (servername, port)
+    now = time.time()
+    with self.lock:
+      cached = self.addrs.get(key)
+    if cached and cached[0] > now:
+      return cached[1]
+    addrs = socket.getaddrinfo(servername, port, socket.AF_UNSPEC, socket.SOCK_STREAM)
+    with self.lock:
+      self.addrs[key] = (now + self.dnsttl, addrs)
+    return addrs
+
+  def connect(self, servername, port, timeout=None, spans=None):
+    """
+    A new connection, or None. spans is as for request().
+    """
+    if timeout == None:
+      timeout = self.timeout
+    if timeout <= 0:
+      return None
+    t = time.time()
+    try:
+      addrs = self.resolve(servername, port)
+    except socket.error as msg:
+      return None
+    if spans != None:
+      now = time.time()
+      spans("resolve", now - t)
+      t = now
+    for res in addrs:
+      af, socktype, proto, canonname, sa = res
+      try:
+        c = socket.socket(af, socktype, proto)
+      except socket.error as msg:
+        continue
+      try:
+        c.settimeout(timeout)
+        c.connect(sa)
+      except socket.error as msg:
+        c.close()
+        continue
+      c.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      if spans != None:
+        spans("connect", time.time() - t)
+      if res is not addrs[0]:
+        # try this one first next time
+        with self.lock:
+          cached = self.addrs.get((servername, port))
+          if cached != None:
+            self.addrs[(servername, port)] = (cached[0], preferred(cached[1], af))
+      return c
+    # none of them worked, maybe the address has changed
+    with self.lock:
+      self.addrs.pop((servername, port), None)
+    return None
+
+  def stale(self, c):
+    """
+    An idle connection should have nothing to read, if it does then the
+    server has closed it (or sent us junk), either way we can't use it.
+    """
+    try:
+      r, w, x = select.select([c], [], [], 0)
+    except (select.error, socket.error, ValueError):
+      return True
+    return len(r) > 0
+
+  def get(self, servername, port, timeout=None, spans=None):
+    """
+    returns (socket, reused)
+    """
+    with self.lock:
+      socks = self.idle.get((servername, port), [])
+      while socks:
+        c = socks.pop()
+        if not self.stale(c):
+          return (c, True)
+        c.close()
+    return (self.connect(servername, port, timeout, spans), False)
+
+  def put(self, servername, port, c):
+    with self.lock:
+      socks = self.idle.setdefault((servername, port), [])
+      if len(socks) < self.maxidle:
+        socks.append(c)
+        return
+    c.close()
+
+  def request(self, servername, port, data, timeout=None, spans=None, unsent=None):
+    """
+    Send data, a complete http request, and read the response, all in
+    timeout seconds, self.timeout if None. If spans is set
+    it's called with (phase, seconds) as each phase of the request is
+    done, the phases are as for metrics.Instruments. A kept alive
+    connection has no resolve or connect.
+
+    returns (status, headers, body, keepalive) or None if the server
+    couldn't be reached, or unsent if we couldn't connect so nothing was
+    sent.
+
+    If a kept alive connection turns out to have been closed by the
+    server, a GET is tried again on a fresh one with whatever's left of
+    timeout. Nothing else is, the server may have already acted on it.
+    """
+    if timeout == None:
+      timeout = self.timeout
+    deadline = time.time() + timeout
+    tried = False
+    while True:
+      c, reused = self.get(servername, port, deadline - time.time(), spans)
+      if c == None:
+        if tried:
+          return None
+        return unsent
+      tried = True
+      parser = ResponseParser()
+      timedout = False
+      t = time.time()
+      try:
+        timeleft(c, deadline)
+        c.sendall(data)
+        if spans != None:
+          now = time.time()
+          spans("send", now - t)
+          t = now
+        timeleft(c, deadline)
+        first = c.recv(4096)
+        if spans != None:
+          now = time.time()
+          spans("ttfb", now - t)
+          t = now
+        if len(first) == 0:
+          parser.eof()
+        else:
+          read_parser(c, first, parser, deadline)
+        if spans != None:
+          spans("body", time.time() - t)
+      except socket.timeout as e:
+        timedout = True
+      except socket.error as e:
+        pass
+      if not parser.done or parser.error:
+        c.close()
+        if (reused and not timedout and parser.received == 0 and deadline > time.time()
+            and data.startswith("GET ")):
+          # the server dropped a kept alive connection, try a fresh one
+          continue
+        return None
+      resp = (parser.status, parser.headers, parser.body, parser.keepalive())
+      if resp[3]:
+        self.put(servername, port, c)
+      else:
+        c.close()
+      return resp
+
+  def pipeline(self, servername, port, requests, window=32, timeout=None):
+    """
+    Send requests down one connection without waiting for each answer,
+    window at a time. returns a list of responses like request() does,
+    with None for any we didn't get. If the server closes the connection
+    part way through the rest are sent again on a new one. They all have
+    to be answered in timeout seconds, self.timeout if None.
+    """
+    if timeout == None:
+      timeout = self.timeout
+    deadline = time.time() + timeout
+    responses = []
+    while len(responses) < len(requests) and deadline > time.time():
+      c, reused = self.get(servername, port, deadline - time.time())
+      if c == None:
+        break
+      got = 0
+      keepalive = True
+      try:
+        while keepalive and len(responses) < len(requests):
+          batch = requests[len(responses):len(responses) + window]
+          timeleft(c, deadline)
+          c.sendall("".join(batch))
+          leftover = ""
+          for req in batch:
+            parser = read_parser(c, leftover, deadline=deadline)
+            if parser.error:
+              keepalive = False
+              break
+            leftover = str(parser.buf)
+            responses.append((parser.status, parser.headers, parser.body, parser.keepalive()))
+            got += 1
+            if not parser.keepalive():
+              keepalive = False
+              break
+      except socket.error as e:
+        keepalive = False
+      if keepalive:
+        self.put(servername, port, c)
+      else:
+        c.close()
+      if got == 0 and not reused:
+        break
+    return responses + [None] * (len(requests) - len(responses))
+
+  def close(self):
+    with self.lock:
+      for socks in self.idle.values():
+        for c in socks:
+          c.close()
+      self.idle = {}
+
+# the flag bits in the first byte of a packed card
+CARD_MAINTAINER = 0x01
+CARD_UIDLEN     = 0x02
+CARD_STATUS     = 0x04
+CARD_INVALID    = 0x08
+CARD_END        = 0x10
+# bytes per packed card
+CARD_SIZE = 8
+
+class Card(object):
   """
   unsigned int maintainer :1; // 1 if maintainer
   unsigned int uidlen     :1; // 1 if 7, otherwise 4
@@ -15,34 +483,624 @@ class Card:
   unsigned int            :3; // pad to a whole byte
     uint8_t uid[7];
     
+  to_bytes and from_bytes use that layout, the bitfields are allocated
+  from the lsb up and the uid is big endian, 4 byte uids are followed by
+  3 zero bytes.
   """
+  __slots__ = ("uid", "maintainer", "status", "uidstr")
+
   def __init__(self, uid, maintainer, status):
     if uid < 2**32:
-      assert(len("%08x" % (uid)) == (4*2))
+      self.uidstr = "%08x" % (uid)
+      assert(len(self.uidstr) == (4*2))
     else:
-     assert(len("%014x" % (uid)) == (7*2))
+      self.uidstr = "%014x" % (uid)
+      assert(len(self.uidstr) == (7*2))
     self.uid = uid
     self.maintainer = maintainer
     self.status = status
 
   def __str__(self):
+    return self.uidstr
+
+  def __repr__(self):
+    return "Card(0x%s, %s, %s)" % (self.uidstr, self.maintainer, self.status)
+
+  def to_bytes(self):
+    flags = 0
+    if self.maintainer:
+      flags |= CARD_MAINTAINER
+    if self.status:
+      flags |= CARD_STATUS
     if self.uid < 2**32:
-      return "%08x" % (self.uid)
+      return chr(flags) + struct.pack(">I", self.uid) + "\0\0\0"
+    return struct.pack(">Q", self.uid | ((flags | CARD_UIDLEN) << 56))
+
+  @classmethod
+  def from_bytes(cls, data, offset=0):
+    """
+    Unpack the card at offset in data, raises ValueError for records
+    marked invalid or end.
+    """
+    flags = struct.unpack_from("B", data, offset)[0]
+    if flags & (CARD_INVALID | CARD_END):
+      raise ValueError("not a valid card record")
+    return cls(packed_uid(data, offset),
+               bool(flags & CARD_MAINTAINER),
+               bool(flags & CARD_STATUS))
+
+def packed_uid(data, offset):
+  """
+  The uid of the packed card at offset in data
+  """
+  if struct.unpack_from("B", data, offset)[0] & CARD_UIDLEN:
+    return struct.unpack_from(">Q", data, offset)[0] & 0xffffffffffffff
+  return struct.unpack_from(">I", data, offset + 1)[0]
+
+class CardTable:
+  """
+  Lots of cards packed into one bytearray, CARD_SIZE bytes each, kept
+  in uid order so they can be found with a binary search.
+  """
+  def __init__(self, cards=()):
+    self.data = bytearray()
+    for card in cards:
+      self.add(card)
+
+  def __len__(self):
+    return len(self.data) / CARD_SIZE
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield Card.from_bytes(self.data, i * CARD_SIZE)
+
+  def __contains__(self, uid):
+    return self.find(uid) != -1
+
+  def uid(self, i):
+    return packed_uid(self.data, i * CARD_SIZE)
+
+  def search(self, uid):
+    """
+    returns the index of the first card with a uid >= uid
+    """
+    lo = 0
+    hi = len(self)
+    while lo < hi:
+      mid = (lo + hi) / 2
+      if self.uid(mid) < uid:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def find(self, uid):
+    """
+    returns the index of the card with uid, or -1
+    """
+    i = self.search(uid)
+    if i < len(self) and self.uid(i) == uid:
+      return i
+    return -1
+
+  def get(self, uid):
+    i = self.find(uid)
+    if i == -1:
+      return None
+    return Card.from_bytes(self.data, i * CARD_SIZE)
+
+  def add(self, card):
+    """
+    Add card, replacing any card with the same uid
+    """
+    i = self.search(card.uid)
+    off = i * CARD_SIZE
+    if i < len(self) and self.uid(i) == card.uid:
+      self.data[off:off + CARD_SIZE] = card.to_bytes()
     else:
-      return "%014x" % (self.uid)
+      self.data[off:off] = card.to_bytes()
+
+  def remove(self, uid):
+    i = self.find(uid)
+    if i == -1:
+      raise KeyError(uid)
+    del self.data[i * CARD_SIZE:(i + 1) * CARD_SIZE]
+
+  def to_bytes(self):
+    return str(self.data)
+
+  @classmethod
+  def from_bytes(cls, data):
+    """
+    Make a table from packed cards, which don't need to be in order.
+    Invalid and end records are skipped.
+    """
+    table = cls()
+    records = []
+    for off in range(0, len(data) - CARD_SIZE + 1, CARD_SIZE):
+      if struct.unpack_from("B", data, off)[0] & (CARD_INVALID | CARD_END):
+        continue
+      records.append((packed_uid(data, off), data[off:off + CARD_SIZE]))
+    records.sort(key=lambda r: r[0])
+    uid = None
+    for u, record in records:
+      if u == uid:
+        # the last one wins
+        table.data[-CARD_SIZE:] = record
+      else:
+        table.data += record
+      uid = u
+    return table
+
+  def diff(self, other):
+    """
+    Compare with other, returns (added, removed, changed) lists of uids,
+    where added are the uids in other but not here, and changed are
+    those in both with different flags.
+    """
+    added = []
+    removed = []
+    changed = []
+    i = 0
+    j = 0
+    while i < len(self) or j < len(other):
+      if j == len(other):
+        removed.append(self.uid(i))
+        i += 1
+      elif i == len(self):
+        added.append(other.uid(j))
+        j += 1
+      else:
+        a = self.uid(i)
+        b = other.uid(j)
+        if a < b:
+          removed.append(a)
+          i += 1
+        elif b < a:
+          added.append(b)
+          j += 1
+        else:
+          if self.data[i * CARD_SIZE] != other.data[j * CARD_SIZE]:
+            changed.append(a)
+          i += 1
+          j += 1
+    return (added, removed, changed)
+
+class CardCache:
+  """
+  Remembers what the server said about each card, so repeat swipes can be
+  answered without asking again, and so we can still answer when the server
+  is unreachable.
+
+  Entries are kept for ttl seconds, or negttl seconds for cards that were
+  refused or unknown. After that they are stale: they are still used while
+  a fresh answer is fetched in the background, until they are maxstale
+  seconds old. At most size cards are kept, the least recently used go first.
+  """
+  def __init__(self, size=1024, ttl=300.0, negttl=30.0, maxstale=86400.0, clock=None):
+    self.size = size
+    self.ttl = ttl
+    self.negttl = negttl
+    self.maxstale = maxstale
+    if clock == None:
+      clock = Clock()
+    self.clock = clock
+    self.lock = threading.Lock()
+    # uid -> (result, time fetched)
+    self.entries = collections.OrderedDict()
+    # uids with a background refresh running
+    self.refreshing = set()
+
+  def get(self, uid):
+    """
+    returns (result, fresh) or None if we know nothing useful about the card
+    """
+    now = self.clock.time()
+    with self.lock:
+      entry = self.entries.pop(uid, None)
+      if entry == None:
+        return None
+      result, fetched = entry
+      age = now - fetched
+      if age > self.maxstale:
+        return None
+      # put it back at the most recently used end
+      self.entries[uid] = entry
+    if result > 0:
+      return (result, age <= self.ttl)
+    return (result, age <= self.negttl)
+
+  def put(self, uid, result):
+    with self.lock:
+      self.entries.pop(uid, None)
+      self.entries[uid] = (result, self.clock.time())
+      while len(self.entries) > self.size:
+        self.entries.popitem(last=False)
+
+  def invalidate(self, uid=None):
+    """
+    Forget about one card, or all of them if uid is None
+    """
+    with self.lock:
+      if uid == None:
+        self.entries.clear()
+      else:
+        self.entries.pop(uid, None)
+
+class SingleFlight:
+  """
+  Lets identical requests made at the same time share one trip to the
+  server, e.g. a card held on the reader, or a dashboard polling the
+  status alongside the node. The first caller for a key does the
+  request, the others wait for its answer.
+
+  One can be shared between several ACNodes.
+  """
+  def __init__(self):
+    self.lock = threading.Lock()
+    # key -> [threading.Event, result]
+    self.flights = {}
+    # requests answered by someone else's trip
+    self.shared = 0
+
+  def do(self, key, fn):
+    """
+    fn(), or the answer to the fn() already running for key
+    """
+    with self.lock:
+      flight = self.flights.get(key)
+      leader = flight == None
+      if leader:
+        flight = self.flights[key] = [threading.Event(), None]
+      else:
+        self.shared += 1
+
+    if not leader:
+      flight[0].wait()
+      return flight[1]
+
+    try:
+      flight[1] = fn()
+    finally:
+      with self.lock:
+        del self.flights[key]
+      flight[0].set()
+    return flight[1]
+
+class CircuitBreaker:
+  """
+  Stops an ACNode waiting on a server that's clearly down. Once failures
+  requests in a row have failed it opens, and allow() says no for
+  cooloff seconds. Then one request is let through to see if the server
+  is back, if that fails it opens again.
+
+  One can be shared between ACNodes using the same server.
+  """
+  def __init__(self, failures=5, cooloff=30.0, clock=None):
+    self.failures = failures
+    self.cooloff = cooloff
+    if clock == None:
+      clock = Clock()
+    self.clock = clock
+    self.lock = threading.Lock()
+    # closed, open or trying
+    self.state = "closed"
+    self.failed = 0
+    self.opened = None
+
+  def allow(self):
+    with self.lock:
+      if self.state == "closed":
+        return True
+      if self.state == "open" and self.clock.time() - self.opened >= self.cooloff:
+        self.state = "trying"
+        return True
+      return False
+
+  def success(self):
+    with self.lock:
+      self.state = "closed"
+      self.failed = 0
+
+  def failure(self):
+    with self.lock:
+      self.failed += 1
+      if self.state == "trying" or self.failed >= self.failures:
+        self.state = "open"
+        self.opened = self.clock.time()
+
+class Policy:
+  """
+  How long an ACNode waits for the acserver, and what it does when it
+  doesn't get an answer, as ACNode(policy=...).
+
+  deadlines is endpoint (as in metrics.endpoint) -> the most seconds a
+  request can take, retries included. Once samples requests to an
+  endpoint have been answered each try gets multiple times the p99 of
+  those, but at least floor seconds. GETs are tried again up to retries
+  times after a jittered backoff, nothing else is as the server might
+  have done it already. While the breaker is open requests fail
+  straight away, so a CardCache answers from what it's got.
+  """
+  DEADLINES = {
+    "card": 3.0,
+    "status": 5.0,
+    "grant": 10.0,
+    "tooluse": 10.0,
+    "other": 10.0,
+  }
+
+  def __init__(self, deadlines=None, retries=2, backoff=0.05, breaker=None,
+               adaptive=True, floor=0.25, multiple=4.0, samples=20):
+    self.deadlines = dict(self.DEADLINES)
+    if deadlines != None:
+      self.deadlines.update(deadlines)
+    self.retries = retries
+    self.backoff = backoff
+    if breaker == None:
+      breaker = CircuitBreaker()
+    self.breaker = breaker
+    self.adaptive = adaptive
+    self.floor = floor
+    self.multiple = multiple
+    self.samples = samples
+    self.lock = threading.Lock()
+    # endpoint -> Histogram of how long answered requests took
+    self.latency = {}
+
+  def timeout(self, name, left):
+    """
+    how long to give a try at an endpoint, with left seconds to go
+    """
+    if not self.adaptive:
+      return left
+    with self.lock:
+      h = self.latency.get(name)
+      if h == None or h.count < self.samples:
+        return left
+      timeout = h.percentile(99) * self.multiple
+    return min(left, max(self.floor, timeout))
+
+  def observe(self, name, seconds):
+    with self.lock:
+      h = self.latency.get(name)
+      if h == None:
+        h = self.latency[name] = Histogram()
+      h.add(seconds)
+
+  def request(self, node, path):
+    """
+    node.fetch(path) with retries, returns None if there's no answer
+    """
+    name = endpoint(path)
+    deadline = time.time() + self.deadlines.get(name, self.deadlines["other"])
+    tries = 1
+    if path.startswith("GET "):
+      tries += self.retries
+    wait = self.backoff
+    for i in range(tries):
+      if not self.breaker.allow():
+        return None
+      start = time.time()
+      left = deadline - start
+      if left <= 0:
+        return None
+      ret = node.fetch(path, self.timeout(name, left))
+      if ret != None:
+        self.breaker.success()
+        self.observe(name, time.time() - start)
+        return ret
+      self.breaker.failure()
+      if i < tries - 1:
+        time.sleep(min(random.uniform(0, wait), max(0, deadline - time.time())))
+        wait *= 2
+    return None
+
+class Server:
+  """
+  One of the acservers in a Servers, and how it's been doing
+  """
+  def __init__(self, servername, port):
+    self.servername = servername
+    self.port = port
+    # moving average of how long it takes to answer, None until it has
+    self.latency = None
+    # failures in a row
+    self.failures = 0
+    # when to try it again after it's failed, by the Servers' clock
+    self.retry = None
+
+  def __repr__(self):
+    return "Server(%r, %r)" % (self.servername, self.port)
+
+class Servers:
+  """
+  Several acservers for an ACNode to use, as ACNode(servers=...), for
+  when there's more than one.
+
+  Requests go to the fastest server that's up and on to the next if it
+  doesn't answer, all in the one request's time. POSTs only go on to the
+  next if they couldn't connect, so they're never done twice, they
+  should still all share a database.
+  Servers that haven't answered anything yet count as fastest, so they
+  get measured. One that fails is left alone for downtime seconds,
+  doubling with each failure in a row up to maxdowntime, unless they're
+  all down.
+  """
+  def __init__(self, servers, downtime=5.0, maxdowntime=300.0, alpha=0.2, clock=None):
+    self.servers = [Server(servername, port) for servername, port in servers]
+    self.downtime = downtime
+    self.maxdowntime = maxdowntime
+    # how much each new latency counts in the average
+    self.alpha = alpha
+    if clock == None:
+      clock = Clock()
+    self.clock = clock
+    self.lock = threading.Lock()
+
+  def order(self):
+    """
+    the servers to try, best first
+    """
+    now = self.clock.time()
+    with self.lock:
+      up = [s for s in self.servers if s.retry == None or s.retry <= now]
+      down = [s for s in self.servers if s.retry != None and s.retry > now]
+      up.sort(key=lambda s: s.latency or 0.0)
+      down.sort(key=lambda s: s.retry)
+    return up + down
+
+  def success(self, server, seconds):
+    with self.lock:
+      if server.latency == None:
+        server.latency = seconds
+      else:
+        server.latency += self.alpha * (seconds - server.latency)
+      server.failures = 0
+      server.retry = None
+
+  def failure(self, server):
+    with self.lock:
+      server.failures += 1
+      wait = min(self.maxdowntime, self.downtime * 2 ** (server.failures - 1))
+      server.retry = self.clock.time() + wait
 
 class ACNode:
-  def __init__(self, nodeid, servername, port, verbose=False, secret=None):
+  def __init__(self, nodeid, servername, port, verbose=False, secret=None, pool=None, cache=None, clock=None, journal=None, flights=None, instruments=None, policy=None, feed=None, servers=None, statusevery=None, recorder=None, snapshot=None):
     self.nodeid = nodeid
     self.servername = servername
     self.port = port
     self.status = 1
     self.verbose = verbose
     self.secret = secret
+    # a ConnectionPool to use keep alive connections, or None for a new
+    # HTTP/1.0 connection per request
+    self.pool = pool
+    # a CardCache to answer repeat swipes locally, or None to always ask
+    self.cache = cache
+    if clock == None:
+      clock = Clock()
+    self.clock = clock
+    # when the tool was last started and stopped, by self.clock
+    self.usestart = None
+    self.usestop = None
+    # a SingleFlight to share GETs with whoever else is asking the same
+    # thing at the same time, or None
+    self.flights = flights
+    # a Servers to spread requests over, or None for just servername
+    # and port
+    self.servers = servers
+    # (servername, port) -> the address family we last connected with
+    self.families = {}
+    # (servername, post, http version) -> the end of the request, see tail()
+    self.tails = {}
+    # the start of the paths we ask about most
+    self.cardpath = "GET /%d/card/" % (self.nodeid)
+    self.statuspath = "GET /%d/status/" % (self.nodeid)
+    # how long to wait for an answer from the server
+    self.timeout = 10.0
+    # a Policy for timeouts and retries, or None to try once and wait up
+    # to self.timeout
+    self.policy = policy
+    # a metrics.Instruments (or the like) to report how long requests
+    # take, or None
+    self.instruments = instruments
+    # a traffic.Recorder to write down every request, or None
+    self.recorder = recorder
+    # a journal.Journal to send reports from in the background, so they
+    # survive the server being away, or None to send them straight away
+    self.journal = journal
+    if journal != None:
+      journal.start(self.request)
+    # a feed.PermissionFeed to answer swipes from, or None to ask the
+    # server each time
+    self.feed = feed
+    # functions to call with (old, new) when self.status changes
+    self.statuswatchers = []
+    self.statuslock = threading.Lock()
+    # status checks started, and the last one whose answer we've used,
+    # so a slow answer doesn't overwrite a newer one
+    self.statusasked = 0
+    self.statusseen = 0
+    # set once the first status check is done
+    self.statusready = threading.Event()
+    # a snapshot.PermissionSnapshot to remember answers across restarts
+    # and fall back on when the server is away, or None
+    self.snapshot = snapshot
+    # set once the snapshot has been checked against the server
+    self.reconciled = threading.Event()
+    if snapshot != None:
+      if snapshot.status != None:
+        self.status = snapshot.status
+    # how often to check the status in the background, None for just
+    # once at startup
+    self.statusevery = statusevery
+    self.stopping = threading.Event()
 
-    ret = self.networkCheckToolStatus()
-    if ret != -1:
-      self.status = ret
+    if feed != None:
+      feed.start(self)
+
+    # in the background, so a node can be made while the server is away
+    t = threading.Thread(target=self.statusloop)
+    t.daemon = True
+    t.start()
+
+    if snapshot != None:
+      t = threading.Thread(target=self.reconcile)
+      t.daemon = True
+      t.start()
+
+  def statusloop(self):
+    while not self.stopping.is_set():
+      self.networkCheckToolStatus()
+      self.statusready.set()
+      if self.snapshot != None:
+        self.snapshot.flush()
+      if self.statusevery == None:
+        return
+      self.stopping.wait(self.statusevery)
+
+  def stop(self):
+    """
+    stop checking the status in the background, and save the snapshot
+    """
+    self.stopping.set()
+    if self.snapshot != None:
+      self.snapshot.flush()
+
+  def watchstatus(self, fn):
+    """
+    fn(old, new) is called whenever the status changes
+    """
+    self.statuswatchers.append(fn)
+
+  def setstatus(self, status, seq=None):
+    """
+    Change self.status and tell the watchers. seq is the status check it
+    came from, if it's older than the last one used it's ignored.
+    """
+    with self.statuslock:
+      if seq == None:
+        # newer than any check in flight
+        self.statusasked += 1
+        seq = self.statusasked
+      if seq < self.statusseen:
+        return
+      self.statusseen = seq
+      old = self.status
+      self.status = status
+    if self.snapshot != None:
+      self.snapshot.set_status(status)
+    if old != status:
+      for fn in list(self.statuswatchers):
+        fn(old, status)
+
+  def toolStatus(self):
+    """
+    The tool's status without asking the server, as of the last status
+    check, setToolStatus or push from the feed
+    """
+    return self.status
 
   def get_url(self, path):
     """
@@ -52,28 +1110,143 @@ class ACNode:
     "POST /wibble?foo=1"
 
     """
-    result = -1
+    result = self.request(path)
+    if result == None:
+      return -1
+    return result
+
+  def report(self, path):
+    """
+    get_url for requests the tool doesn't have to wait for. With a
+    journal they're written to it to be sent later and 1 is returned
+    straight away, so nothing that acts on the server's answer should
+    use this.
+    """
+    if self.journal != None:
+      self.journal.append(path)
+      return 1
+    return self.get_url(path)
 
-    socket.setdefaulttimeout(10.0)
+  def request(self, path):
+    """
+    As get_url, but returns None if we didn't get an answer from the
+    server, rather than mixing network errors in with -1
+    """
+    if self.flights != None and path.startswith("GET "):
+      # the whole request, so nodes with different keys don't share
+      key = (self.servername, self.port, self.build_request(path))
+      return self.flights.do(key, lambda: self.attempt(path))
+    return self.attempt(path)
 
-    def get_constants(prefix):
-      """Create a dictionary mapping socket module constants to their names."""
-      return dict( (getattr(socket, n), n)
-                    for n in dir(socket)
-                    if n.startswith(prefix))
-    families = get_constants('AF_')
-    types = get_constants('SOCK_')
-    protocols = get_constants('IPPROTO_')
+  def attempt(self, path):
+    """
+    request, without sharing, following self.policy if there is one
+    """
+    if self.policy != None:
+      return self.policy.request(self, path)
+    return self.fetch(path)
+
+  def fetch(self, path, timeout=None):
+    """
+    One try at path, giving up after timeout seconds (self.timeout if
+    None). With self.servers each server is tried in turn until one
+    answers, in what's left of timeout. A POST only goes on to the next
+    if it couldn't connect to this one, otherwise it might be done twice.
+    """
+    if timeout == None:
+      timeout = self.timeout
+
+    if self.servers == None:
+      ret = self.fetch_from(self.servername, self.port, path, timeout)
+      if ret is UNSENT:
+        return None
+      return ret
+
+    deadline = time.time() + timeout
+    for server in self.servers.order():
+      start = time.time()
+      left = deadline - start
+      if left <= 0:
+        break
+      ret = self.fetch_from(server.servername, server.port, path, left)
+      if ret != None and ret is not UNSENT:
+        self.servers.success(server, time.time() - start)
+        return ret
+      self.servers.failure(server)
+      if ret == None and not path.startswith("GET "):
+        break
+    return None
+
+  def fetch_from(self, servername, port, path, timeout):
+    if self.instruments == None and self.recorder == None:
+      if self.pool != None:
+        return self.pooled_get_url(servername, port, path, timeout)
+      return self.unpooled_get_url(servername, port, path, timeout)
+
+    name = None
+    if self.instruments != None:
+      name = endpoint(path)
+    start = time.time()
+    if self.pool != None:
+      ret = self.pooled_get_url(servername, port, path, timeout, name)
+    else:
+      ret = self.unpooled_get_url(servername, port, path, timeout, name)
+    elapsed = time.time() - start
+
+    answer = ret
+    if answer is UNSENT:
+      answer = None
+    if self.instruments != None:
+      self.instruments.span(name, "total", elapsed)
+      if answer == None:
+        self.instruments.count(name, "error")
+      else:
+        self.instruments.count(name, "ok")
+    if self.recorder != None:
+      self.recorder.record(self.nodeid, servername, port, path, answer, start, elapsed)
+    return ret
+
+  def mark(self, name, phase, start):
+    """
+    report the time from start to now as phase, returns now for the
+    start of the next one
+    """
+    now = time.time()
+    self.instruments.span(name, phase, now - start)
+    return now
+
+  def unpooled_get_url(self, servername, port, path, timeout, name=None):
+    """
+    A new HTTP/1.0 connection for each request, connecting and getting
+    the answer has to be done in timeout seconds. If name is set the
+    time each phase takes is reported to self.instruments under it.
+    """
+    deadline = time.time() + timeout
+    if name != None:
+      t = time.time()
 
-    for res in socket.getaddrinfo(self.servername, self.port, socket.AF_UNSPEC, socket.SOCK_STREAM):
+    try:
+      addrs = socket.getaddrinfo(servername, port, socket.AF_UNSPEC, socket.SOCK_STREAM)
+    except socket.error as msg:
+      return UNSENT
+    addrs = preferred(addrs, self.families.get((servername, port)))
+    if name != None:
+      t = self.mark(name, "resolve", t)
+
+    c = None
+    for res in addrs:
       af, socktype, proto, canonname, sa = res
-#      print families[af], types[socktype], protocols[proto]
+      left = deadline - time.time()
+      if left <= 0:
+        c = None
+        break
       try:
         c = socket.socket(af, socktype, proto)
       except socket.error as msg:
         c = None
         continue
       try:
+        c.settimeout(left)
         c.connect(sa)
       except socket.error as msg:
         c.close()
@@ -81,66 +1254,118 @@ class ACNode:
         continue
       break
 
-#    print families[c.family], types[c.type], protocols[c.proto]
+    if c == None:
+      return UNSENT
+    self.families[(servername, port)] = c.family
+    if name != None:
+      t = self.mark(name, "connect", t)
 
     if self.verbose:
       print
       print path
       print
 
-    c.send(path)
-    c.send(" HTTP/1.0\n")
-    c.send("Host: ")
-    c.send(self.servername+"\n");
-    if self.secret != None:
-      c.send("X-AC-Key: " + self.secret + "\n")
-    c.send("\n")
-
-# timeout if not response after 10 secs
-    c.setblocking(0)
-    c.settimeout(10.0)
-
-    res = ""
+    try:
+      # in one go, lots of little sends are lots of little packets
+      c.sendall(path + self.tail(servername, path[0] == "P", "HTTP/1.0"))
+    except socket.error, e:
+      if self.verbose:
+        print e
+      c.close()
+      return None
+    if name != None:
+      t = self.mark(name, "send", t)
 
-    newlines = 0
-    first = False
-    done = False
-    while not done:
+    parser = ResponseParser()
+    first = True
+    while not parser.done:
+      left = deadline - time.time()
       try:
-        data = c.recv(1024)
+        if left <= 0:
+          raise socket.timeout("timed out")
+        c.settimeout(left)
+        data = c.recv(4096)
       except socket.error, e:
-        if str(e) != "timed out":
+        # timed out, or the server went away
+        if self.verbose:
           print e
-        continue
+        c.close()
+        return None
+
+      if name != None and first:
+        t = self.mark(name, "ttfb", t)
+        first = False
 
       if len(data) == 0:
-        done = True
+        parser.eof()
         break
 
-      for ch in data:
-        res += ch
-        if ch == '\n':
-          newlines += 1
-        else:
-          if ch != '\r':
-            newlines = 0
-        if first:
-#          print ">>>", ch, "<<<"
-          if ch.isdigit():
-            result = ord(ch) - ord('0')
-          done = True
-          break
-        if newlines == 2:
-          first = True
+      parser.feed(data)
 
     c.close()
+    if name != None:
+      self.mark(name, "body", t)
 
-#    print res
-    
-    return result
+    if parser.error:
+      return None
+
+    return body_result(parser.body)
+
+  def tail(self, servername, post, version):
+    """
+    Everything in a request after the path. It's the same for every
+    request to servername so it's only made once.
+    """
+    key = (servername, post, version)
+    tail = self.tails.get(key)
+    if tail == None:
+      tail = " " + version + "\r\nHost: " + servername + "\r\n"
+      if self.secret != None:
+        tail += "X-AC-Key: " + self.secret + "\r\n"
+      if post:
+        tail += "Content-Length: 0\r\n"
+      tail += "\r\n"
+      self.tails[key] = tail
+    return tail
+
+  def build_request(self, path, servername=None):
+    """
+    The HTTP/1.1 request for path, for use on kept alive connections
+    """
+    if servername == None:
+      servername = self.servername
+    return path + self.tail(servername, path[0] == "P", "HTTP/1.1")
+
+  def pooled_get_url(self, servername, port, path, timeout, name=None):
+    """
+    get_url, but over a kept alive HTTP/1.1 connection from self.pool.
+    If name is set the phases are reported to self.instruments, as for
+    unpooled_get_url.
+    """
+    if self.verbose:
+      print
+      print path
+      print
+
+    spans = None
+    if name != None:
+      spans = lambda phase, seconds: self.instruments.span(name, phase, seconds)
+    resp = self.pool.request(servername, port, self.build_request(path, servername), timeout, spans, UNSENT)
+    if resp == None or resp is UNSENT:
+      return resp
+
+    status, headers, body, keepalive = resp
+    return body_result(body)
 
   def querycard(self, card):
-    ret = self.get_url("GET /%d/card/%s" % (self.nodeid, card))
+    if self.feed != None and self.feed.fresh():
+      ret = self.feed.lookup(card.uid)
+    elif self.cache != None:
+      ret = self.cachedquerycard(card)
+    elif self.snapshot != None:
+      ret = self.snapshotquerycard(card)
+    else:
+      ret = self.get_url(self.cardpath + str(card))
 
     if self.verbose:
       print "Got: %d" % (ret)
@@ -155,11 +1380,199 @@ class ACNode:
     
     return ret
 
+  def querycard_many(self, cards):
+    """
+    Ask about lots of cards at once, the requests are pipelined down one
+    connection. returns a dict of card -> result, where result is what
+    querycard would have returned for that card.
+
+    If there's a cache the answers go into it, so this can be used to
+    warm it up. While the feed is fresh the answers come from that.
+    """
+    cards = list(cards)
+    results = self.pipelinecards(cards)
+    for card in cards:
+      if results[card] == None:
+        results[card] = -1
+
+    if self.verbose:
+      for card in cards:
+        print "%s: %d" % (card, results[card])
+
+    return results
+
+  def pipelinecards(self, cards):
+    """
+    querycard_many without the -1s, cards we got no answer for are None.
+
+    Like a single request it stops while the policy's breaker is open,
+    fails over between self.servers in the card deadline and tells the
+    instruments and recorder. The instruments
+    get a count for each card, and the time for the whole batch as the
+    total for the "batch" endpoint.
+    """
+    results = dict((card, None) for card in cards)
+    if self.feed != None and self.feed.fresh():
+      for card in cards:
+        results[card] = self.feed.lookup(card.uid)
+      return results
+
+    pool = self.pool
+    if pool == None:
+      # a pool that doesn't keep anything, just for this batch
+      pool = ConnectionPool(maxidle=0)
+    timeout = self.timeout
+    if self.policy != None:
+      timeout = self.policy.deadlines["card"]
+    if self.servers == None:
+      servers = [None]
+    else:
+      servers = self.servers.order()
+
+    deadline = time.time() + timeout
+    left = list(cards)
+    for server in servers:
+      if len(left) == 0:
+        break
+      if self.policy != None and not self.policy.breaker.allow():
+        break
+      timeout = deadline - time.time()
+      if timeout <= 0:
+        break
+      if server == None:
+        servername, port = self.servername, self.port
+      else:
+        servername, port = server.servername, server.port
+
+      reqs = [self.build_request(self.cardpath + str(card), servername) for card in left]
+      start = time.time()
+      resps = pool.pipeline(servername, port, reqs, timeout=timeout)
+      elapsed = time.time() - start
+
+      missed = []
+      for card, resp in zip(left, resps):
+        ret = None
+        if resp != None:
+          ret = body_result(resp[2])
+          results[card] = ret
+          if self.cache != None:
+            self.cache.put(card.uid, ret)
+          if self.snapshot != None:
+            self.snapshot.put(card.uid, ret)
+        else:
+          missed.append(card)
+        if self.instruments != None:
+          if ret == None:
+            self.instruments.count("card", "error")
+          else:
+            self.instruments.count("card", "ok")
+        if self.recorder != None:
+          self.recorder.record(self.nodeid, servername, port, self.cardpath + str(card), ret, start, elapsed)
+      if self.instruments != None:
+        self.instruments.span("batch", "total", elapsed)
+
+      got = len(left) - len(missed)
+      if self.policy != None:
+        if got > 0:
+          self.policy.breaker.success()
+        else:
+          self.policy.breaker.failure()
+      if server != None:
+        if got > 0:
+          self.servers.success(server, elapsed / got)
+        else:
+          self.servers.failure(server)
+      left = missed
+    return results
+
+  def cachedquerycard(self, card):
+    cached = self.cache.get(card.uid)
+    if cached != None:
+      result, fresh = cached
+      if not fresh:
+        self.refreshcard(card, True)
+      return result
+    if self.snapshot != None:
+      # what we knew before we started, while we find out if it's still so
+      result = self.snapshot.get(card.uid)
+      if result != None:
+        self.refreshcard(card, True)
+        return result
+    return self.refreshcard(card, False)
+
+  def snapshotquerycard(self, card):
+    """
+    Ask the server, and remember the answer. If there isn't one then
+    whatever we last knew.
+    """
+    ret = self.request(self.cardpath + str(card))
+    if ret == None:
+      ret = self.snapshot.get(card.uid)
+      if ret == None:
+        return -1
+      return ret
+    self.snapshot.put(card.uid, ret)
+    return ret
+
+  def reconcile(self, batch=256):
+    """
+    Check every card in the snapshot with the server, batch at a time,
+    and save what it says. Cards we get no answer for keep what they
+    had. It gives up at the first batch that gets no answers at all, or
+    that the policy's breaker stops, rather than keep on at a server
+    that isn't there.
+    """
+    try:
+      uids = self.snapshot.uids()
+      for i in range(0, len(uids), batch):
+        if self.stopping.is_set():
+          break
+        cards = [Card(uid, False, True) for uid in uids[i:i + batch]]
+        results = self.pipelinecards(cards)
+        if results.values().count(None) == len(cards):
+          break
+      self.snapshot.flush()
+    finally:
+      self.reconciled.set()
+
+  def refreshcard(self, card, background):
+    """
+    Ask the server about card and update the cache with the answer, if
+    we couldn't reach the server then whatever is in the cache stays there.
+    """
+    if background:
+      with self.cache.lock:
+        if card.uid in self.cache.refreshing:
+          return
+        self.cache.refreshing.add(card.uid)
+      t = threading.Thread(target=self.refreshcard, args=(card, False))
+      t.daemon = True
+      t.start()
+      return
+
+    try:
+      ret = self.request(self.cardpath + str(card))
+    finally:
+      with self.cache.lock:
+        self.cache.refreshing.discard(card.uid)
+    if ret == None:
+      return -1
+    self.cache.put(card.uid, ret)
+    if self.snapshot != None:
+      self.snapshot.put(card.uid, ret)
+    return ret
+
   def networkCheckToolStatus(self):
     """
     https://wiki.london.hackspace.org.uk/view/Project:Tool_Access_Control/Solexious_Proposal#Check_tool_status
     """
-    ret = self.get_url("GET /%d/status/" % (self.nodeid))
+    with self.statuslock:
+      self.statusasked += 1
+      seq = self.statusasked
+
+    ret = self.get_url(self.statuspath)
+    if ret != -1:
+      self.setstatus(ret, seq)
 
     if self.verbose:
       print "Status: %d" % (ret)
@@ -170,8 +1583,15 @@ class ACNode:
     """
     https://wiki.london.hackspace.org.uk/view/Project:Tool_Access_Control/Solexious_Proposal#Report_tool_status
     """
+    # not report(), the server checks the card can do this and we need
+    # to know if it did before we change anything
     ret = self.get_url("POST /%ld/status/%d/by/%s" % (self.nodeid, status, card))
 
+    if ret == 1:
+      self.setstatus(status)
+    if ret == 1 and self.cache != None:
+      self.cache.invalidate()
+
     if self.verbose:
       print "Got: %d" % (ret)
     
@@ -186,6 +1606,11 @@ class ACNode:
     # /<nodeid>/grant-to-card/<trainee card uid>/by-card/<maintainer card uid>
     ret = self.get_url("POST /%ld/grant-to-card/%s/by-card/%s" % (self.nodeid, user, maintainer))
 
+    if ret == 1 and self.cache != None:
+      self.cache.invalidate(user.uid)
+    if ret == 1 and self.feed != None:
+      self.feed.granted(user.uid)
+
     if self.verbose:
       print "Got: %d" % (ret)
     
@@ -199,7 +1624,7 @@ class ACNode:
     if self.verbose:
       print "Setting tool status:"
     # /[nodeID]/tooluse/time/for/[cardID]/[timeUsed]
-    ret = self.get_url("POST /%ld/tooluse/time/for/%s/%d" % (self.nodeid, card, time))
+    ret = self.report("POST /%ld/tooluse/time/for/%s/%d" % (self.nodeid, card, time))
 
     if self.verbose:
       print "Got: %d" % (ret)
@@ -215,13 +1640,32 @@ class ACNode:
 
     # /[nodeID]/tooluse/[status]/[cardID]
 
-    ret = self.get_url("POST /%ld/tooluse/%d/%s" % (self.nodeid, status, card))
+    ret = self.report("POST /%ld/tooluse/%d/%s" % (self.nodeid, status, card))
+
+    if ret == 1:
+      if status == 1:
+        self.usestart = self.clock.time()
+        self.usestop = None
+      else:
+        self.usestop = self.clock.time()
 
     if self.verbose:
       print "Got: %d" % (ret)
 
     return ret
 
+  def usageTime(self):
+    """
+    How many whole seconds the tool has been in use for, since the last
+    reportToolUse that started it, for toolUseTime
+    """
+    if self.usestart == None:
+      return 0
+    stop = self.usestop
+    if stop == None:
+      stop = self.clock.time()
+    return int(stop - self.usestart)
+
 if __name__ == "__main__":
   node = ACNode(1, "localhost", 1234)
 
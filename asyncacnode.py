@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+#
+# A non-blocking acnode client, so one process can drive lots of nodes at
+# once. Built on asyncore, everything runs from Loop.run()
+#
+
+import asyncore, socket, time
+from acnode import ResponseParser, body_result
+
+class Call(asyncore.dispatcher):
+  """
+  One request to the acserver.
+
+  When it finishes result is set to what ACNode.get_url would have
+  returned, and the callbacks are called with it. Cancelled calls don't
+  call their callbacks.
+
+  addrs are from getaddrinfo, each is tried in turn until one connects.
+  node, if set, is told which one did with node.connected(addr), or
+  node.unreachable() if none of them did.
+  """
+  def __init__(self, loop, addrs, request, timeout, callback, node=None):
+    asyncore.dispatcher.__init__(self, map=loop.map)
+    self.outbuf = request
+    self.parser = ResponseParser()
+    self.deadline = time.time() + timeout
+    self.callbacks = []
+    if callback != None:
+      self.callbacks.append(callback)
+    self.done = False
+    self.cancelled = False
+    self.result = None
+    self.node = node
+    # the ones left to try
+    self.addrs = list(addrs or [])
+    # the getaddrinfo result we're connecting to, not self.addr which
+    # asyncore keeps the bare address in
+    self.trying = None
+
+    if not self.next():
+      self.finish(-1)
+
+  def next(self):
+    """
+    Start connecting to the next address, returns False if there aren't
+    any left
+    """
+    if self.socket != None:
+      self.close()
+    while len(self.addrs) > 0:
+      self.trying = self.addrs.pop(0)
+      af, socktype, proto, canonname, sa = self.trying
+      try:
+        self.create_socket(af, socktype)
+        self.connect(sa)
+        return True
+      except socket.error as msg:
+        self.close()
+    if self.node != None:
+      self.node.unreachable()
+    return False
+
+  def retry(self):
+    """
+    If we haven't connected yet try the next address, returns True if
+    there was one
+    """
+    if self.connected or self.done:
+      return False
+    return self.next()
+
+  def finish(self, result):
+    if self.done:
+      return
+    self.done = True
+    self.result = result
+    if self.socket != None:
+      self.close()
+    if not self.cancelled:
+      for callback in self.callbacks:
+        callback(result)
+
+  def cancel(self):
+    self.cancelled = True
+    self.finish(None)
+
+  def expire(self, now):
+    if now >= self.deadline:
+      self.finish(-1)
+
+  def handle_connect(self):
+    if self.node != None:
+      self.node.connected(self.trying)
+
+  def writable(self):
+    return not self.connected or len(self.outbuf) > 0
+
+  def handle_write(self):
+    sent = self.send(self.outbuf)
+    self.outbuf = self.outbuf[sent:]
+
+  def handle_read(self):
+    if self.parser.feed(self.recv(4096)):
+      self.response()
+
+  def handle_close(self):
+    if self.retry():
+      return
+    self.parser.eof()
+    self.response()
+
+  def response(self):
+    if self.parser.error:
+      self.finish(-1)
+    else:
+      self.finish(body_result(self.parser.body))
+
+  def handle_error(self):
+    if self.retry():
+      return
+    self.finish(-1)
+
+class Loop:
+  """
+  Runs the Calls for any number of AsyncACNodes.
+  """
+  def __init__(self):
+    self.map = {}
+
+  def run(self, calls=None):
+    """
+    Run until all of calls have finished, or all outstanding calls if
+    calls is None.
+    """
+    while True:
+      now = time.time()
+      for call in self.map.values():
+        call.expire(now)
+      if calls == None:
+        pending = self.map.values()
+      else:
+        pending = [call for call in calls if not call.done]
+      if len(pending) == 0:
+        return
+      if len(self.map) == 0:
+        return
+      wait = min(call.deadline for call in self.map.values()) - now
+      asyncore.loop(timeout=max(0.0, min(wait, 1.0)), use_poll=True, map=self.map, count=1)
+
+class AsyncACNode:
+  """
+  Like ACNode, but each method starts a request and returns a Call,
+  callback(result) is called when it finishes. Nothing happens until
+  loop.run() is called.
+  """
+  def __init__(self, nodeid, servername, port, loop, secret=None, timeout=10.0):
+    self.nodeid = nodeid
+    self.servername = servername
+    self.port = port
+    self.loop = loop
+    self.secret = secret
+    self.timeout = timeout
+    # from getaddrinfo, the one that last worked first, or None to look
+    # them up again. Looked up here so it isn't done in the loop.
+    self.addrs = None
+    self.resolve()
+    # the end of every request, and the start of the common paths
+    self.tail = " HTTP/1.0\r\nHost: " + servername + "\r\n"
+    if secret != None:
+      self.tail += "X-AC-Key: " + secret + "\r\n"
+    self.tail += "\r\n"
+    self.cardpath = "GET /%d/card/" % (nodeid)
+    self.statuspath = "GET /%d/status/" % (nodeid)
+
+  def get_url(self, path, callback=None, timeout=None):
+    if timeout == None:
+      timeout = self.timeout
+
+    req = path + self.tail
+
+    if self.addrs == None:
+      # the last lookup failed or none of them worked
+      self.resolve()
+
+    return Call(self.loop, self.addrs, req, timeout, callback, self)
+
+  def resolve(self):
+    try:
+      self.addrs = socket.getaddrinfo(self.servername, self.port, socket.AF_UNSPEC, socket.SOCK_STREAM)
+    except socket.error as msg:
+      self.addrs = None
+
+  def connected(self, addr):
+    if self.addrs != None and addr in self.addrs:
+      # try it first next time
+      self.addrs = [addr] + [a for a in self.addrs if a != addr]
+
+  def unreachable(self):
+    self.addrs = None
+
+  def querycard(self, card, callback=None, timeout=None):
+    return self.get_url(self.cardpath + str(card), callback, timeout)
+
+  def networkCheckToolStatus(self, callback=None, timeout=None):
+    return self.get_url(self.statuspath, callback, timeout)
+
+  def setToolStatus(self, status, card, callback=None, timeout=None):
+    return self.get_url("POST /%ld/status/%d/by/%s" % (self.nodeid, status, card), callback, timeout)
+
+  def addNewUser(self, user, maintainer, callback=None, timeout=None):
+    return self.get_url("POST /%ld/grant-to-card/%s/by-card/%s" % (self.nodeid, user, maintainer), callback, timeout)
+
+  def toolUseTime(self, card, time, callback=None, timeout=None):
+    return self.get_url("POST /%ld/tooluse/time/for/%s/%d" % (self.nodeid, card, time), callback, timeout)
+
+  def reportToolUse(self, card, status, callback=None, timeout=None):
+    return self.get_url("POST /%ld/tooluse/%d/%s" % (self.nodeid, status, card), callback, timeout)
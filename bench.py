@@ -0,0 +1,498 @@
+#!/usr/bin/env python
+#
+# Benchmarks for the python acnode, run with:
+#
+#   python bench.py [name ...]
+#
+# with no names all of them are run.
+#
+
+import sys, os, time, tempfile, random, json, resource, threading, socket
+from acnode import ACNode, Card, ConnectionPool, CardCache, ResponseParser, SingleFlight, body_result
+from asyncacnode import AsyncACNode, Loop
+from eeprom import EepromImage
+from metrics import Instruments
+from uids import UidIndex
+from snapshot import PermissionSnapshot
+import carddb
+from stubserver import ACServer, StubServer
+
+def start_stub():
+  """
+  a stub acserver with the 0_carddb.json users, tool 1 and user 2 a user of it
+  """
+  acserver = ACServer("0_carddb.json")
+  acserver.add_tool(1, "test_tool", 1, "working ok")
+  acserver.set_permission(1, 2, 1)
+  return StubServer(0, acserver).start()
+
+def percentile(samples, p):
+  samples = sorted(samples)
+  return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+def report(name, samples, elapsed):
+  print "%-24s %8.0f req/s  p50 %7.3fms  p99 %7.3fms" % (name,
+    len(samples) / elapsed,
+    percentile(samples, 50) * 1000.0,
+    percentile(samples, 99) * 1000.0)
+
+def run_queries(node, card, count):
+  samples = []
+  start = time.time()
+  for i in range(count):
+    t = time.time()
+    node.querycard(card)
+    samples.append(time.time() - t)
+  return samples, time.time() - start
+
+def bench_pool(count=2000):
+  """
+  querycard pooled against unpooled, against a local stub acserver.
+  """
+  server = start_stub()
+  port = server.port
+  card = Card(0x22222222, False, True)
+
+  node = ACNode(1, "localhost", port)
+  samples, elapsed = run_queries(node, card, count)
+  report("unpooled", samples, elapsed)
+
+  pool = ConnectionPool()
+  node = ACNode(1, "localhost", port, pool=pool)
+  samples, elapsed = run_queries(node, card, count)
+  report("pooled", samples, elapsed)
+
+  pool.close()
+  server.stop()
+
+def bench_cache(count=100000):
+  """
+  repeat swipes of the same card, answered from a CardCache
+  """
+  server = start_stub()
+  port = server.port
+  card = Card(0x22222222, False, True)
+
+  node = ACNode(1, "localhost", port, cache=CardCache())
+  node.querycard(card)
+  samples, elapsed = run_queries(node, card, count)
+  print "%-24s %8.2fus per swipe  p99 %7.2fus" % ("cached",
+    elapsed / count * 1000000.0,
+    percentile(samples, 99) * 1000000.0)
+
+  server.stop()
+
+def bench_async(nodes=200, rounds=10):
+  """
+  lots of AsyncACNodes swiping at once from one process
+  """
+  server = start_stub()
+  port = server.port
+  card = Card(0x22222222, False, True)
+
+  for i in range(2, nodes + 1):
+    server.acserver.add_tool(i, "tool %d" % (i), 1, "working ok")
+    server.acserver.set_permission(i, 2, 1)
+
+  loop = Loop()
+  fleet = [AsyncACNode(i, "localhost", port, loop) for i in range(1, nodes + 1)]
+  samples = []
+  errors = [0]
+  def done(started):
+    def callback(result):
+      samples.append(time.time() - started)
+      if result != 1:
+        errors[0] += 1
+    return callback
+
+  start = time.time()
+  for r in range(rounds):
+    now = time.time()
+    calls = [node.querycard(card, done(now)) for node in fleet]
+    loop.run(calls)
+  report("async %d nodes" % (nodes), samples, time.time() - start)
+  print "%-24s %8d" % ("errors", errors[0])
+
+  server.stop()
+
+def old_parse(chunks):
+  """
+  the per character parser get_url used to have, for comparison
+  """
+  result = -1
+  res = ""
+  newlines = 0
+  first = False
+  for data in chunks:
+    for ch in data:
+      res += ch
+      if ch == '\n':
+        newlines += 1
+      else:
+        if ch != '\r':
+          newlines = 0
+      if first:
+        if ch.isdigit():
+          result = ord(ch) - ord('0')
+        return result
+      if newlines == 2:
+        first = True
+  return result
+
+def new_parse(chunks):
+  parser = ResponseParser()
+  for data in chunks:
+    if parser.feed(data):
+      break
+  return body_result(parser.body)
+
+def bench_parser(count=20000):
+  """
+  cpu time to parse synthetic responses, old parser against ResponseParser
+
+  python 2 has no tracemalloc, so allocations aren't counted here.
+  """
+  headers = "HTTP/1.0 200 OK\r\n" + \
+    "Date: Sat, 17 Oct 2026 12:00:00 GMT\r\n" + \
+    "Server: WSGIServer/0.1 Python/2.7.18\r\n" + \
+    "X-Frame-Options: SAMEORIGIN\r\n" + \
+    "Content-Type: text/html; charset=utf-8\r\n"
+  small = headers + "Content-Length: 1\r\n\r\n1"
+  padded = headers + "".join("X-Pad-%d: %s\r\n" % (i, "z" * 60) for i in range(40)) + "Content-Length: 1\r\n\r\n1"
+  responses = [
+    ("one recv", [small]),
+    ("split in 16 byte recvs", [small[i:i + 16] for i in range(0, len(small), 16)]),
+    ("3k of headers", [padded[i:i + 1024] for i in range(0, len(padded), 1024)]),
+  ]
+  for name, chunks in responses:
+    for parse in (old_parse, new_parse):
+      start = time.clock()
+      for i in range(count):
+        parse(chunks)
+      elapsed = time.clock() - start
+      print "%-24s %-10s %8.2fus cpu per response" % (name, parse.__name__, elapsed / count * 1000000.0)
+
+def bench_many(count=500):
+  """
+  querying lots of cards one at a time, against querycard_many
+  """
+  server = start_stub()
+  port = server.port
+  cards = [Card(0x10000000 + i, False, True) for i in range(count)]
+
+  unpooled = ACNode(1, "localhost", port)
+  pool = ConnectionPool()
+  node = ACNode(1, "localhost", port, pool=pool)
+  for name, query in (("querycard unpooled", lambda: [unpooled.querycard(card) for card in cards]),
+                      ("querycard pooled", lambda: [node.querycard(card) for card in cards]),
+                      ("querycard_many", lambda: node.querycard_many(cards))):
+    start = time.time()
+    query()
+    elapsed = time.time() - start
+    print "%-24s %8.2fms for %d cards" % (name, elapsed * 1000.0, count)
+
+  pool.close()
+  server.stop()
+
+def bench_coalesce(threads=32, bursts=50):
+  """
+  bursts of threads swiping the same card at once, with and without a
+  SingleFlight, counting the requests that get to the server
+  """
+  server = start_stub()
+  port = server.port
+  card = Card(0x22222222, False, True)
+
+  hits = [0]
+  lock = threading.Lock()
+  handle = server.acserver.handle
+  def counted(*args):
+    with lock:
+      hits[0] += 1
+    return handle(*args)
+  server.acserver.handle = counted
+
+  for name, flights in (("independent", None), ("coalesced", SingleFlight())):
+    node = ACNode(1, "localhost", port, flights=flights)
+    # the node checks the tool status in the background when it starts,
+    # that isn't a swipe
+    node.statusready.wait()
+    hits[0] = 0
+    samples = []
+    start = time.time()
+    for b in range(bursts):
+      go = threading.Event()
+      def swipe():
+        go.wait()
+        t = time.time()
+        node.querycard(card)
+        samples.append(time.time() - t)
+      fleet = [threading.Thread(target=swipe) for i in range(threads)]
+      for t in fleet:
+        t.start()
+      go.set()
+      for t in fleet:
+        t.join()
+    report(name, samples, time.time() - start)
+    print "%-24s %8d for %d swipes" % ("server hits", hits[0], threads * bursts)
+
+  server.stop()
+
+class CountingSocket:
+  """
+  counts the calls that would each have been a syscall on a real socket
+  """
+  def __init__(self):
+    self.calls = 0
+
+  def send(self, data):
+    self.calls += 1
+    return len(data)
+
+  sendall = send
+
+def old_send(c, path, servername, secret):
+  """
+  how get_url used to build and send a request, for comparison
+  """
+  def get_constants(prefix):
+    return dict((getattr(socket, n), n) for n in dir(socket) if n.startswith(prefix))
+  families = get_constants('AF_')
+  types = get_constants('SOCK_')
+  protocols = get_constants('IPPROTO_')
+  c.send(path)
+  c.send(" HTTP/1.0\n")
+  c.send("Host: ")
+  c.send(servername+"\n");
+  if secret != None:
+    c.send("X-AC-Key: " + secret + "\n")
+  c.send("\n")
+
+def bench_request(count=20000):
+  """
+  CPU time and send calls to build and send a querycard request, the old
+  way against the node's precomputed one
+  """
+  node = NullNode(1, "localhost", 1, secret="12345678")
+  card = Card(0x22222222, False, True)
+  for name, send in (("old", lambda c: old_send(c, "GET /%d/card/%s" % (node.nodeid, card), node.servername, node.secret)),
+                     ("precomputed", lambda c: c.sendall(node.cardpath + str(card) + node.tail(node.servername, False, "HTTP/1.0")))):
+    c = CountingSocket()
+    start = resource.getrusage(resource.RUSAGE_SELF)
+    for i in range(count):
+      send(c)
+    end = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (end.ru_utime - start.ru_utime) + (end.ru_stime - start.ru_stime)
+    print "%-24s %8.2fus cpu per request  %d sends" % (name, cpu / count * 1000000.0, c.calls / count)
+
+class NullNode(ACNode):
+  """
+  answers without going near the network, to time what's around it
+  """
+  def unpooled_get_url(self, servername, port, path, timeout, name=None):
+    return 1
+
+def bench_instruments(count=200000, requests=2000):
+  """
+  what Instruments cost per request, disabled and enabled, first with no
+  network and then against a stub acserver
+  """
+  path = "GET /1/card/22222222"
+  for name, instruments in (("disabled", None), ("enabled", Instruments())):
+    node = NullNode(1, "localhost", 1, instruments=instruments)
+    start = time.time()
+    for i in range(count):
+      node.unpooled_get_url("localhost", 1, path, 10.0)
+    bare = time.time() - start
+    start = time.time()
+    for i in range(count):
+      node.fetch(path)
+    elapsed = time.time() - start
+    print "%-24s %8.3fus per request overhead" % (name, (elapsed - bare) / count * 1000000.0)
+
+  server = start_stub()
+  card = Card(0x22222222, False, True)
+  instruments = Instruments()
+  for name, i in (("stub disabled", None), ("stub enabled", instruments)):
+    node = ACNode(1, "localhost", server.port, instruments=i)
+    samples, elapsed = run_queries(node, card, requests)
+    report(name, samples, elapsed)
+  for phase in ("resolve", "connect", "send", "ttfb", "body", "total"):
+    h = instruments.spans[("card", phase)]
+    print "%-24s %8.3fms mean  p99 %7.3fms" % ("  " + phase, h.mean() * 1000.0, h.percentile(99) * 1000.0)
+  server.stop()
+
+def bench_uids(count=1000000, lookups=1000000):
+  """
+  mixed case 4 and 7 byte uid strings: checking, deduping, looking up
+  and diffing them as strings via Card, against a UidIndex
+  """
+  rand = random.Random(0)
+  strings = []
+  for i in range(count):
+    if rand.random() < 0.5:
+      s = "%08x" % (rand.getrandbits(32))
+    else:
+      s = "04%012x" % (rand.getrandbits(48))
+    if rand.random() < 0.5:
+      s = s.upper()
+    strings.append(s)
+  other = strings[count // 10:] + ["%08x" % (rand.getrandbits(32)) for i in range(count // 10)]
+  cards = [Card(rand.getrandbits(32), False, True) for i in range(lookups)]
+
+  def as_strings():
+    known = set(str(Card(int(s, 16), False, True)) for s in strings)
+    hits = sum(1 for card in cards if str(card) in known)
+    new = set(str(Card(int(s, 16), False, True)) for s in other)
+    return hits, len(new - known), len(known - new)
+
+  def as_index():
+    known = UidIndex.from_strings(strings)
+    hits = sum(1 for card in cards if card.uid in known)
+    added, removed = known.diff(UidIndex.from_strings(other))
+    return hits, len(added), len(removed)
+
+  for name, fn in (("strings via Card", as_strings), ("UidIndex", as_index)):
+    start = time.time()
+    ret = fn()
+    elapsed = time.time() - start
+    print "%-24s %8.2fs for %d uids, %d lookups  %r" % (name, elapsed, count, lookups, ret)
+
+def bench_eeprom(count=1000000):
+  """
+  scanning a big eeprom image
+  """
+  fd, filename = tempfile.mkstemp()
+  os.close(fd)
+  image = EepromImage.create(filename, (count + 1) * 8)
+  start = time.time()
+  for i in range(count):
+    image.append(Card(0x10000000 + i, False, True))
+  print "%-24s %8.2fs for %d cards" % ("append", time.time() - start, count)
+
+  for name, scan in (("records", image.records), ("uids", image.uids), ("cards", image.cards)):
+    start = time.time()
+    n = 0
+    for x in scan():
+      n += 1
+    elapsed = time.time() - start
+    print "%-24s %8.2fs %8.0f records/s" % ("scan " + name, elapsed, n / elapsed)
+
+  start = time.time()
+  image.find(0x10000000 + count - 1)
+  print "%-24s %8.2fs" % ("find last", time.time() - start)
+
+  image.close()
+  os.unlink(filename)
+
+def write_carddb(filename, members, seed):
+  """
+  a synthetic carddb, each member has one or two cards
+  """
+  rnd = random.Random(seed)
+  f = open(filename, "wb")
+  f.write("[\n")
+  for i in range(members):
+    if i > 0:
+      f.write(",\n")
+    cards = ["%08X" % (0x10000000 + i)]
+    if rnd.random() < 0.3:
+      cards.append("%014X" % (0x04000000000000 + i))
+    json.dump({"id": str(i + 1), "nick": "member%d" % (i + 1),
+               "subscribed": rnd.random() < 0.9, "gladosfile": "",
+               "perms": [], "cards": cards}, f)
+  f.write("\n]\n")
+  f.close()
+
+def bench_carddb(members=100000):
+  """
+  loading and diffing a big carddb
+  """
+  fd, old = tempfile.mkstemp()
+  os.close(fd)
+  fd, new = tempfile.mkstemp()
+  os.close(fd)
+  write_carddb(old, members, 1)
+  write_carddb(new, members, 2)
+  print "%-24s %8.1fMB" % ("carddb size", os.path.getsize(old) / 1e6)
+
+  start = time.time()
+  n = 0
+  for user in carddb.users(old):
+    n += 1
+  print "%-24s %8.2fs" % ("stream users", time.time() - start)
+
+  start = time.time()
+  a = carddb.CardDB.load(old)
+  b = carddb.CardDB.load(new)
+  print "%-24s %8.2fs" % ("load both", time.time() - start)
+
+  start = time.time()
+  d = a.diff(b)
+  print "%-24s %8.2fs %d changes" % ("diff", time.time() - start, len(d))
+
+  start = time.time()
+  a.apply(d)
+  print "%-24s %8.2fs" % ("apply", time.time() - start)
+  print "%-24s %8.1fMB" % ("max rss", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3)
+
+  os.unlink(old)
+  os.unlink(new)
+
+def bench_snapshot(sizes=(1000, 100000, 1000000), lookups=100000):
+  """
+  opening a permission snapshot, and looking cards up in it, by size
+  """
+  for size in sizes:
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    os.unlink(filename)
+    uids = random.sample(xrange(2**32), size)
+    snapshot = PermissionSnapshot(filename)
+    for uid in uids:
+      snapshot.put(uid, 1)
+    start = time.time()
+    snapshot.close()
+    write = time.time() - start
+
+    start = time.time()
+    snapshot = PermissionSnapshot(filename)
+    first = snapshot.get(uids[0])
+    opened = time.time() - start
+
+    sample = [random.choice(uids) for i in xrange(lookups)]
+    start = time.time()
+    for uid in sample:
+      snapshot.get(uid)
+    per = (time.time() - start) / lookups
+    # what the node does after a few new answers
+    for uid in random.sample(xrange(2**32), 10):
+      snapshot.put(uid, 0)
+    start = time.time()
+    snapshot.flush()
+    flush = time.time() - start
+    print "%-24s %8.2fms open, %6.2fus a lookup, %.2fs to write %.1fMB, %.1fms to flush 10 more" % (
+      "%d cards" % (size), opened * 1000.0, per * 1e6, write, os.path.getsize(filename) / 1e6, flush * 1000.0)
+    snapshot.close()
+    os.unlink(filename)
+
+BENCHMARKS = {
+  "pool": bench_pool,
+  "cache": bench_cache,
+  "async": bench_async,
+  "parser": bench_parser,
+  "many": bench_many,
+  "coalesce": bench_coalesce,
+  "instruments": bench_instruments,
+  "request": bench_request,
+  "uids": bench_uids,
+  "eeprom": bench_eeprom,
+  "carddb": bench_carddb,
+  "snapshot": bench_snapshot,
+}
+
+if __name__ == "__main__":
+  names = sys.argv[1:] or sorted(BENCHMARKS.keys())
+  for name in names:
+    print "==", name
+    BENCHMARKS[name]()
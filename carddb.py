@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+#
+# Load carddb.json files and work out what changed between two of them
+#
+
+import json
+from uids import parse_uid
+
+def users(f, chunksize=65536):
+  """
+  Yield the users in a carddb file one at a time, so big files don't
+  have to be read into memory all at once. f is a file object or a
+  filename.
+
+  A carddb is a json list of users like:
+
+    {"id":"1", "nick":"test1", "subscribed":true, "gladosfile":"zz",
+     "perms":[], "cards":["00112233445566","aabbccdd"]}
+  """
+  if isinstance(f, basestring):
+    f = open(f, "rb")
+
+  decoder = json.JSONDecoder()
+  buf = ""
+  pos = 0
+  started = False
+  eof = False
+  while True:
+    # skip to the start of the next user
+    while pos < len(buf) and buf[pos] in " \t\r\n,[]":
+      if buf[pos] == "[":
+        started = True
+      pos += 1
+    if pos == len(buf):
+      if eof:
+        return
+      buf = f.read(chunksize)
+      pos = 0
+      eof = len(buf) == 0
+      continue
+
+    if not started:
+      raise ValueError("carddb is not a list")
+
+    try:
+      user, end = decoder.raw_decode(buf, pos)
+    except ValueError:
+      # probably cut off part way through, get some more
+      if eof:
+        raise
+      more = f.read(chunksize)
+      eof = len(more) == 0
+      buf = buf[pos:] + more
+      pos = 0
+      continue
+
+    pos = end
+    yield user
+
+class CardDBDiff:
+  """
+  What changed between two carddbs.
+
+  added and removed are lists of (uid, user id), subscribed and
+  unsubscribed are lists of user ids. nicks has the nick of any users
+  that weren't in the old carddb.
+  """
+  def __init__(self):
+    self.added = []
+    self.removed = []
+    self.subscribed = []
+    self.unsubscribed = []
+    self.nicks = {}
+
+  def __len__(self):
+    return len(self.added) + len(self.removed) + len(self.subscribed) + len(self.unsubscribed)
+
+class CardDB:
+  """
+  An index of a carddb, by user id and by card uid. uids are ints.
+  """
+  def __init__(self):
+    # user id -> nick
+    self.nicks = {}
+    # user ids of subscribed users
+    self.subscribers = set()
+    # uid -> user id
+    self.cards = {}
+    # (user id, uid string) for cards in the file that aren't uids
+    self.invalid = []
+
+  @classmethod
+  def load(cls, f):
+    db = cls()
+    for user in users(f):
+      userid = int(user["id"])
+      uids = []
+      for uid in user["cards"]:
+        try:
+          uids.append(parse_uid(uid))
+        except ValueError:
+          db.invalid.append((userid, uid))
+      db.add_user(userid, user["nick"], user["subscribed"], uids)
+    return db
+
+  def add_user(self, userid, nick, subscribed, uids):
+    self.nicks[userid] = nick
+    if subscribed:
+      self.subscribers.add(userid)
+    else:
+      self.subscribers.discard(userid)
+    for uid in uids:
+      self.cards[uid] = userid
+
+  def user(self, uid):
+    """
+    The user id who owns uid, or None
+    """
+    return self.cards.get(uid)
+
+  def subscribed(self, uid):
+    """
+    Is uid the card of a subscribed user?
+    """
+    return self.cards.get(uid) in self.subscribers
+
+  def diff(self, other):
+    """
+    returns a CardDBDiff of what changed to get from here to other. A
+    card that moved to a different user is both removed and added.
+    """
+    d = CardDBDiff()
+    for uid, userid in other.cards.iteritems():
+      if self.cards.get(uid) != userid:
+        d.added.append((uid, userid))
+    for uid, userid in self.cards.iteritems():
+      if other.cards.get(uid) != userid:
+        d.removed.append((uid, userid))
+    d.subscribed = list(other.subscribers - self.subscribers)
+    d.unsubscribed = list(self.subscribers - other.subscribers)
+    for userid, nick in other.nicks.iteritems():
+      if userid not in self.nicks:
+        d.nicks[userid] = nick
+    return d
+
+  def apply(self, d):
+    """
+    Apply a CardDBDiff from diff(), so this matches the carddb it was
+    made against, without reloading it.
+    """
+    self.nicks.update(d.nicks)
+    for uid, userid in d.removed:
+      if self.cards.get(uid) == userid:
+        del self.cards[uid]
+    for uid, userid in d.added:
+      self.cards[uid] = userid
+    self.subscribers.difference_update(d.unsubscribed)
+    self.subscribers.update(d.subscribed)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#
+# Read and write acnode eeprom card list images
+#
+
+import os, mmap, struct
+from acnode import Card, CARD_SIZE, CARD_MAINTAINER, CARD_STATUS, CARD_INVALID, CARD_END, packed_uid
+
+class EepromImage:
+  """
+  A card list image, as an acnode keeps it in its eeprom, accessed
+  through mmap so it can be much bigger than a real eeprom.
+
+  The image is a run of packed Cards. Cards with the invalid bit set
+  have been removed and are skipped, the first record with the end bit
+  set is where the list stops. A blank eeprom is all 0xff, so it starts
+  with an end record.
+
+  Records are referred to by their offset in the image.
+  """
+  def __init__(self, filename, writable=True):
+    self.filename = filename
+    if writable:
+      self.f = open(filename, "r+b")
+      access = mmap.ACCESS_WRITE
+    else:
+      self.f = open(filename, "rb")
+      access = mmap.ACCESS_READ
+    self.size = os.fstat(self.f.fileno()).st_size
+    self.size -= self.size % CARD_SIZE
+    if self.size == 0:
+      self.f.close()
+      raise ValueError("%s is too small to be an eeprom image" % (filename))
+    self.map = mmap.mmap(self.f.fileno(), self.size, access=access)
+    self.end = self.find_end()
+
+  @classmethod
+  def create(cls, filename, size):
+    """
+    Make a blank image of size bytes, which has to be a whole number of
+    records
+    """
+    if size <= 0 or size % CARD_SIZE != 0:
+      raise ValueError("eeprom image size %d isn't a positive multiple of %d" % (size, CARD_SIZE))
+    blank = "\xff" * 65536
+    f = open(filename, "wb")
+    left = size
+    while left > 0:
+      f.write(blank[:min(left, len(blank))])
+      left -= len(blank)
+    f.close()
+    return cls(filename)
+
+  def flags(self, offset):
+    return struct.unpack_from("B", self.map, offset)[0]
+
+  def set_flags(self, offset, flags):
+    struct.pack_into("B", self.map, offset, flags)
+
+  def find_end(self):
+    for offset in xrange(0, self.size, CARD_SIZE):
+      if self.flags(offset) & CARD_END:
+        return offset
+    return self.size
+
+  def records(self):
+    """
+    the offsets of the valid records, nothing is copied out of the image
+    """
+    unpack = struct.unpack_from
+    for offset in xrange(0, self.end, CARD_SIZE):
+      if not unpack("B", self.map, offset)[0] & CARD_INVALID:
+        yield offset
+
+  def uids(self):
+    for offset in self.records():
+      yield packed_uid(self.map, offset)
+
+  def cards(self):
+    for offset in self.records():
+      yield Card.from_bytes(self.map, offset)
+
+  def __len__(self):
+    count = 0
+    for offset in self.records():
+      count += 1
+    return count
+
+  def find(self, uid):
+    """
+    returns the offset of the card with uid, or -1
+    """
+    for offset in self.records():
+      if packed_uid(self.map, offset) == uid:
+        return offset
+    return -1
+
+  def card(self, offset):
+    return Card.from_bytes(self.map, offset)
+
+  def set_bit(self, offset, bit, on):
+    flags = self.flags(offset)
+    if on:
+      flags |= bit
+    else:
+      flags &= ~bit
+    self.set_flags(offset, flags)
+
+  def set_status(self, offset, status):
+    self.set_bit(offset, CARD_STATUS, status)
+
+  def set_maintainer(self, offset, maintainer):
+    self.set_bit(offset, CARD_MAINTAINER, maintainer)
+
+  def remove(self, offset):
+    self.set_bit(offset, CARD_INVALID, True)
+
+  def append(self, card):
+    """
+    Add card after the last one, returns its offset
+    """
+    if self.end + CARD_SIZE > self.size:
+      raise ValueError("eeprom image is full")
+    offset = self.end
+    self.map[offset:offset + CARD_SIZE] = card.to_bytes()
+    self.end += CARD_SIZE
+    if self.end < self.size:
+      # blank the record after it, which marks the end
+      self.map[self.end:self.end + CARD_SIZE] = "\xff" * CARD_SIZE
+    return offset
+
+  def flush(self):
+    self.map.flush()
+
+  def close(self):
+    self.map.close()
+    self.f.close()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+#
+# Keeping a node's permissions up to date from the acserver, rather than
+# asking about every swipe.
+#
+
+import time, json, threading
+from acnode import ConnectionPool
+
+class PermissionFeed:
+  """
+  A copy of the permissions for a node's tool, as ACNode(feed=...).
+
+  A thread long polls GET /<nodeid>/permissions/<version>?wait=<wait>,
+  which the server answers when anything has changed since version, or
+  after wait seconds with no cards if nothing has. Each answer with cards
+  replaces the table.
+
+  While the last answer is less than wait + grace seconds old the table
+  is fresh and querycard answers from it, otherwise the node asks the
+  server as usual. If the server doesn't have a feed (it 404s) the thread
+  gives up and nothing changes.
+  """
+  def __init__(self, wait=25.0, grace=5.0, retry=5.0):
+    self.wait = wait
+    self.grace = grace
+    self.retry = retry
+    self.cond = threading.Condition()
+    # uid -> permission, for every card the server knows that can use
+    # the tool
+    self.table = {}
+    self.status = None
+    self.version = -1
+    # time.time() of the last answer
+    self.updated = None
+    # False once we know the server doesn't do feeds
+    self.supported = True
+    self.running = False
+    self.node = None
+    self.pool = ConnectionPool(maxidle=1, timeout=wait + grace)
+
+  def start(self, node):
+    self.node = node
+    self.running = True
+    t = threading.Thread(target=self.run)
+    t.daemon = True
+    t.start()
+
+  def stop(self):
+    """
+    the thread stops after the poll it's waiting on
+    """
+    with self.cond:
+      self.running = False
+      self.cond.notify_all()
+
+  def poll(self):
+    """
+    One long poll, returns False if we didn't get an answer
+    """
+    node = self.node
+    path = "GET /%d/permissions/%d?wait=%g" % (node.nodeid, self.version, self.wait)
+    resp = self.pool.request(node.servername, node.port, node.build_request(path))
+    if resp == None:
+      return False
+    status, headers, body, keepalive = resp
+    if status == 404:
+      self.supported = False
+      return False
+    try:
+      update = json.loads(str(body))
+    except ValueError:
+      return False
+
+    if "cards" in update:
+      node.setstatus(update["status"])
+    with self.cond:
+      self.updated = time.time()
+      if "cards" in update:
+        self.table = dict((int(uid, 16), perm) for uid, perm in update["cards"].items())
+        self.status = update["status"]
+      self.version = update["version"]
+      self.cond.notify_all()
+    return True
+
+  def run(self):
+    while self.running and self.supported:
+      if not self.poll() and self.supported:
+        with self.cond:
+          self.cond.wait(self.retry)
+    self.pool.close()
+
+  def fresh(self):
+    with self.cond:
+      return self.updated != None and time.time() - self.updated < self.wait + self.grace
+
+  def lookup(self, uid):
+    """
+    What querycard would get for uid
+    """
+    with self.cond:
+      return self.table.get(uid, -1)
+
+  def granted(self, uid):
+    """
+    The node has just given uid permission, so it can be used before the
+    server pushes it
+    """
+    with self.cond:
+      if self.table.get(uid, -1) == 0:
+        self.table[uid] = 1
+
+  def wait_version(self, version, timeout=None):
+    """
+    Wait for the table to be at least version, returns True if it is
+    """
+    deadline = None
+    if timeout != None:
+      deadline = time.time() + timeout
+    with self.cond:
+      while self.version < version:
+        if deadline == None:
+          self.cond.wait(1.0)
+        else:
+          left = deadline - time.time()
+          if left <= 0:
+            return False
+          self.cond.wait(left)
+      return True
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+#
+# The tools and permissions each set of tests starts from.
+#
+# A Baseline is built on the acserver the first time it's used, after
+# that putting it back before each test is a fixed, small number of bulk
+# operations over one connection for the whole run. The acserver writes
+# through its own connection, so we can't just roll back a transaction.
+#
+
+import os, sys
+import test_config
+
+class Baseline:
+  """
+  tools is a list of (tool id, name, status, status message, secret),
+  permissions a list of (tool id, user id, permission) and acnodes a
+  list of (acnode id, tool id). Users and cards are in 0_carddb.json
+  """
+  def __init__(self, name, tools, permissions, acnodes=[(1, 1)]):
+    self.name = name
+    self.tools = tools
+    self.permissions = permissions
+    self.acnodes = acnodes
+
+class StubFixture:
+  def __init__(self):
+    from stubserver import ACServer, StubServer
+    from acnode import VirtualClock
+    # the stub can share our idea of the time, so nothing needs to wait
+    self.clock = VirtualClock()
+    self.server = StubServer(test_config.ACNODE_ACSERVER_PORT, ACServer("0_carddb.json", self.clock)).start()
+    # if the port was 0 it's been picked for us
+    test_config.ACNODE_ACSERVER_PORT = self.server.port
+    self.acserver = self.server.acserver
+    # baseline name -> ACServer.snapshot()
+    self.snapshots = {}
+
+  def restore(self, baseline):
+    if baseline.name in self.snapshots:
+      self.acserver.restore(self.snapshots[baseline.name])
+      return
+    self.acserver.reset()
+    for tool in baseline.tools:
+      self.acserver.add_tool(*tool)
+    for perm in baseline.permissions:
+      self.acserver.set_permission(*perm)
+    self.snapshots[baseline.name] = self.acserver.snapshot()
+
+  def update_carddb(self, filename):
+    self.acserver.update_carddb(filename)
+
+class PhpFixture:
+  def __init__(self):
+    import MySQLdb
+    from acnode import Clock
+    # the server goes by the real time
+    self.clock = Clock()
+    self.db = MySQLdb.connect(host=test_config.MYSQL_HOST,
+                              user=test_config.MYSQL_USER,
+                              passwd=test_config.MYSQL_PASS,
+                              db=test_config.MYSQL_DB)
+    # baseline name -> [sql, ...]
+    self.statements = {}
+
+  def build(self, baseline):
+    """
+    the sql to put baseline back, one statement per table whatever the
+    number of rows
+    """
+    sql = [
+      "DELETE FROM permissions;",
+      "DELETE FROM acnodes;",
+      "DELETE FROM toolusage;",
+      "DELETE FROM tools;",
+    ]
+    tools = []
+    for toolid, name, status, status_message, secret in baseline.tools:
+      if secret != None:
+        raise RuntimeError("only the django server supports secret key thingys")
+      tools.append("(%d, %s, %d, %s)" % (toolid, self.db.literal(name), status, self.db.literal(status_message)))
+    sql.append("insert into tools (tool_id, name, status, status_message) VALUES %s;" % (", ".join(tools)))
+    acnodes = ["(%d, '%d', '%d', %d)" % (acnodeid, acnodeid, acnodeid, toolid) for acnodeid, toolid in baseline.acnodes]
+    sql.append("insert into acnodes (acnode_id, unique_identifier, shared_secret, tool_id) VALUES %s;" % (", ".join(acnodes)))
+    if baseline.permissions:
+      perms = ["(%d, %d, %d, NOW())" % perm for perm in baseline.permissions]
+      sql.append("insert into permissions (tool_id, user_id, permission, added_on) VALUES %s;" % (", ".join(perms)))
+    return sql
+
+  def restore(self, baseline):
+    if baseline.name not in self.statements:
+      self.statements[baseline.name] = self.build(baseline)
+    cur = self.db.cursor()
+    for sql in self.statements[baseline.name]:
+      cur.execute(sql)
+    self.db.commit()
+    cur.close()
+
+  def update_carddb(self, filename):
+    raise RuntimeError("Please implement php mode")
+
+class DjangoFixture:
+  def __init__(self):
+    from acnode import Clock
+    self.clock = Clock()
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'acserver.settings'
+    import django
+    djpath = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.path.sep + "acserver-django"
+    if os.path.exists(djpath):
+      self.djpath = djpath
+    elif test_config.ACNODE_ACSERVER_DJANGO:
+      self.djpath = test_config.ACNODE_ACSERVER_DJANGO
+    else:
+      raise RuntimeError("you need to put acserver-django on your python path somehow, bodge this here.")
+    sys.path.append(self.djpath)
+    django.setup()
+    from server.models import Tool, Permissions
+    self.Tool = Tool
+    self.Permissions = Permissions
+    # baseline name -> (tools, permissions), unsaved model instances
+    self.rows = {}
+
+  def build(self, baseline):
+    tools = []
+    for toolid, name, status, status_message, secret in baseline.tools:
+      if secret != None:
+        tools.append(self.Tool(id=toolid, name=name, status=status, status_message=status_message, secret=secret))
+      else:
+        tools.append(self.Tool(id=toolid, name=name, status=status, status_message=status_message))
+    # everything is added by user 1
+    perms = [self.Permissions(tool_id=toolid, user_id=userid, permission=permission, addedby_id=1)
+             for toolid, userid, permission in baseline.permissions]
+    return (tools, perms)
+
+  def restore(self, baseline):
+    if baseline.name not in self.rows:
+      self.rows[baseline.name] = self.build(baseline)
+    tools, perms = self.rows[baseline.name]
+    self.Permissions.objects.all().delete()
+    self.Tool.objects.filter(id__in=[t.id for t in tools]).delete()
+    self.Tool.objects.bulk_create(tools)
+    self.Permissions.objects.bulk_create(perms)
+
+  def update_carddb(self, filename):
+    import subprocess
+    update = [self.djpath + os.path.sep + "manage.py", "updatecarddb", filename]
+    subprocess.call(update)
+
+FIXTURES = {
+  "stub": StubFixture,
+  "php": PhpFixture,
+  "django": DjangoFixture,
+}
+
+current = None
+
+def fixture():
+  """
+  The fixture for test_config.TESTMODE, made the first time it's needed
+  and kept for the whole run
+  """
+  global current
+  if current == None:
+    current = FIXTURES[test_config.TESTMODE]()
+  return current
+
+def restore(baseline):
+  fixture().restore(baseline)
+
+def clock():
+  """
+  The clock the tests should use, a VirtualClock for the stub so time
+  dependent tests don't have to wait
+  """
+  return fixture().clock
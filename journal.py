@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+#
+# A write ahead journal for the reports an acnode sends the acserver, so
+# they aren't lost when the server can't be reached.
+#
+
+import os, time, threading, collections
+
+def linesize(q):
+  """
+  how long the R line for (seq, request) is
+  """
+  return len("R %d %s\n" % q)
+
+class Journal:
+  """
+  Requests that still have to get to the acserver, in an append only
+  file of lines like:
+
+    R <seq> <request>   a request to send
+    A <seq>             the server has answered it
+
+  append() returns as soon as the request is written, fsyncs are batched
+  up to syncdelay seconds apart. Once start()ed a thread sends the
+  requests in order, backing off while the server can't be reached. The
+  file is rewritten without the answered requests when it gets big, if
+  it's still more than maxsize bytes the oldest requests are dropped.
+
+  The fsyncs and rewrites are done by the sending thread, or by append()
+  after it's let go of the lock if there isn't one, and neither holds
+  the lock while it's waiting on the disk.
+  """
+  def __init__(self, filename, maxsize=1024 * 1024, syncdelay=0.2, backoff=1.0, maxbackoff=300.0):
+    self.filename = filename
+    self.maxsize = maxsize
+    self.syncdelay = syncdelay
+    self.backoff = backoff
+    self.maxbackoff = maxbackoff
+    self.cond = threading.Condition()
+    # (seq, request), oldest first
+    self.queue = collections.deque()
+    # the bytes the queue's R lines take up, so compacting knows what
+    # it's keeping without adding them up again
+    self.queued = 0
+    self.seq = 0
+    # requests thrown away to keep under maxsize
+    self.dropped = 0
+    self.load()
+    self.f = open(filename, "ab")
+    self.size = self.f.tell()
+    self.lastsync = 0.0
+    self.dirty = False
+    self.thread = None
+    self.running = False
+    # the seq of the request being sent, which mustn't be dropped
+    self.sending = None
+    # held while syncing or compacting, so there's one at a time
+    self.maintaining = threading.Lock()
+    # the seqs acked while a compaction is writing, or None
+    self.acked = None
+
+  def load(self):
+    if not os.path.exists(self.filename):
+      return
+    pending = {}
+    for line in open(self.filename, "rb"):
+      if not line.endswith("\n"):
+        # cut off by a crash
+        break
+      parts = line[:-1].split(" ", 2)
+      try:
+        seq = int(parts[1])
+      except (IndexError, ValueError):
+        continue
+      if parts[0] == "R" and len(parts) == 3:
+        pending[seq] = parts[2]
+      elif parts[0] == "A":
+        pending.pop(seq, None)
+      self.seq = max(self.seq, seq)
+    self.queue = collections.deque(sorted(pending.items()))
+    self.queued = sum(linesize(q) for q in self.queue)
+
+  def write(self, line):
+    self.f.write(line)
+    self.f.flush()
+    self.size += len(line)
+    self.dirty = True
+
+  def sync(self, force=False):
+    """
+    fsync if it's been syncdelay since the last one. Call with
+    self.maintaining held.
+    """
+    with self.cond:
+      if not self.dirty or (not force and time.time() - self.lastsync < self.syncdelay):
+        return
+      fd = self.f.fileno()
+      self.lastsync = time.time()
+      self.dirty = False
+    # the file is only swapped for another by compact(), which can't be
+    # running
+    os.fsync(fd)
+
+  def maintain(self, force=False):
+    """
+    Compact the file if it's got too big, and fsync it
+    """
+    with self.maintaining:
+      with self.cond:
+        big = self.size > self.maxsize or (self.size > self.maxsize / 2 and self.size > 2 * self.queued)
+      if big:
+        self.compact()
+      self.sync(force)
+
+  def append(self, request):
+    with self.cond:
+      self.seq += 1
+      self.queue.append((self.seq, request))
+      line = "R %d %s\n" % (self.seq, request)
+      self.queued += len(line)
+      self.write(line)
+      self.cond.notify_all()
+      inline = not self.running
+    if inline:
+      # there's no thread to do it
+      self.maintain()
+
+  def pending(self):
+    with self.cond:
+      return list(self.queue)
+
+  def ack(self, seq):
+    with self.cond:
+      if len(self.queue) > 0 and self.queue[0][0] == seq:
+        # the usual case, the sending thread acks the oldest
+        self.queued -= linesize(self.queue.popleft())
+      else:
+        for q in self.queue:
+          if q[0] == seq:
+            self.queue.remove(q)
+            self.queued -= linesize(q)
+            break
+      self.write("A %d\n" % (seq))
+      if self.acked != None:
+        self.acked.append(seq)
+      self.cond.notify_all()
+
+  def compact(self):
+    """
+    Rewrite the file with just the unanswered requests. The bulk of it
+    is written without the lock, then what's changed since is added with
+    it. Call with self.maintaining held.
+    """
+    with self.cond:
+      head = None
+      if len(self.queue) > 0 and self.queue[0][0] == self.sending:
+        head = self.queue.popleft()
+      while len(self.queue) > 0 and self.queued > self.maxsize / 2:
+        self.queued -= linesize(self.queue.popleft())
+        self.dropped += 1
+      if head != None:
+        self.queue.appendleft(head)
+      queue = list(self.queue)
+      last = self.seq
+      self.acked = []
+
+    tmp = self.filename + ".tmp"
+    f = open(tmp, "wb")
+    f.write("".join("R %d %s\n" % q for q in queue))
+    f.flush()
+    os.fsync(f.fileno())
+
+    with self.cond:
+      # appended and acked while we were writing
+      added = []
+      for q in reversed(self.queue):
+        if q[0] <= last:
+          break
+        added.append("R %d %s\n" % q)
+      added.reverse()
+      added += ["A %d\n" % (seq) for seq in self.acked if seq <= last]
+      self.acked = None
+      if len(added) > 0:
+        f.write("".join(added))
+        f.flush()
+        os.fsync(f.fileno())
+      f.close()
+      os.rename(tmp, self.filename)
+      self.f.close()
+      self.f = open(self.filename, "ab")
+      self.size = self.f.tell()
+      self.lastsync = time.time()
+      self.dirty = False
+
+  def start(self, send):
+    """
+    Start sending requests with send(request), which returns None if the
+    server couldn't be reached.
+    """
+    self.running = True
+    self.thread = threading.Thread(target=self.run, args=(send,))
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self):
+    with self.cond:
+      self.running = False
+      self.cond.notify_all()
+    if self.thread != None:
+      self.thread.join()
+    self.maintain(True)
+
+  def run(self, send):
+    wait = self.backoff
+    # time.time() to try again after a failure
+    retry = 0.0
+    while True:
+      with self.cond:
+        idle = len(self.queue) == 0
+      self.maintain(idle)
+
+      with self.cond:
+        if not self.running:
+          return
+        now = time.time()
+        if len(self.queue) == 0 or now < retry:
+          # woken by an append to see to the file, or to send it
+          timeout = self.syncdelay
+          if len(self.queue) > 0:
+            timeout = min(timeout, retry - now)
+          self.cond.wait(timeout)
+          continue
+        seq, request = self.queue[0]
+        self.sending = seq
+
+      ret = send(request)
+      if ret != None:
+        self.ack(seq)
+      with self.cond:
+        self.sending = None
+      if ret != None:
+        wait = self.backoff
+        retry = 0.0
+        continue
+      retry = time.time() + wait
+      wait = min(wait * 2, self.maxbackoff)
+
+  def wait(self, timeout=None):
+    """
+    Wait for everything to be sent, returns True if it was
+    """
+    deadline = None
+    if timeout != None:
+      deadline = time.time() + timeout
+    with self.cond:
+      while len(self.queue) > 0:
+        if deadline == None:
+          self.cond.wait(1.0)
+        else:
+          left = deadline - time.time()
+          if left <= 0:
+            return False
+          self.cond.wait(left)
+      return True
+
+  def close(self):
+    self.stop()
+    self.f.close()
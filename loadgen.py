@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+#
+# Load an acserver with a fleet of simulated acnodes.
+#
+#   python loadgen.py --nodes 100 --rate 2 --duration 30 --json run.json
+#
+# The server is the one in test_config, with TESTMODE stub (or --stub) a
+# stub acserver is started in another process.
+#
+# With --processes the nodes are split between that many worker
+# processes, so the GIL isn't the limit. A day of door traffic:
+#
+#   python loadgen.py --nodes 200 --virtual --duration 86400 --processes 8
+#
+
+import sys, time, json, random, threading, argparse, multiprocessing
+from acnode import ACNode, Card, ConnectionPool, Clock, VirtualClock
+from metrics import Histogram
+import carddb
+import test_config
+
+# how long get_url waits for the server
+TIMEOUT = 10.0
+
+ENDPOINTS = ["card", "status", "tooluse"]
+
+class EndpointStats:
+  def __init__(self):
+    self.latency = Histogram()
+    # the answers we got, result -> count
+    self.results = {}
+    # requests that didn't get an answer from the server
+    self.errors = 0
+    # and of those, the ones that took as long as the timeout
+    self.timeouts = 0
+
+  def merge(self, other):
+    self.latency.merge(other.latency)
+    for result, n in other.results.items():
+      self.results[result] = self.results.get(result, 0) + n
+    self.errors += other.errors
+    self.timeouts += other.timeouts
+
+  def to_dict(self, elapsed):
+    return {
+      "count": self.latency.count,
+      "throughput": self.latency.count / elapsed,
+      "errors": self.errors,
+      "timeouts": self.timeouts,
+      "results": dict((str(k), v) for k, v in self.results.items()),
+      "latency": self.latency.to_dict(),
+    }
+
+class LoadNode(ACNode):
+  """
+  An ACNode that notes whether its last request got an answer
+  """
+  neterror = False
+
+  def request(self, path):
+    ret = ACNode.request(self, path)
+    self.neterror = ret == None
+    return ret
+
+class SimulatedNode(threading.Thread):
+  """
+  One node, doing a random mix of requests with exponentially
+  distributed gaps between them, at rate requests a second on average,
+  for duration seconds by the node's clock. With a VirtualClock the gaps
+  take no time, so long runs are over as fast as the server can go.
+  """
+  def __init__(self, node, cards, mix, rate, duration, seed):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.node = node
+    self.clock = node.clock
+    self.cards = cards
+    self.mix = mix
+    self.rate = rate
+    self.duration = duration
+    self.random = random.Random(seed)
+    self.stats = dict((name, EndpointStats()) for name in ENDPOINTS)
+    # the card using the tool, if any
+    self.user = None
+
+  def choose(self):
+    x = self.random.random() * sum(self.mix.values())
+    for name in ENDPOINTS:
+      x -= self.mix.get(name, 0)
+      if x < 0:
+        return name
+    return ENDPOINTS[0]
+
+  def call(self, name):
+    if name == "card":
+      return self.node.querycard(self.random.choice(self.cards))
+    if name == "status":
+      return self.node.networkCheckToolStatus()
+    # tool use goes start, stop, start...
+    if self.user == None:
+      self.user = self.random.choice(self.cards)
+      return self.node.reportToolUse(self.user, 1)
+    ret = self.node.reportToolUse(self.user, 0)
+    if ret == 1:
+      ret = self.node.toolUseTime(self.user, self.node.usageTime())
+    self.user = None
+    return ret
+
+  def run(self):
+    when = self.clock.time()
+    deadline = when + self.duration
+    while True:
+      if self.rate > 0:
+        when += self.random.expovariate(self.rate)
+      now = self.clock.time()
+      if when >= deadline or now >= deadline:
+        return
+      if when > now:
+        self.clock.sleep(when - now)
+
+      name = self.choose()
+      start = time.time()
+      ret = self.call(name)
+      elapsed = time.time() - start
+
+      stats = self.stats[name]
+      stats.latency.add(elapsed)
+      if self.node.neterror:
+        stats.errors += 1
+        if elapsed >= TIMEOUT:
+          stats.timeouts += 1
+      else:
+        stats.results[ret] = stats.results.get(ret, 0) + 1
+
+def load_cards(filename):
+  cards = []
+  for user in carddb.users(filename):
+    for uid in user["cards"]:
+      cards.append(Card(int(uid, 16), False, True))
+  return cards
+
+def start_stub(port, nodes, firstnode, filename):
+  """
+  a stub acserver with a tool for each node, and every user in the
+  carddb a user of all of them
+  """
+  from stubserver import ACServer, StubServer
+  acserver = ACServer(filename)
+  for nodeid in range(firstnode, firstnode + nodes):
+    acserver.add_tool(nodeid, "tool %d" % (nodeid), 1, "working ok")
+    for userid in acserver.db.nicks.keys():
+      acserver.set_permission(nodeid, userid, 1)
+  server = StubServer(port, acserver)
+  # in its own process, so it isn't fighting the nodes for the GIL
+  process = multiprocessing.Process(target=server.serve_forever)
+  process.daemon = True
+  process.start()
+  server.process = process
+  return server
+
+def simulate(host, port, nodes, rate, duration, mix, cards, firstnode=1, pool=False, seed=0, virtual=False):
+  """
+  Run nodes SimulatedNodes, with ids from firstnode, in threads. With
+  virtual each node has its own VirtualClock. returns (elapsed, endpoint
+  name -> EndpointStats)
+  """
+  fleet = []
+  for i in range(nodes):
+    if pool:
+      p = ConnectionPool()
+    else:
+      p = None
+    if virtual:
+      clock = VirtualClock(time.time())
+    else:
+      clock = Clock()
+    node = LoadNode(firstnode + i, host, port, pool=p, clock=clock)
+    fleet.append(SimulatedNode(node, cards, mix, rate, duration, seed + i))
+
+  start = time.time()
+  for sim in fleet:
+    sim.start()
+  for sim in fleet:
+    sim.join()
+  elapsed = time.time() - start
+
+  totals = dict((name, EndpointStats()) for name in ENDPOINTS)
+  for sim in fleet:
+    for name in ENDPOINTS:
+      totals[name].merge(sim.stats[name])
+  return elapsed, totals
+
+def shards(nodes, firstnode, processes):
+  """
+  Split node ids firstnode.. between processes, returns [(firstnode,
+  nodes), ...] with the sizes as even as they'll go
+  """
+  ret = []
+  for i in range(processes):
+    n = nodes // processes
+    if i < nodes % processes:
+      n += 1
+    if n > 0:
+      ret.append((firstnode, n))
+    firstnode += n
+  return ret
+
+def worker(job):
+  """
+  simulate() in a worker process. The stats come back pickled, which is
+  a few hundred ints an endpoint however many requests there were.
+  """
+  args, kwargs = job
+  return simulate(*args, **kwargs)
+
+def run(host, port, nodes, rate, duration, mix, cards, firstnode=1, pool=False, seed=0, virtual=False, processes=1):
+  """
+  returns the results as a dict, ready to be dumped as json. With
+  processes > 1 the nodes are shared out between that many worker
+  processes, each with its own nodes and connections.
+  """
+  if processes <= 1:
+    elapsed, totals = simulate(host, port, nodes, rate, duration, mix, cards, firstnode, pool, seed, virtual)
+  else:
+    jobs = []
+    for first, n in shards(nodes, firstnode, processes):
+      # seeded so each node does what it would have in one process
+      jobs.append(((host, port, n, rate, duration, mix, cards),
+                   {"firstnode": first, "pool": pool, "seed": seed + first - firstnode, "virtual": virtual}))
+    start = time.time()
+    workers = multiprocessing.Pool(len(jobs))
+    done = workers.map(worker, jobs)
+    workers.close()
+    workers.join()
+    elapsed = time.time() - start
+    totals = dict((name, EndpointStats()) for name in ENDPOINTS)
+    for e, stats in done:
+      for name in ENDPOINTS:
+        totals[name].merge(stats[name])
+
+  return {
+    "config": {"host": host, "port": port, "nodes": nodes, "rate": rate,
+               "duration": duration, "mix": mix, "pool": pool, "seed": seed,
+               "virtual": virtual, "processes": processes},
+    "elapsed": elapsed,
+    "endpoints": dict((name, totals[name].to_dict(elapsed)) for name in ENDPOINTS),
+  }
+
+def report(results):
+  print "%d nodes for %.1fs" % (results["config"]["nodes"], results["elapsed"])
+  print "%-8s %8s %8s %8s %8s %9s %9s %9s" % ("", "count", "req/s", "errors", "timeouts", "p50 ms", "p99 ms", "max ms")
+  for name in ENDPOINTS:
+    e = results["endpoints"][name]
+    print "%-8s %8d %8.1f %8d %8d %9.2f %9.2f %9.2f" % (name, e["count"], e["throughput"],
+      e["errors"], e["timeouts"], e["latency"]["p50"] * 1000.0,
+      e["latency"]["p99"] * 1000.0, e["latency"]["max"] * 1000.0)
+
+def parse_mix(mix):
+  """
+  "card=80,status=15,tooluse=5" -> {"card": 80.0, ...}
+  """
+  ret = {}
+  for part in mix.split(","):
+    name, _, weight = part.partition("=")
+    if name not in ENDPOINTS:
+      raise argparse.ArgumentTypeError("unknown endpoint %s" % (name))
+    ret[name] = float(weight)
+  return ret
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="simulate a fleet of acnodes")
+  parser.add_argument("--host", default=test_config.ACNODE_ACSERVER_HOST)
+  parser.add_argument("--port", type=int, default=test_config.ACNODE_ACSERVER_PORT)
+  parser.add_argument("--stub", action="store_true", default=test_config.TESTMODE == "stub",
+                      help="start a stub acserver on the port")
+  parser.add_argument("--nodes", type=int, default=50)
+  parser.add_argument("--first-node", type=int, default=1)
+  parser.add_argument("--rate", type=float, default=1.0, help="requests per second per node")
+  parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+  parser.add_argument("--mix", type=parse_mix, default=parse_mix("card=80,status=15,tooluse=5"))
+  parser.add_argument("--carddb", default="0_carddb.json", help="where to get cards to swipe from")
+  parser.add_argument("--pool", action="store_true", help="use keep alive connections")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--virtual", action="store_true",
+                      help="don't wait between requests, duration is simulated time")
+  parser.add_argument("--processes", type=int, default=1,
+                      help="split the nodes between this many processes")
+  parser.add_argument("--json", help="write the results here, - for stdout")
+  args = parser.parse_args()
+
+  server = None
+  if args.stub:
+    server = start_stub(args.port, args.nodes, args.first_node, args.carddb)
+    args.host = "localhost"
+    args.port = server.port
+
+  results = run(args.host, args.port, args.nodes, args.rate, args.duration, args.mix,
+                load_cards(args.carddb), args.first_node, args.pool, args.seed, args.virtual,
+                args.processes)
+
+  if args.json == "-":
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+  else:
+    report(results)
+    if args.json:
+      f = open(args.json, "w")
+      json.dump(results, f, indent=2, sort_keys=True)
+      f.close()
+
+  if server != None:
+    server.process.terminate()
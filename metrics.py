@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+#
+# Counting things and timing them
+#
+
+import os, math, threading
+
+class Histogram:
+  """
+  Values (usually seconds) counted in log spaced buckets, each one 2**0.25
+  times wider than the last, starting from lowest. Good to within about
+  10%, and adding a value doesn't allocate anything.
+  """
+  STEPS = 4
+
+  def __init__(self, lowest=0.00001, buckets=120):
+    self.lowest = lowest
+    self.counts = [0] * buckets
+    self.count = 0
+    self.sum = 0.0
+    self.max = 0.0
+
+  def bucket(self, value):
+    if value <= self.lowest:
+      return 0
+    i = int(math.log(value / self.lowest, 2) * self.STEPS) + 1
+    return min(i, len(self.counts) - 1)
+
+  def upper(self, i):
+    """
+    the top of bucket i
+    """
+    return self.lowest * 2 ** (float(i) / self.STEPS)
+
+  def add(self, value):
+    self.counts[self.bucket(value)] += 1
+    self.count += 1
+    self.sum += value
+    if value > self.max:
+      self.max = value
+
+  def merge(self, other):
+    for i, n in enumerate(other.counts):
+      self.counts[i] += n
+    self.count += other.count
+    self.sum += other.sum
+    self.max = max(self.max, other.max)
+
+  def percentile(self, p):
+    if self.count == 0:
+      return 0.0
+    want = self.count * p / 100.0
+    seen = 0
+    for i, n in enumerate(self.counts):
+      seen += n
+      if seen >= want and n > 0:
+        return min(self.upper(i), self.max)
+    return self.max
+
+  def mean(self):
+    if self.count == 0:
+      return 0.0
+    return self.sum / self.count
+
+  def to_dict(self):
+    return {
+      "count": self.count,
+      "mean": self.mean(),
+      "max": self.max,
+      "p50": self.percentile(50),
+      "p90": self.percentile(90),
+      "p99": self.percentile(99),
+      "p999": self.percentile(99.9),
+      # [bucket upper bound, count] for the buckets with anything in
+      "buckets": [[self.upper(i), n] for i, n in enumerate(self.counts) if n > 0],
+    }
+
+# the part of an acserver path that says what kind of request it is ->
+# the name we count it under
+ENDPOINTS = {
+  "card": "card",
+  "status": "status",
+  "grant-to-card": "grant",
+  "tooluse": "tooluse",
+}
+
+def endpoint(path):
+  """
+  "GET /1/card/22222222" -> "card"
+  """
+  parts = path.split("/", 3)
+  if len(parts) < 3:
+    return "other"
+  return ENDPOINTS.get(parts[2], "other")
+
+class Instruments:
+  """
+  Where an ACNode reports on its requests, as ACNode(instruments=...).
+  Anything with the same span() and count() methods will do, this one
+  keeps a Histogram for each endpoint and phase in memory.
+
+  The phases are resolve, connect, send, ttfb (the wait for the first
+  byte of the response) and body, with total for the whole request.
+  count() is called once per request with the outcome, ok or error.
+  """
+  def __init__(self):
+    self.lock = threading.Lock()
+    # (endpoint, phase) -> Histogram
+    self.spans = {}
+    # (endpoint, outcome) -> count
+    self.counters = {}
+
+  def span(self, endpoint, phase, seconds):
+    with self.lock:
+      h = self.spans.get((endpoint, phase))
+      if h == None:
+        h = self.spans[(endpoint, phase)] = Histogram()
+      h.add(seconds)
+
+  def count(self, endpoint, outcome):
+    with self.lock:
+      key = (endpoint, outcome)
+      self.counters[key] = self.counters.get(key, 0) + 1
+
+  def prometheus(self):
+    """
+    Everything so far in the prometheus text format. The histogram
+    buckets are every 4th of ours, so le doubles from one to the next.
+    """
+    lines = [
+      "# HELP acnode_request_seconds Time spent in each phase of acserver requests.",
+      "# TYPE acnode_request_seconds histogram",
+    ]
+    with self.lock:
+      for (name, phase), h in sorted(self.spans.items()):
+        labels = 'endpoint="%s",phase="%s"' % (name, phase)
+        seen = 0
+        for i, n in enumerate(h.counts):
+          seen += n
+          if i % Histogram.STEPS == 0:
+            lines.append('acnode_request_seconds_bucket{%s,le="%.6g"} %d' % (labels, h.upper(i), seen))
+        lines.append('acnode_request_seconds_bucket{%s,le="+Inf"} %d' % (labels, h.count))
+        lines.append('acnode_request_seconds_sum{%s} %.9g' % (labels, h.sum))
+        lines.append('acnode_request_seconds_count{%s} %d' % (labels, h.count))
+
+      lines.append("# HELP acnode_requests_total Requests made to the acserver.")
+      lines.append("# TYPE acnode_requests_total counter")
+      for (name, outcome), n in sorted(self.counters.items()):
+        lines.append('acnode_requests_total{endpoint="%s",outcome="%s"} %d' % (name, outcome, n))
+    return "\n".join(lines) + "\n"
+
+  def write_prometheus(self, filename):
+    """
+    For the node exporter's textfile collector, written to a temporary
+    file and renamed so it's never seen half done
+    """
+    tmp = filename + ".tmp"
+    f = open(tmp, "w")
+    f.write(self.prometheus())
+    f.close()
+    os.rename(tmp, filename)
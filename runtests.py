@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+#
+# Run the tests in test.py across several processes.
+#
+#   ACNODE_TESTMODE=stub python runtests.py [-j N] [test names...]
+#
+# Each worker process has its own stub acserver, so the tests can't see
+# each others tools and permissions. The django and php modes share one
+# database between all the tests, so they only run with -j 1.
+#
+
+import sys, time, argparse, unittest, traceback, multiprocessing
+import test_config
+import test
+
+def tests(suite):
+  """
+  the individual tests in a suite, flattened
+  """
+  for t in suite:
+    if isinstance(t, unittest.TestSuite):
+      for x in tests(t):
+        yield x
+    else:
+      yield t
+
+class Result(unittest.TestResult):
+  """
+  Keeps the failures as text, so they can be sent back from a worker
+  """
+  def __init__(self):
+    unittest.TestResult.__init__(self)
+    self.outcome = "ok"
+    self.detail = ""
+
+  def addError(self, t, err):
+    self.outcome = "error"
+    self.detail = "".join(traceback.format_exception(*err))
+
+  def addFailure(self, t, err):
+    self.outcome = "fail"
+    self.detail = "".join(traceback.format_exception(*err))
+
+  def addSkip(self, t, reason):
+    self.outcome = "skip"
+    self.detail = reason
+
+def worker_init():
+  if test_config.TESTMODE == "stub":
+    # a stub acserver of our own, on a free port
+    test_config.ACNODE_ACSERVER_PORT = 0
+
+def run_one(name):
+  result = Result()
+  start = time.time()
+  unittest.defaultTestLoader.loadTestsFromName(name, test).run(result)
+  return (name, result.outcome, result.detail, time.time() - start)
+
+MARKS = {"ok": ".", "fail": "F", "error": "E", "skip": "s"}
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="run the tests in parallel")
+  parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count())
+  parser.add_argument("names", nargs="*", help="tests to run, e.g. AcnodeTests.test_user")
+  args = parser.parse_args()
+
+  if args.jobs > 1 and test_config.TESTMODE != "stub":
+    print "only TESTMODE stub can run tests in parallel, the %s tests share a database" % (test_config.TESTMODE)
+    args.jobs = 1
+
+  if args.names:
+    suite = unittest.defaultTestLoader.loadTestsFromNames(args.names, test)
+  else:
+    suite = unittest.defaultTestLoader.loadTestsFromModule(test)
+  names = [t.id()[len("test."):] for t in tests(suite)]
+
+  start = time.time()
+  pool = multiprocessing.Pool(args.jobs, worker_init)
+  results = []
+  for name, outcome, detail, elapsed in pool.imap_unordered(run_one, names):
+    sys.stdout.write(MARKS[outcome])
+    sys.stdout.flush()
+    results.append((name, outcome, detail))
+  pool.close()
+  pool.join()
+  elapsed = time.time() - start
+  print
+
+  bad = [r for r in results if r[1] in ("fail", "error")]
+  for name, outcome, detail in bad:
+    print "=" * 70
+    print "%s: %s" % (outcome.upper(), name)
+    print "-" * 70
+    print detail
+  print "-" * 70
+  print "Ran %d tests in %.3fs with %d processes" % (len(results), elapsed, args.jobs)
+  print
+  if bad:
+    print "FAILED (%d of them)" % (len(bad))
+    sys.exit(1)
+  print "OK"
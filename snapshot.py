@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+#
+# What a node knew about its cards and tool, kept on disk so it still
+# knows after a restart.
+#
+
+import os, mmap, struct, threading
+
+MAGIC = "ACPS"
+# the file format, files with any other are ignored
+FORMAT = 1
+# magic, format, tool status, number of cards
+HEADER = struct.Struct(">4sHbxI")
+# uid, permission, sorted by uid. The uid is big endian so comparing the
+# bytes compares the numbers.
+RECORD = struct.Struct(">Qb")
+
+def offset(i):
+  return HEADER.size + i * RECORD.size
+
+def lowerbound(m, count, key):
+  """
+  The index of the first of count records in m whose uid isn't less
+  than key, a packed uid
+  """
+  lo = 0
+  hi = count
+  while lo < hi:
+    mid = (lo + hi) // 2
+    if m[offset(mid):offset(mid) + 8] < key:
+      lo = mid + 1
+    else:
+      hi = mid
+  return lo
+
+class PermissionSnapshot:
+  """
+  Card permissions and the tool status, as ACNode(snapshot=...).
+
+  The file is a header and then a sorted table of (uid, permission)
+  records, which is mmapped rather than read, so opening it takes the
+  same time whatever its size and lookups are a binary search. Changes go
+  in memory until flush() writes a new file and renames it over the old
+  one. A missing file, or one in another format, is an empty snapshot.
+  flush() only holds the lock lookups use to copy what it's going to
+  write and to swap the new file in, not while it writes.
+  """
+  def __init__(self, filename):
+    self.filename = filename
+    self.lock = threading.Lock()
+    # held for the whole of a flush, so there's only one at a time
+    self.flushlock = threading.Lock()
+    # uid -> permission, newer than the file
+    self.changes = {}
+    self.status = None
+    self.count = 0
+    self.map = None
+    self.dirty = False
+    self.open()
+
+  def open(self):
+    if not os.path.exists(self.filename):
+      return
+    f = open(self.filename, "rb")
+    try:
+      size = os.fstat(f.fileno()).st_size
+      if size < HEADER.size:
+        return
+      m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+      f.close()
+    magic, format, status, count = HEADER.unpack_from(m, 0)
+    if magic != MAGIC or format != FORMAT or size != HEADER.size + count * RECORD.size:
+      m.close()
+      return
+    self.map = m
+    self.count = count
+    if status >= 0:
+      self.status = status
+
+  def search(self, uid):
+    """
+    the permission for uid in the file, or None
+    """
+    key = struct.pack(">Q", uid)
+    i = lowerbound(self.map, self.count, key)
+    if i < self.count and self.map[offset(i):offset(i) + 8] == key:
+      return RECORD.unpack_from(self.map, offset(i))[1]
+    return None
+
+  def get(self, uid):
+    """
+    The last permission we had for uid, or None if we never had one
+    """
+    with self.lock:
+      if uid in self.changes:
+        return self.changes[uid]
+      if self.map == None:
+        return None
+      return self.search(uid)
+
+  def put(self, uid, permission):
+    with self.lock:
+      if uid in self.changes:
+        if self.changes[uid] == permission:
+          return
+      elif self.map != None and self.search(uid) == permission:
+        return
+      self.changes[uid] = permission
+      self.dirty = True
+
+  def set_status(self, status):
+    with self.lock:
+      if status != self.status:
+        self.status = status
+        self.dirty = True
+
+  def uids(self):
+    """
+    every uid we know about
+    """
+    with self.lock:
+      uids = set(self.changes)
+      count = self.count
+      data = ""
+      if self.map != None:
+        data = self.map[HEADER.size:offset(count)]
+    for i in range(count):
+      uids.add(RECORD.unpack_from(data, i * RECORD.size)[0])
+    return sorted(uids)
+
+  def __len__(self):
+    return len(self.uids())
+
+  def flush(self):
+    """
+    Write out the changes, if there are any
+    """
+    with self.flushlock:
+      with self.lock:
+        if not self.dirty:
+          return
+        m = self.map
+        count = self.count
+        changes = dict(self.changes)
+        status = self.status
+        self.dirty = False
+
+      # the old table with the changes merged in, copying the runs of
+      # records between them as they are
+      code = status
+      if code == None:
+        code = -1
+      tmp = self.filename + ".tmp"
+      f = open(tmp, "wb")
+      f.write(HEADER.pack(MAGIC, FORMAT, code, 0))
+      n = 0
+      i = 0
+      for uid in sorted(changes):
+        key = struct.pack(">Q", uid)
+        j = i
+        if m != None:
+          j = lowerbound(m, count, key)
+        if j > i:
+          f.write(m[offset(i):offset(j)])
+          n += j - i
+        f.write(RECORD.pack(uid, changes[uid]))
+        n += 1
+        i = j
+        if m != None and j < count and m[offset(j):offset(j) + 8] == key:
+          # replaced
+          i = j + 1
+      if m != None and i < count:
+        f.write(m[offset(i):offset(count)])
+        n += count - i
+      f.seek(0)
+      f.write(HEADER.pack(MAGIC, FORMAT, code, n))
+      f.flush()
+      os.fsync(f.fileno())
+      f.close()
+      os.rename(tmp, self.filename)
+
+      with self.lock:
+        newer = self.status
+        self.map = None
+        self.count = 0
+        self.open()
+        self.status = newer
+        # anything that changed while we were writing is still to do
+        self.changes = dict((uid, permission) for uid, permission in self.changes.items()
+                            if changes.get(uid) != permission)
+        if len(self.changes) > 0 or self.status != status:
+          self.dirty = True
+      if m != None:
+        m.close()
+
+  def close(self):
+    self.flush()
+    with self.flushlock, self.lock:
+      if self.map != None:
+        self.map.close()
+        self.map = None
@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+#
+# A stub acserver that runs in process, for testing without the real one.
+#
+#   python stubserver.py [port [carddb.json]]
+#
+
+import sys, time, json, copy, struct, socket, threading, urllib, BaseHTTPServer, SocketServer
+import carddb
+from acnode import Clock
+
+# the key the api tests use
+API_KEY = "KEY GOES HERE"
+
+class Tool:
+  def __init__(self, toolid, name, status, status_message, secret=None):
+    self.toolid = toolid
+    self.name = name
+    self.status = status
+    self.status_message = status_message
+    self.secret = secret
+    # user id -> 1 for a user, 2 for a maintainer
+    self.permissions = {}
+    # user id of whoever is using the tool, or None
+    self.in_use = None
+    # and when they started
+    self.in_use_since = None
+    # (user id, seconds) for each toolUseTime report
+    self.usage = []
+    # (user id, seconds) between each reportToolUse start and stop
+    self.sessions = []
+
+class ACServer:
+  """
+  What the acserver knows and how it answers the acnodes, without the
+  http. Users and cards come from a carddb, the tools and permissions
+  are set up with add_tool and set_permission.
+  """
+  def __init__(self, carddbfile=None, clock=None):
+    self.lock = threading.Lock()
+    # goes up whenever a permission or tool status might have changed,
+    # for the permissions feed
+    self.version = 0
+    self.changed = threading.Condition(self.lock)
+    self.carddbfile = carddbfile
+    if clock == None:
+      clock = Clock()
+    self.clock = clock
+    self.reset()
+
+  def reset(self):
+    with self.lock:
+      self.tools = {}
+      if self.carddbfile != None:
+        self.db = carddb.CardDB.load(self.carddbfile)
+      else:
+        self.db = carddb.CardDB()
+      self.change()
+
+  def change(self):
+    """
+    wake up the feeds, call with self.lock held
+    """
+    self.version += 1
+    self.changed.notify_all()
+
+  def snapshot(self):
+    """
+    A copy of the tools, permissions and carddb, for restore()
+    """
+    with self.lock:
+      return copy.deepcopy((self.tools, self.db))
+
+  def restore(self, snapshot):
+    tools, db = copy.deepcopy(snapshot)
+    with self.lock:
+      self.tools = tools
+      self.db = db
+      self.change()
+
+  def update_carddb(self, filename):
+    """
+    like manage.py updatecarddb
+    """
+    new = carddb.CardDB.load(filename)
+    with self.lock:
+      self.db.apply(self.db.diff(new))
+      self.change()
+
+  def add_tool(self, toolid, name, status, status_message, secret=None):
+    with self.lock:
+      self.tools[toolid] = Tool(toolid, name, status, status_message, secret)
+      self.change()
+
+  def set_permission(self, toolid, userid, permission):
+    with self.lock:
+      self.tools[toolid].permissions[userid] = permission
+      self.change()
+
+  def permission(self, tool, uid):
+    """
+    What querycard should get for uid, -1 for cards that aren't known
+    or belong to someone who isn't subscribed
+    """
+    if not self.db.subscribed(uid):
+      return -1
+    return tool.permissions.get(self.db.user(uid), 0)
+
+  def node_request(self, method, nodeid, args, key):
+    """
+    The calls made by acnodes, returns the body of the response
+    """
+    tool = self.tools.get(nodeid)
+    if tool == None:
+      return -1
+    if tool.secret != None and key != tool.secret:
+      return 0
+
+    try:
+      if method == "GET" and args == ["status", ""]:
+        return tool.status
+
+      if method == "GET" and len(args) == 2 and args[0] == "card":
+        return self.permission(tool, int(args[1], 16))
+
+      if method == "GET" and args == ["is_tool_in_use"]:
+        if tool.in_use != None:
+          return "yes"
+        return "no"
+
+      if method == "POST" and len(args) == 4 and args[0] == "status" and args[2] == "by":
+        status = int(args[1])
+        perm = self.permission(tool, int(args[3], 16))
+        # any member can take a tool out of service, only maintainers
+        # can put it back
+        if perm < 0 or (status == 1 and perm < 2):
+          return 0
+        tool.status = status
+        self.change()
+        return 1
+
+      if method == "POST" and len(args) == 4 and args[0] == "grant-to-card" and args[2] == "by-card":
+        trainee = int(args[1], 16)
+        if self.permission(tool, int(args[3], 16)) != 2 or self.permission(tool, trainee) < 0:
+          return 0
+        userid = self.db.user(trainee)
+        if tool.permissions.get(userid, 0) == 0:
+          tool.permissions[userid] = 1
+          self.change()
+        return 1
+
+      if method == "POST" and len(args) == 5 and args[:3] == ["tooluse", "time", "for"]:
+        uid = int(args[3], 16)
+        if self.permission(tool, uid) < 1:
+          return 0
+        tool.usage.append((self.db.user(uid), int(args[4])))
+        return 1
+
+      if method == "POST" and len(args) == 3 and args[0] == "tooluse":
+        status = int(args[1])
+        uid = int(args[2], 16)
+        if self.permission(tool, uid) < 1:
+          return 0
+        now = self.clock.time()
+        if tool.in_use != None:
+          tool.sessions.append((tool.in_use, now - tool.in_use_since))
+        if status == 1:
+          tool.in_use = self.db.user(uid)
+          tool.in_use_since = now
+        else:
+          tool.in_use = None
+          tool.in_use_since = None
+        return 1
+    except ValueError:
+      return -1
+
+    return None
+
+  def permissions(self, nodeid, since, wait, key):
+    """
+    The permissions feed, a long poll. Waits up to wait seconds for
+    self.version to be something other than since, then returns the
+    version, the tool's status and every card that can be used with it
+    -> its permission. If nothing changed there's no cards. None if the
+    tool doesn't exist or the key is wrong.
+    """
+    deadline = time.time() + wait
+    with self.lock:
+      while True:
+        tool = self.tools.get(nodeid)
+        if tool == None or (tool.secret != None and key != tool.secret):
+          return None
+        left = deadline - time.time()
+        if self.version != since:
+          break
+        if left <= 0:
+          return {"version": self.version}
+        self.changed.wait(left)
+      cards = {}
+      for uid, userid in self.db.cards.iteritems():
+        if userid in self.db.subscribers:
+          cards["%x" % (uid)] = tool.permissions.get(userid, 0)
+      return {"version": self.version, "status": tool.status, "cards": cards}
+
+  def tools_summary(self, userid):
+    summary = []
+    for toolid in sorted(self.tools.keys()):
+      tool = self.tools[toolid]
+      permission = "un-authorised"
+      if userid in self.db.subscribers:
+        permission = {1: "user", 2: "maintainer"}.get(tool.permissions.get(userid), permission)
+      if tool.status == 1:
+        status = "Operational"
+      else:
+        status = "Out of service"
+      if tool.in_use != None:
+        in_use = "yes"
+      else:
+        in_use = "no"
+      summary.append({"name": tool.name, "status": status,
+                      "status_message": tool.status_message,
+                      "permission": permission, "in_use": in_use})
+    return summary
+
+  def handle(self, method, path, headers):
+    """
+    returns (http status, content type, body)
+    """
+    parts = urllib.unquote(path.split("?")[0]).split("/")[1:]
+
+    if method == "GET" and len(parts) == 3 and parts[:2] == ["api", "get_tools_summary_for_user"]:
+      if headers.get("API-KEY") != API_KEY:
+        return (401, "text/plain", "Unauthorized")
+      with self.lock:
+        body = json.dumps(self.tools_summary(int(parts[2])))
+      return (200, "application/json", body)
+
+    try:
+      nodeid = int(parts[0])
+    except ValueError:
+      return (404, "text/plain", "-1")
+
+    if method == "GET" and len(parts) == 3 and parts[1] == "permissions":
+      query = urllib.unquote(path.partition("?")[2])
+      try:
+        since = int(parts[2])
+        wait = 25.0
+        if query.startswith("wait="):
+          wait = min(60.0, float(query[5:]))
+      except ValueError:
+        return (404, "text/plain", "-1")
+      ret = self.permissions(nodeid, since, wait, headers.get("X-AC-Key"))
+      if ret == None:
+        return (404, "text/plain", "-1")
+      return (200, "application/json", json.dumps(ret))
+
+    with self.lock:
+      ret = self.node_request(method, nodeid, parts[1:], headers.get("X-AC-Key"))
+    if ret == None:
+      return (404, "text/plain", "-1")
+    return (200, "text/plain", str(ret))
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+  # pipelined responses are lots of small writes
+  disable_nagle_algorithm = True
+
+  def reply(self):
+    if self.server.delay > 0:
+      time.sleep(self.server.delay)
+    code, content_type, body = self.server.acserver.handle(self.command, self.path, self.headers)
+    length = int(self.headers.get("Content-Length", 0))
+    if length > 0:
+      self.rfile.read(length)
+    # one write, otherwise nagle and delayed acks stall kept alive connections
+    self.wfile.write("HTTP/1.1 %d %s\r\n"
+      "Content-Type: %s\r\n"
+      "Content-Length: %d\r\n"
+      "\r\n%s" % (code, self.responses[code][0], content_type, len(body), body))
+
+  do_GET = reply
+  do_POST = reply
+
+  def log_message(self, format, *args):
+    pass
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """
+  Serves an ACServer over http, port 0 picks a free port. start() runs
+  it in a background thread. Each answer waits delay seconds first.
+  """
+  daemon_threads = True
+  allow_reuse_address = True
+  request_queue_size = 1024
+
+  def __init__(self, port=0, acserver=None, host="localhost"):
+    BaseHTTPServer.HTTPServer.__init__(self, (host, port), StubHandler)
+    if acserver == None:
+      acserver = ACServer()
+    self.acserver = acserver
+    self.port = self.server_address[1]
+    self.delay = 0.0
+
+  def start(self):
+    t = threading.Thread(target=self.serve_forever)
+    t.daemon = True
+    t.start()
+    return self
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+
+class BrokenServer:
+  """
+  Accepts connections and then never answers (mode "hang"), resets
+  them straight away (mode "reset") or answers 1 a byte at a time every
+  0.1s (mode "drip"), for seeing how acnodes cope.
+  """
+  def __init__(self, mode, port=0, host="localhost"):
+    self.mode = mode
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.sock.bind((host, port))
+    self.sock.listen(64)
+    self.port = self.sock.getsockname()[1]
+    # connections we're sitting on
+    self.conns = []
+    self.accepted = 0
+
+  def serve_forever(self):
+    while True:
+      try:
+        c, addr = self.sock.accept()
+      except socket.error:
+        return
+      self.accepted += 1
+      if self.mode == "reset":
+        # close with an RST rather than a FIN
+        c.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        c.close()
+      elif self.mode == "drip":
+        self.conns.append(c)
+        t = threading.Thread(target=self.drip, args=(c,))
+        t.daemon = True
+        t.start()
+      else:
+        self.conns.append(c)
+
+  def drip(self, c):
+    try:
+      c.recv(4096)
+      for b in "HTTP/1.1 200 OK\r\nContent-Length: 1\r\n\r\n1":
+        c.sendall(b)
+        time.sleep(0.1)
+    except socket.error:
+      pass
+
+  def start(self):
+    t = threading.Thread(target=self.serve_forever)
+    t.daemon = True
+    t.start()
+    return self
+
+  def stop(self):
+    try:
+      self.sock.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+      pass
+    self.sock.close()
+    for c in self.conns:
+      c.close()
+
+if __name__ == "__main__":
+  port = 1234
+  filename = "0_carddb.json"
+  if len(sys.argv) > 1:
+    port = int(sys.argv[1])
+  if len(sys.argv) > 2:
+    filename = sys.argv[2]
+  acserver = ACServer(filename)
+  acserver.add_tool(1, "test_tool", 1, "working ok")
+  print "stub acserver on port %d" % (port)
+  StubServer(port, acserver).serve_forever()
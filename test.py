@@ -1,8 +1,20 @@
 #!/usr/bin/env python
 
-import unittest, MySQLdb, time, urllib2, json, os, sys, subprocess
-from acnode import ACNode, Card
+import unittest, urllib2, json, os, tempfile, shutil, threading, time, socket
+from acnode import ACNode, Card, CardCache, CardTable, CircuitBreaker, ConnectionPool, Policy, ResponseParser, Servers, SingleFlight, VirtualClock, body_result, preferred
+from asyncacnode import AsyncACNode, Loop
+from eeprom import EepromImage
+from journal import Journal
+from snapshot import PermissionSnapshot
+from feed import PermissionFeed
+from uids import UidIndex, parse_uid, uid_str
+import traffic
+from metrics import Instruments, endpoint
+from stubserver import ACServer, BrokenServer, StubServer
+import carddb
+import loadgen
 import test_config
+import fixtures
 
 class AcnodeTests(unittest.TestCase):
   # user 1 has 2 cards, and is a maintainer
@@ -20,6 +32,16 @@ class AcnodeTests(unittest.TestCase):
 
   user_does_not_exist = Card(0x12345678, False, True)
 
+  baseline = fixtures.Baseline("acnode",
+    tools=[(1, 'test_tool', 1, 'working ok', None),
+           # and to test the api a bit better lets have a 2nd
+           (2, 'other test tool', 0, 'Out of action', None)],
+    permissions=[(1, 2, 1), # user 2 is a user
+                 (1, 1, 2), # user 1 is a maintainer
+                 (1, 8, 1), # make the android tag a user
+                 (1, 5, 2), # make the temp card a maintainer
+                 (1, 4, 2)]) # make user 4 a maintainer
+
   def setUp(self):
     """
     import users and cards into the db:
@@ -40,99 +62,10 @@ class AcnodeTests(unittest.TestCase):
     insert into permissions (tool_id, user_id, permission) VALUES (1, 1, 2);
     
     """
-    if test_config.TESTMODE == "php":
-      db = MySQLdb.connect(host=test_config.MYSQL_HOST,
-                           user=test_config.MYSQL_USER,
-                           passwd=test_config.MYSQL_PASS,
-                           db=test_config.MYSQL_DB)
-      cur = db.cursor()
-      cur.execute("DELETE FROM permissions;")
-      cur.execute("DELETE FROM acnodes;")
-      cur.execute("DELETE FROM toolusage;")
-      cur.execute("DELETE FROM tools;")
-
-      # we need a tool to test with
-      cur.execute("insert into tools (tool_id, name, status, status_message) VALUES (1, 'test_tool', 1, 'working ok');")
-      # and to test the api a bit better lets have a 2nd
-      cur.execute("insert into tools (tool_id, name, status, status_message) VALUES (2, 'other test tool', 0, 'Out of action');")
-
-      # and now an acnode for our tool
-      cur.execute("insert into acnodes (acnode_id, unique_identifier, shared_secret, tool_id) VALUES (1, '1', '1', 1);")
-
-      # make user 2 a user for this tool
-      cur.execute("insert into permissions (tool_id, user_id, permission, added_on) VALUES (1, 2, 1, NOW());")
-    
-      # make user 1 a maintainer for this tool
-      cur.execute("insert into permissions (tool_id, user_id, permission, added_on) VALUES (1, 1, 2, NOW());")
-
-      # make the android tag a user
-      cur.execute("insert into permissions (tool_id, user_id, permission, added_on) VALUES (1, 8, 1, NOW());")
-
-      # make the temp card a maintainer
-      cur.execute("insert into permissions (tool_id, user_id, permission, added_on) VALUES (1, 5, 2, NOW());")
-
-      # make user 4 a maintainer
-      cur.execute("insert into permissions (tool_id, user_id, permission, added_on) VALUES (1, 4, 2, NOW());")
-
-      db.commit()
-      db.close()
-    elif test_config.TESTMODE == "django":
-      os.environ['DJANGO_SETTINGS_MODULE'] = 'acserver.settings'
-      import django
-      if os.path.exists(os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.path.sep + "acserver-django" ):
-        sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.path.sep + "acserver-django")
-      else:
-        if test_config.ACNODE_ACSERVER_DJANGO:
-          sys.path.append(test_config.ACNODE_ACSERVER_DJANGO)
-        else:
-          raise RunTimeException("you need to put acserver-django on your python path somehow, bodge this here.")
-      from server.models import Tool, Card, User, Permissions
-      from django.core.exceptions import ObjectDoesNotExist
-
-      django.setup()
-      try:
-        t = Tool.objects.get(id=1)
-        t.delete()
-        t = None
-      except ObjectDoesNotExist, e:
-        pass
-
-      try:
-        t = Tool.objects.get(id=2)
-        t.delete()
-        t = None
-      except ObjectDoesNotExist, e:
-        pass
-
-      t = Tool(id=1, name='test_tool', status=1, status_message='working ok')
-      t.save()
-
-      t = Tool(id=2, name='other test tool', status=0, status_message='Out of action')
-      t.save()
-
-      # clean permissions first
-      ps = Permissions.objects.all()
-      for p in ps:
-        p.delete()
-        p = None
-
-      # user 2 is a user
-      p = Permissions(user=User.objects.get(pk=2), permission=1, tool=Tool.objects.get(pk=1), addedby=User.objects.get(pk=1))
-      p.save()
-      # user 1 is a maintainer
-      p = Permissions(user=User.objects.get(pk=1), permission=2, tool=Tool.objects.get(pk=1), addedby=User.objects.get(pk=1))
-      p.save()
-      # make the android tag a user
-      p = Permissions(user=User.objects.get(pk=8), permission=1, tool=Tool.objects.get(pk=1), addedby=User.objects.get(pk=1))
-      p.save()
-      # make the temp card a maintainer
-      p = Permissions(user=User.objects.get(pk=5), permission=2, tool=Tool.objects.get(pk=1), addedby=User.objects.get(pk=1))
-      p.save()
-      # make user 4 a maintainer
-      p = Permissions(user=User.objects.get(pk=4), permission=2, tool=Tool.objects.get(pk=1), addedby=User.objects.get(pk=1))
-      p.save()
+    fixtures.restore(self.baseline)
 
-    self.node = ACNode(1, test_config.ACNODE_ACSERVER_HOST, test_config.ACNODE_ACSERVER_PORT)
+    self.clock = fixtures.clock()
+    self.node = ACNode(1, test_config.ACNODE_ACSERVER_HOST, test_config.ACNODE_ACSERVER_PORT, clock=self.clock)
 
   def test_online(self):
     # should be online now
@@ -201,9 +134,22 @@ class AcnodeTests(unittest.TestCase):
   def test_using_acnode(self):
     self.failUnless(self.node.reportToolUse(self.user2, 1) == 1)
     # and stop after 5 seconds
-    time.sleep(5)
-    self.failUnless(self.node.toolUseTime(self.user2, 5) == 1)
+    self.clock.sleep(5)
+    self.failUnless(self.node.usageTime() == 5)
+    self.failUnless(self.node.toolUseTime(self.user2, self.node.usageTime()) == 1)
+    self.failUnless(self.node.reportToolUse(self.user2, 0) == 1)
+
+  def test_long_session(self):
+    # a whole day, which only takes that long with a real server
+    if test_config.TESTMODE != "stub":
+      self.skipTest("needs the stub's clock")
+    self.failUnless(self.node.reportToolUse(self.user2, 1) == 1)
+    self.clock.sleep(24 * 60 * 60)
     self.failUnless(self.node.reportToolUse(self.user2, 0) == 1)
+    self.failUnless(self.node.toolUseTime(self.user2, self.node.usageTime()) == 1)
+    tool = fixtures.fixture().acserver.tools[1]
+    self.failUnless(tool.sessions == [(2, 24 * 60 * 60)])
+    self.failUnless(tool.usage == [(2, 24 * 60 * 60)])
 
   def test_set_offline(self):
     # take the tool offline
@@ -248,7 +194,7 @@ class AcnodeTests(unittest.TestCase):
     self.failUnless(response.read() == "yes")
 
     # if the tool starts and stops in the same second then this fails
-    time.sleep(1)
+    self.clock.sleep(1)
 
     # and stop
     self.failUnless(self.node.reportToolUse(self.user2, 0) == 1)
@@ -258,6 +204,195 @@ class AcnodeTests(unittest.TestCase):
     # this fails if the tool is used for less than a second actual bug?
     self.failUnless(ret == "no")
 
+  def test_pooled(self):
+    pool = ConnectionPool()
+    node = ACNode(1, test_config.ACNODE_ACSERVER_HOST, test_config.ACNODE_ACSERVER_PORT, pool=pool)
+    # the same connection gets used again
+    for i in range(3):
+      self.failUnless(node.querycard(self.user2) == 1)
+      self.failUnless(node.querycard(self.user_does_not_exist) == -1)
+    self.failUnless(node.setToolStatus(0, self.user2) == 1)
+    self.failUnless(node.networkCheckToolStatus() == 0)
+    pool.close()
+
+  def test_build_request(self):
+    node = ACNode(1, "acserver", 80, secret="12345678")
+    self.failUnless(node.build_request(node.cardpath + str(self.user2)) ==
+      "GET /1/card/22222222 HTTP/1.1\r\nHost: acserver\r\nX-AC-Key: 12345678\r\n\r\n")
+    self.failUnless(node.build_request("POST /1/tooluse/1/22222222") ==
+      "POST /1/tooluse/1/22222222 HTTP/1.1\r\nHost: acserver\r\nX-AC-Key: 12345678\r\nContent-Length: 0\r\n\r\n")
+    node.stop()
+
+  def test_querycard_many(self):
+    cards = [self.user1a, self.user1b, self.user2, self.user3, self.user4, self.user_does_not_exist]
+    ret = self.node.querycard_many(cards)
+    self.failUnless([ret[card] for card in cards] == [2, 2, 1, 0, -1, -1])
+
+  def test_async(self):
+    loop = Loop()
+    node = AsyncACNode(1, test_config.ACNODE_ACSERVER_HOST, test_config.ACNODE_ACSERVER_PORT, loop)
+    results = []
+    calls = [node.querycard(self.user1a, results.append),
+             node.querycard(self.user2),
+             node.querycard(self.user3),
+             node.networkCheckToolStatus()]
+    cancelled = node.querycard(self.user2, results.append)
+    cancelled.cancel()
+    loop.run()
+    self.failUnless([call.result for call in calls] == [2, 1, 0, 1])
+    self.failUnless(results == [2])
+
+  def test_async_addresses(self):
+    # the first address has nothing listening, like ::1 for an IPv4 only
+    # server, so it goes on to the next and remembers that one
+    loop = Loop()
+    node = AsyncACNode(1, test_config.ACNODE_ACSERVER_HOST, test_config.ACNODE_ACSERVER_PORT, loop)
+    dead = socket.socket()
+    dead.bind(("127.0.0.1", 0))
+    nothing = (socket.AF_INET, socket.SOCK_STREAM, 6, '', dead.getsockname())
+    dead.close()
+    good = node.addrs[0]
+    node.addrs = [nothing, good]
+    call = node.querycard(self.user2)
+    loop.run()
+    self.failUnless(call.result == 1)
+    self.failUnless(node.addrs == [good, nothing])
+    # and if none of them work, they're looked up again next time
+    node.addrs = [nothing]
+    call = node.querycard(self.user2)
+    loop.run()
+    self.failUnless(call.result == -1 and node.addrs == None)
+    call = node.querycard(self.user2)
+    loop.run()
+    self.failUnless(call.result == 1)
+
+  def test_coalesced(self):
+    flights = SingleFlight()
+    node = ACNode(1, test_config.ACNODE_ACSERVER_HOST, test_config.ACNODE_ACSERVER_PORT, flights=flights)
+    results = []
+    fleet = [threading.Thread(target=lambda: results.append(node.querycard(self.user2))) for i in range(8)]
+    for t in fleet:
+      t.start()
+    for t in fleet:
+      t.join()
+    self.failUnless(results == [1] * 8)
+    # posts always go through
+    self.failUnless(node.setToolStatus(0, self.user2) == 1)
+    self.failUnless(node.setToolStatus(0, self.user2) == 1)
+
+  def test_instruments(self):
+    instruments = Instruments()
+    node = ACNode(1, test_config.ACNODE_ACSERVER_HOST, test_config.ACNODE_ACSERVER_PORT, instruments=instruments)
+    node.statusready.wait(5.0)
+    self.failUnless(node.querycard(self.user2) == 1)
+    self.failUnless(node.reportToolUse(self.user2, 1) == 1)
+    for phase in ("resolve", "connect", "send", "ttfb", "body", "total"):
+      self.failUnless(instruments.spans[("card", phase)].count == 1)
+    # and the one from __init__
+    self.failUnless(instruments.counters == {("status", "ok"): 1, ("card", "ok"): 1, ("tooluse", "ok"): 1})
+
+  def test_pooled_instruments(self):
+    instruments = Instruments()
+    pool = ConnectionPool()
+    node = ACNode(1, test_config.ACNODE_ACSERVER_HOST, test_config.ACNODE_ACSERVER_PORT, instruments=instruments, pool=pool)
+    node.statusready.wait(5.0)
+    self.failUnless(node.querycard(self.user2) == 1)
+    self.failUnless(node.querycard(self.user2) == 1)
+    pool.close()
+    # the same phases, but the cards went on the connection kept alive
+    # from the status check so there was nothing to resolve or connect
+    for phase in ("send", "ttfb", "body", "total"):
+      self.failUnless(instruments.spans[("card", phase)].count == 2)
+    for phase in ("resolve", "connect"):
+      self.failUnless(instruments.spans[("status", phase)].count == 1)
+      self.failUnless(("card", phase) not in instruments.spans)
+
+  def test_status_watch(self):
+    node = ACNode(1, test_config.ACNODE_ACSERVER_HOST, test_config.ACNODE_ACSERVER_PORT, statusevery=0.05)
+    node.statusready.wait(5.0)
+    self.failUnless(node.toolStatus() == 1)
+    flips = []
+    changed = threading.Event()
+    def watcher(old, new):
+      flips.append((old, new))
+      changed.set()
+    node.watchstatus(watcher)
+    # someone else takes it out of service, and the next check notices
+    self.failUnless(self.node.setToolStatus(0, self.user2) == 1)
+    self.failUnless(changed.wait(5.0))
+    self.failUnless(node.toolStatus() == 0)
+    # and our own changes are straight away
+    self.failUnless(node.setToolStatus(1, self.user1a) == 1)
+    self.failUnless(node.toolStatus() == 1)
+    node.stop()
+    self.failUnless(flips == [(1, 0), (0, 1)])
+
+  def test_feed(self):
+    if test_config.TESTMODE != "stub":
+      self.skipTest("only the stub has a permissions feed")
+    acserver = fixtures.fixture().acserver
+    feed = PermissionFeed(wait=1.0)
+    node = ACNode(1, test_config.ACNODE_ACSERVER_HOST, test_config.ACNODE_ACSERVER_PORT, feed=feed)
+    self.failUnless(feed.wait_version(acserver.version, 5.0))
+    self.failUnless(feed.fresh())
+    for card, ret in ((self.user1a, 2), (self.user2, 1), (self.user3, 0), (self.user4, -1), (self.user_does_not_exist, -1)):
+      self.failUnless(node.querycard(card) == ret)
+    # a grant is there straight away
+    self.failUnless(node.addNewUser(self.user3, self.user1a) == 1)
+    self.failUnless(node.querycard(self.user3) == 1)
+    # and changes made elsewhere get pushed
+    acserver.set_permission(1, 2, 0)
+    self.failUnless(feed.wait_version(acserver.version, 5.0))
+    self.failUnless(node.querycard(self.user2) == 0)
+    self.failUnless(self.node.setToolStatus(0, self.user2) == 1)
+    self.failUnless(feed.wait_version(acserver.version, 5.0))
+    self.failUnless(node.status == 0)
+    feed.stop()
+
+  def test_feed_unsupported(self):
+    # no tool 42, so no feed for it
+    feed = PermissionFeed()
+    feed.node = ACNode(42, test_config.ACNODE_ACSERVER_HOST, test_config.ACNODE_ACSERVER_PORT)
+    self.failUnless(not feed.poll())
+    self.failUnless(not feed.supported and not feed.fresh())
+
+  def test_record_replay(self):
+    dir = tempfile.mkdtemp()
+    filename = os.path.join(dir, "traffic.jsonl")
+    recorder = traffic.Recorder(filename)
+    node = ACNode(1, test_config.ACNODE_ACSERVER_HOST, test_config.ACNODE_ACSERVER_PORT, recorder=recorder)
+    node.statusready.wait(5.0)
+    for card in (self.user1a, self.user2, self.user3, self.user_does_not_exist):
+      node.querycard(card)
+    other = ACNode(2, test_config.ACNODE_ACSERVER_HOST, test_config.ACNODE_ACSERVER_PORT, recorder=recorder)
+    other.statusready.wait(5.0)
+    recorder.close()
+
+    records = traffic.load(traffic.logfiles(filename))
+    self.failUnless(len(records) == 6)
+    self.failUnless([r["ret"] for r in records if r["node"] == 1] == [1, 2, 1, 0, -1])
+    self.failUnless(records[1]["req"] == "GET /1/card/00112233445566")
+
+    results = traffic.replay(records, test_config.ACNODE_ACSERVER_HOST, test_config.ACNODE_ACSERVER_PORT, None)
+    shutil.rmtree(dir)
+    self.failUnless(results["count"] == 6 and results["errors"] == 0 and results["mismatches"] == 0)
+
+  def test_journal(self):
+    dir = tempfile.mkdtemp()
+    journal = Journal(os.path.join(dir, "journal"))
+    node = ACNode(1, test_config.ACNODE_ACSERVER_HOST, test_config.ACNODE_ACSERVER_PORT, clock=self.clock, journal=journal)
+    self.failUnless(node.reportToolUse(self.user2, 1) == 1)
+    self.failUnless(node.setToolStatus(0, self.user2) == 1)
+    # status changes aren't journalled, the server has to say yes first
+    self.failUnless(self.node.networkCheckToolStatus() == 0)
+    self.failUnless(node.setToolStatus(1, self.user2) == 0)
+    self.failUnless(node.setToolStatus(1, self.user_does_not_exist) != 1)
+    self.failUnless(node.toolStatus() == 0)
+    self.failUnless(journal.wait(10.0))
+    journal.close()
+    shutil.rmtree(dir)
+    self.failUnless(self.node.networkCheckToolStatus() == 0)
+
   # apikey tests
   # API-KEY: 'KEY GOES HERE'
   def test_get_tools_summary_for_user(self):
@@ -340,73 +475,18 @@ class DbUpdateTests(unittest.TestCase):
   user3a = Card(0x33333300, False, True)
   user4  = Card(0x44444444, False, True)
 
-  djpath = None
+  baseline = fixtures.Baseline("dbupdate",
+    tools=[(1, 'test_tool', 1, 'working ok', None)],
+    # make user 3 a user
+    permissions=[(1, 3, 1)])
 
   def setUp(self):
-    if test_config.TESTMODE == "php":
-      db = MySQLdb.connect(host=test_config.MYSQL_HOST,
-                           user=test_config.MYSQL_USER,
-                           passwd=test_config.MYSQL_PASS,
-                           db=test_config.MYSQL_DB)
-      cur = db.cursor()
-      cur.execute("DELETE FROM permissions;")
-      cur.execute("DELETE FROM acnodes;")
-      cur.execute("DELETE FROM toolusage;")
-      cur.execute("DELETE FROM tools;")
-
-      # we need a tool to test with
-      cur.execute("insert into tools (tool_id, name, status, status_message) VALUES (1, 'test_tool', 1, 'working ok');")
-
-      # and now an acnode for our tool
-      cur.execute("insert into acnodes (acnode_id, unique_identifier, shared_secret, tool_id) VALUES (1, '1', '1', 1);")
-
-      # make user 4 a user
-      cur.execute("insert into permissions (tool_id, user_id, permission, added_on) VALUES (1, 3, 1, NOW());")
-      db.commit()
-      db.close()
-    elif test_config.TESTMODE == "django":
-      os.environ['DJANGO_SETTINGS_MODULE'] = 'acserver.settings'
-      import django
-      djpath = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.path.sep + "acserver-django"
-      if os.path.exists(djpath):
-        sys.path.append(djpath)
-        self.djpath = djpath
-      else:
-        if test_config.ACNODE_ACSERVER_DJANGO:
-          sys.path.append(test_config.ACNODE_ACSERVER_DJANGO)
-          self.djpath = test_config.ACNODE_ACSERVER_DJANGO
-        else:
-          raise RunTimeException("you need to put acserver-django on your python path somehow, bodge this here.")
-      from server.models import Tool, Card, User, Permissions
-      from django.core.exceptions import ObjectDoesNotExist
-
-      django.setup()
-      try:
-        t = Tool.objects.get(id=1)
-        t.delete()
-        t = None
-      except ObjectDoesNotExist, e:
-        pass
-
-      t = Tool(id=1, name='test_tool', status=1, status_message='working ok')
-      t.save()
-      # clean permissions first
-      ps = Permissions.objects.all()
-      for p in ps:
-        p.delete()
-        p = None
-      # make user 3 a user
-      p = Permissions(user=User.objects.get(pk=3), permission=1, tool=Tool.objects.get(pk=1), addedby=User.objects.get(pk=1))
-      p.save()
+    fixtures.restore(self.baseline)
 
     self.node = ACNode(1, test_config.ACNODE_ACSERVER_HOST, test_config.ACNODE_ACSERVER_PORT)
 
   def update_carddb(self, file):
-    if test_config.TESTMODE == "php":
-      raise RunTimeError("Please implement php mode")
-    elif test_config.TESTMODE == "django":
-      update = [self.djpath + os.path.sep + "manage.py", "updatecarddb", file]
-      subprocess.call(update)
+    fixtures.fixture().update_carddb(file)
 
   def test_start(self):
     # card exists and is a user for this tool
@@ -442,53 +522,14 @@ class SecretTests(unittest.TestCase):
   user3a = Card(0x33333300, False, True)
   user4  = Card(0x44444444, False, True)
 
-  djpath = None
+  baseline = fixtures.Baseline("secret",
+    tools=[(1, 'test_tool', 1, 'working ok', None),
+           (2, 'test_tool_with_secret', 1, 'working ok', '12345678')],
+    # make user 3 a user for tool 1 and 2
+    permissions=[(1, 3, 1), (2, 3, 1)])
 
   def setUp(self):
-    if test_config.TESTMODE == "php":
-      raise RunTimeError("only the django server supports secret key thingys")
-    elif test_config.TESTMODE == "django":
-      os.environ['DJANGO_SETTINGS_MODULE'] = 'acserver.settings'
-      import django
-      djpath = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.path.sep + "acserver-django"
-      if os.path.exists(djpath):
-        sys.path.append(djpath)
-        self.djpath = djpath
-      else:
-        if test_config.ACNODE_ACSERVER_DJANGO:
-          sys.path.append(test_config.ACNODE_ACSERVER_DJANGO)
-          self.djpath = test_config.ACNODE_ACSERVER_DJANGO
-        else:
-          raise RunTimeException("you need to put acserver-django on your python path somehow, bodge this here.")
-      from server.models import Tool, Card, User, Permissions
-      from django.core.exceptions import ObjectDoesNotExist
-
-      django.setup()
-      try:
-        t = Tool.objects.get(id=1)
-        t.delete()
-        t = None
-        t = Tool.objects.get(id=2)
-        t.delete()
-        t = None
-      except ObjectDoesNotExist, e:
-        pass
-
-      t = Tool(id=1, name='test_tool', status=1, status_message='working ok')
-      t.save()
-      t = Tool(id=2, name='test_tool_with_secret', status=1, status_message='working ok', secret='12345678')
-      t.save()
-      # clean permissions first
-      ps = Permissions.objects.all()
-      for p in ps:
-        p.delete()
-        p = None
-      # make user 3 a user for tool 1
-      p = Permissions(user=User.objects.get(pk=3), permission=1, tool=Tool.objects.get(pk=1), addedby=User.objects.get(pk=1))
-      p.save()
-      # and 2
-      p = Permissions(user=User.objects.get(pk=3), permission=1, tool=Tool.objects.get(pk=2), addedby=User.objects.get(pk=1))
-      p.save()
+    fixtures.restore(self.baseline)
 
     self.node = ACNode(1, test_config.ACNODE_ACSERVER_HOST, test_config.ACNODE_ACSERVER_PORT)
     self.node_one_with_secret = ACNode(1, test_config.ACNODE_ACSERVER_HOST, test_config.ACNODE_ACSERVER_PORT, secret='abcdefgh')
@@ -520,6 +561,841 @@ class SecretTests(unittest.TestCase):
     # we are sending the wrong secret, so should be refused
     self.failUnless(self.wrong_secret_node.querycard(self.user3) == 0)
 
+  def test_shared_flights(self):
+    # a node with the wrong key mustn't get an answer meant for the
+    # right one
+    flights = SingleFlight()
+    right = ACNode(2, test_config.ACNODE_ACSERVER_HOST, test_config.ACNODE_ACSERVER_PORT, secret='12345678', flights=flights)
+    wrong = ACNode(2, test_config.ACNODE_ACSERVER_HOST, test_config.ACNODE_ACSERVER_PORT, secret='xxxxxxxx', flights=flights)
+    right.statusready.wait(5.0)
+    wrong.statusready.wait(5.0)
+    go = threading.Event()
+    attempt = right.attempt
+    def held(path):
+      go.wait(5.0)
+      return attempt(path)
+    right.attempt = held
+
+    results = {}
+    def query(name, node):
+      results[name] = node.querycard(self.user3)
+    threads = [threading.Thread(target=query, args=("right", right))]
+    threads[0].start()
+    while len(flights.flights) == 0:
+      time.sleep(0.01)
+    threads.append(threading.Thread(target=query, args=("wrong", wrong)))
+    threads[1].start()
+    time.sleep(0.1)
+    go.set()
+    for t in threads:
+      t.join()
+    self.failUnless(results == {"right": 1, "wrong": 0})
+
+class ResilienceTests(unittest.TestCase):
+  # against servers of its own, which misbehave
+
+  card = Card(0x22222222, False, True)
+
+  def setUp(self):
+    self.clock = VirtualClock()
+    self.servers = []
+
+  def tearDown(self):
+    for server in self.servers:
+      server.stop()
+
+  def broken(self, mode):
+    server = BrokenServer(mode).start()
+    self.servers.append(server)
+    return server
+
+  def stub(self):
+    acserver = ACServer("0_carddb.json")
+    acserver.add_tool(1, "test_tool", 1, "working ok")
+    acserver.set_permission(1, 2, 1)
+    server = StubServer(0, acserver).start()
+    self.servers.append(server)
+    return server
+
+  def node(self, server, failures=100, **kwargs):
+    policy = Policy(deadlines={"card": 0.5, "status": 0.2, "tooluse": 0.5}, backoff=0.01,
+                    breaker=CircuitBreaker(failures, 30.0, self.clock), **kwargs)
+    node = ACNode(1, "localhost", server.port, policy=policy, clock=self.clock)
+    # the status check from __init__ is done in the background
+    node.statusready.wait(5.0)
+    return node
+
+  def test_hang(self):
+    node = self.node(self.broken("hang"))
+    start = time.time()
+    self.failUnless(node.querycard(self.card) == -1)
+    self.failUnless(time.time() - start < 1.0)
+    # and without the policy it doesn't wait forever either
+    self.failUnless(node.fetch("GET /1/card/22222222", 0.1) == None)
+
+  def test_quick_start(self):
+    # the server never answers, but the node's ready to go
+    start = time.time()
+    node = ACNode(1, "localhost", self.broken("hang").port)
+    self.failUnless(time.time() - start < 0.1)
+    self.failUnless(node.toolStatus() == 1 and not node.statusready.is_set())
+
+  def test_reset_retries_gets(self):
+    server = self.broken("reset")
+    node = self.node(server)
+    before = server.accepted
+    self.failUnless(node.querycard(self.card) == -1)
+    self.failUnless(server.accepted - before == 3)
+    # but not posts
+    before = server.accepted
+    self.failUnless(node.setToolStatus(0, self.card) == -1)
+    self.failUnless(server.accepted - before == 1)
+
+  def test_breaker(self):
+    server = self.broken("reset")
+    # the status check in __init__ is enough to open it
+    node = self.node(server, failures=3)
+    self.failUnless(node.policy.breaker.state == "open")
+    before = server.accepted
+    self.failUnless(node.querycard(self.card) == -1)
+    self.failUnless(server.accepted == before)
+    # one go after the cooloff, which fails so it's open again
+    self.clock.advance(30)
+    self.failUnless(node.querycard(self.card) == -1)
+    self.failUnless(server.accepted - before == 1)
+    self.failUnless(node.policy.breaker.state == "open")
+
+  def test_cached_fallback(self):
+    node = self.node(self.broken("hang"), failures=1)
+    node.cache = CardCache(clock=self.clock)
+    node.cache.put(self.card.uid, 1)
+    self.clock.advance(600)
+    start = time.time()
+    self.failUnless(node.querycard(self.card) == 1)
+    self.failUnless(time.time() - start < 0.1)
+
+  def test_snapshot_cold_start(self):
+    dir = tempfile.mkdtemp()
+    filename = os.path.join(dir, "snapshot")
+    server = self.stub()
+    node = ACNode(1, "localhost", server.port, snapshot=PermissionSnapshot(filename))
+    node.statusready.wait(5.0)
+    self.failUnless(node.querycard(self.card) == 1)
+    node.stop()
+
+    # restarted while the server's away, it still knows
+    snapshot = PermissionSnapshot(filename)
+    self.failUnless(snapshot.status == 1 and snapshot.get(self.card.uid) == 1)
+    node = ACNode(1, "localhost", self.broken("reset").port, snapshot=snapshot)
+    node.statusready.wait(5.0)
+    self.failUnless(node.querycard(self.card) == 1 and node.toolStatus() == 1)
+
+    # and when it's back, what it knew is checked in the background
+    server.acserver.set_permission(1, 2, 0)
+    node = ACNode(1, "localhost", server.port, snapshot=PermissionSnapshot(filename))
+    self.failUnless(node.reconciled.wait(5.0))
+    self.failUnless(node.snapshot.get(self.card.uid) == 0)
+    self.failUnless(PermissionSnapshot(filename).get(self.card.uid) == 0)
+    shutil.rmtree(dir)
+
+  def test_pooled_timeout(self):
+    server = self.stub()
+    node = ACNode(1, "localhost", server.port, pool=ConnectionPool())
+    node.statusready.wait(5.0)
+    self.failUnless(node.toolUseTime(self.card, 5) == 1)
+    # the kept alive connection times out, that isn't the server
+    # dropping it so the post isn't sent again
+    node.timeout = 0.3
+    server.delay = 0.5
+    self.failUnless(node.toolUseTime(self.card, 5) == -1)
+    time.sleep(0.5)
+    self.failUnless(len(server.acserver.tools[1].usage) == 2)
+
+    # and a get doesn't get twice its deadline
+    policy = Policy(deadlines={"card": 0.5}, retries=0)
+    node = ACNode(1, "localhost", server.port, pool=node.pool, policy=policy)
+    server.delay = 0.0
+    node.statusready.wait(5.0)
+    self.failUnless(node.querycard(self.card) == 1)
+    server.delay = 1.0
+    start = time.time()
+    self.failUnless(node.querycard(self.card) == -1)
+    self.failUnless(time.time() - start < 0.8)
+
+  def test_pooled_dropped(self):
+    server = self.stub()
+    pool = ConnectionPool()
+    node = ACNode(1, "localhost", server.port, pool=pool)
+    node.statusready.wait(5.0)
+    listener = socket.socket()
+    listener.bind(("localhost", 0))
+    listener.listen(1)
+    def drop():
+      # reads the request and closes without answering, like a server
+      # timing out a kept alive connection
+      c, addr = listener.accept()
+      c.recv(4096)
+      c.close()
+    def dropped(path):
+      t = threading.Thread(target=drop)
+      t.start()
+      pool.put("localhost", server.port, socket.create_connection(listener.getsockname()))
+      resp = pool.request("localhost", server.port, node.build_request(path))
+      t.join()
+      return resp
+    # a get is tried again on a fresh connection
+    resp = dropped("GET /1/card/22222222")
+    self.failUnless(resp != None and body_result(resp[2]) == 1)
+    # a post isn't, the server might have done it
+    self.failUnless(dropped("POST /1/tooluse/time/for/22222222/5") == None)
+    self.failUnless(len(server.acserver.tools[1].usage) == 0)
+    listener.close()
+
+  def test_reconcile_gives_up(self):
+    dir = tempfile.mkdtemp()
+    snapshot = PermissionSnapshot(os.path.join(dir, "snapshot"))
+    for uid in range(0x10000000, 0x10000000 + 2000):
+      snapshot.put(uid, 1)
+    server = self.broken("reset")
+    node = ACNode(1, "localhost", server.port, snapshot=snapshot)
+    self.failUnless(node.reconciled.wait(5.0))
+    node.statusready.wait(5.0)
+    # the status check and one batch, not a connection for every card
+    self.failUnless(server.accepted < 5)
+    self.failUnless(snapshot.get(0x10000000) == 1)
+    shutil.rmtree(dir)
+
+  def test_slow(self):
+    server = self.stub()
+    server.delay = 0.2
+    node = self.node(server)
+    self.failUnless(node.querycard(self.card) == 1)
+
+  def test_adaptive(self):
+    server = self.stub()
+    node = self.node(server, floor=0.05)
+    for i in range(30):
+      self.failUnless(node.querycard(self.card) == 1)
+    self.failUnless(node.policy.timeout("card", 0.5) < 0.1)
+    # much slower than it's been, so it's given up on early
+    server.delay = 0.3
+    start = time.time()
+    self.failUnless(node.querycard(self.card) == -1)
+    self.failUnless(time.time() - start < 0.4)
+
+  def test_failover(self):
+    stubs = [self.stub(), self.stub()]
+    servers = Servers([("localhost", stub.port) for stub in stubs])
+    pool = ConnectionPool()
+    node = ACNode(1, "localhost", stubs[0].port, servers=servers, pool=pool)
+    for i in range(10):
+      self.failUnless(node.querycard(self.card) == 1)
+    pool.close()
+    # the stub's kept alive connections would outlive stop()
+    node = ACNode(1, "localhost", stubs[0].port, servers=servers)
+    for i in range(10):
+      self.failUnless(node.querycard(self.card) == 1)
+    # kill whichever it likes best, part way through
+    best = servers.order()[0]
+    other = servers.order()[1]
+    killed = [stub for stub in stubs if stub.port == best.port][0]
+    killed.stop()
+    self.servers.remove(killed)
+    start = time.time()
+    self.failUnless(node.querycard(self.card) == 1)
+    failover = time.time() - start
+    self.failUnless(failover < 0.5)
+    self.failUnless(servers.order()[0] is other)
+    for i in range(10):
+      self.failUnless(node.querycard(self.card) == 1)
+    self.failUnless(best.failures == 1)
+
+  def test_many_policy(self):
+    cards = [self.card, Card(0x12345678, False, True)]
+    server = self.broken("reset")
+    node = self.node(server, failures=1)
+    self.failUnless(node.policy.breaker.state == "open")
+    before = server.accepted
+    self.failUnless(node.querycard_many(cards) == {cards[0]: -1, cards[1]: -1})
+    self.failUnless(server.accepted == before)
+
+    # and it fails over, telling the instruments
+    servers = Servers([("localhost", server.port), ("localhost", self.stub().port)])
+    instruments = Instruments()
+    node = ACNode(1, "localhost", server.port, servers=servers, instruments=instruments)
+    self.failUnless(node.querycard_many(cards) == {cards[0]: 1, cards[1]: -1})
+    self.failUnless(instruments.counters[("card", "ok")] == 2)
+    self.failUnless(instruments.spans[("batch", "total")].count >= 1)
+
+  def test_drip(self):
+    # a server that answers slowly enough is still too slow, pooled or not
+    policy = Policy(deadlines={"card": 1.0, "status": 0.2}, retries=0)
+    server = self.broken("drip")
+    for pool in (None, ConnectionPool()):
+      node = ACNode(1, "localhost", server.port, policy=policy, pool=pool)
+      node.statusready.wait(5.0)
+      start = time.time()
+      self.failUnless(node.querycard(self.card) == -1)
+      self.failUnless(time.time() - start < 1.5)
+    start = time.time()
+    self.failUnless(ConnectionPool().pipeline("localhost", server.port, ["GET / HTTP/1.1\r\n\r\n"], timeout=0.5) == [None])
+    self.failUnless(time.time() - start < 1.0)
+
+  def test_failover_posts(self):
+    # two servers with the one database
+    acserver = ACServer("0_carddb.json")
+    acserver.add_tool(1, "test_tool", 1, "working ok")
+    acserver.set_permission(1, 2, 1)
+    stubs = [StubServer(0, acserver).start(), StubServer(0, acserver).start()]
+    self.servers.extend(stubs)
+    node = ACNode(1, "localhost", stubs[0].port, servers=Servers([("localhost", stub.port) for stub in stubs]))
+    node.statusready.wait(5.0)
+    node.timeout = 0.3
+    for stub in stubs:
+      stub.delay = 0.5
+    # the first got it, so it isn't sent to the second as well
+    self.failUnless(node.toolUseTime(self.card, 5) == -1)
+    time.sleep(0.5)
+    self.failUnless(len(acserver.tools[1].usage) == 1)
+    for stub in stubs:
+      stub.delay = 0.0
+
+    # but one that couldn't connect to the first goes on to the next
+    dead = socket.socket()
+    dead.bind(("localhost", 0))
+    port = dead.getsockname()[1]
+    dead.close()
+    node = ACNode(1, "localhost", port, servers=Servers([("localhost", port), ("localhost", stubs[1].port)]))
+    node.statusready.wait(5.0)
+    self.failUnless(node.toolUseTime(self.card, 5) == 1)
+    self.failUnless(len(acserver.tools[1].usage) == 2)
+
+  def test_failover_deadline(self):
+    hung = [self.broken("hang"), self.broken("hang")]
+    policy = Policy(deadlines={"card": 0.5, "status": 0.2}, retries=0)
+    servers = Servers([("localhost", server.port) for server in hung])
+    node = ACNode(1, "localhost", hung[0].port, servers=servers, policy=policy)
+    node.statusready.wait(5.0)
+    start = time.time()
+    self.failUnless(node.querycard(self.card) == -1)
+    self.failUnless(time.time() - start < 0.8)
+    start = time.time()
+    self.failUnless(node.querycard_many([self.card]) == {self.card: -1})
+    self.failUnless(time.time() - start < 0.8)
+
+  def test_preferred(self):
+    addrs = [(socket.AF_INET6, socket.SOCK_STREAM, 6, '', ('::1', 80, 0, 0)),
+             (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', 80))]
+    self.failUnless(preferred(addrs, None) == addrs)
+    self.failUnless(preferred(addrs, socket.AF_INET) == addrs[::-1])
+    node = ACNode(1, "localhost", self.stub().port)
+    node.statusready.wait(5.0)
+    self.failUnless(node.families.values() == [socket.AF_INET])
+
+class CardTests(unittest.TestCase):
+  # doesn't need an acserver
+
+  def test_pack_4(self):
+    card = Card(0xaabbccdd, False, True)
+    self.failUnless(card.to_bytes() == "\x04\xaa\xbb\xcc\xdd\x00\x00\x00")
+    card = Card.from_bytes(card.to_bytes())
+    self.failUnless(str(card) == "aabbccdd")
+    self.failUnless(not card.maintainer and card.status)
+
+  def test_pack_7(self):
+    card = Card(0x00112233445566, True, False)
+    self.failUnless(card.to_bytes() == "\x03\x00\x11\x22\x33\x44\x55\x66")
+    card = Card.from_bytes(bytearray(card.to_bytes()))
+    self.failUnless(str(card) == "00112233445566")
+    self.failUnless(card.maintainer and not card.status)
+
+  def test_blank_eeprom(self):
+    self.assertRaises(ValueError, Card.from_bytes, "\xff" * 8)
+
+  def test_table(self):
+    table = CardTable([Card(0x33333333, False, True),
+                       Card(0x00112233445566, True, True),
+                       Card(0x22222222, False, True)])
+    self.failUnless([c.uid for c in table] == [0x22222222, 0x33333333, 0x00112233445566])
+    self.failUnless(0x33333333 in table)
+    self.failIf(0x44444444 in table)
+    self.failUnless(table.get(0x00112233445566).maintainer)
+    table.remove(0x33333333)
+    self.failIf(0x33333333 in table)
+    self.failUnless(len(table) == 2)
+
+  def test_table_diff(self):
+    old = CardTable([Card(0x22222222, False, True), Card(0x33333333, False, True)])
+    # blank records are skipped
+    new = CardTable.from_bytes(old.to_bytes() + "\xff" * 8)
+    new.remove(0x33333333)
+    new.add(Card(0x44444444, False, True))
+    new.add(Card(0x22222222, True, True))
+    self.failUnless(old.diff(new) == ([0x44444444], [0x33333333], [0x22222222]))
+
+class EepromTests(unittest.TestCase):
+  # doesn't need an acserver
+
+  cards = [Card(0x00112233445566, True, True),
+           Card(0xaabbccdd, True, True),
+           Card(0x22222222, False, True)]
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.filename = os.path.join(self.dir, "eeprom.img")
+    self.image = EepromImage.create(self.filename, 64)
+
+  def tearDown(self):
+    self.image.close()
+    shutil.rmtree(self.dir)
+
+  def test_blank(self):
+    self.failUnless(len(self.image) == 0)
+
+  def test_bad_size(self):
+    filename = os.path.join(self.dir, "other.img")
+    for size in (0, -8, 12):
+      self.assertRaises(ValueError, EepromImage.create, filename, size)
+    open(filename, "wb").close()
+    self.assertRaises(ValueError, EepromImage, filename)
+
+  def test_round_trip(self):
+    for card in self.cards:
+      self.image.append(card)
+    self.image.close()
+    self.image = EepromImage(self.filename)
+    self.failUnless([str(c) for c in self.image.cards()] == [str(c) for c in self.cards])
+    self.failUnless(list(self.image.uids()) == [c.uid for c in self.cards])
+
+  def test_flip_bits(self):
+    for card in self.cards:
+      self.image.append(card)
+    offset = self.image.find(0x22222222)
+    self.image.set_maintainer(offset, True)
+    self.image.set_status(offset, False)
+    card = self.image.card(offset)
+    self.failUnless(card.maintainer and not card.status)
+
+  def test_remove(self):
+    for card in self.cards:
+      self.image.append(card)
+    self.image.remove(self.image.find(0xaabbccdd))
+    self.failUnless(self.image.find(0xaabbccdd) == -1)
+    self.failUnless(len(self.image) == 2)
+
+  def test_full(self):
+    for i in range(8):
+      self.image.append(Card(0x10000000 + i, False, True))
+    self.failUnless(len(self.image) == 8)
+    self.assertRaises(ValueError, self.image.append, Card(0x20000000, False, True))
+
+class SingleFlightTests(unittest.TestCase):
+  # doesn't need an acserver
+
+  def test_shared(self):
+    flights = SingleFlight()
+    release = threading.Event()
+    calls = []
+    def fetch():
+      calls.append(1)
+      release.wait()
+      return 42
+    results = []
+    fleet = [threading.Thread(target=lambda: results.append(flights.do("GET /1/card/22222222", fetch))) for i in range(5)]
+    for t in fleet:
+      t.start()
+    # wait for the rest to be waiting on the first
+    while flights.shared < 4:
+      time.sleep(0.001)
+    release.set()
+    for t in fleet:
+      t.join()
+    self.failUnless(results == [42] * 5)
+    self.failUnless(len(calls) == 1)
+    # and once it's done the next one goes to the server again
+    self.failUnless(flights.do("GET /1/card/22222222", lambda: 7) == 7)
+
+  def test_failure(self):
+    flights = SingleFlight()
+    def fetch():
+      raise RuntimeError("boom")
+    self.assertRaises(RuntimeError, flights.do, "x", fetch)
+    self.failUnless(flights.flights == {})
+
+class InstrumentsTests(unittest.TestCase):
+  # doesn't need an acserver
+
+  def test_endpoint(self):
+    self.failUnless(endpoint("GET /1/card/22222222") == "card")
+    self.failUnless(endpoint("GET /1/status/") == "status")
+    self.failUnless(endpoint("POST /1/grant-to-card/33333333/by-card/aabbccdd") == "grant")
+    self.failUnless(endpoint("POST /1/tooluse/time/for/22222222/5") == "tooluse")
+    self.failUnless(endpoint("GET /1/is_tool_in_use") == "other")
+    self.failUnless(endpoint("GET /") == "other")
+
+  def test_prometheus(self):
+    instruments = Instruments()
+    instruments.span("card", "total", 0.001)
+    instruments.span("card", "total", 0.5)
+    instruments.count("card", "ok")
+    instruments.count("card", "error")
+    text = instruments.prometheus()
+    self.failUnless('acnode_request_seconds_count{endpoint="card",phase="total"} 2' in text)
+    self.failUnless('acnode_request_seconds_bucket{endpoint="card",phase="total",le="+Inf"} 2' in text)
+    self.failUnless('acnode_requests_total{endpoint="card",outcome="error"} 1' in text)
+    # the buckets only go up
+    counts = [int(line.split()[-1]) for line in text.splitlines() if line.startswith("acnode_request_seconds_bucket")]
+    self.failUnless(counts == sorted(counts) and counts[0] == 0)
+
+class JournalTests(unittest.TestCase):
+  # doesn't need an acserver, send() pretends to be one
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.filename = os.path.join(self.dir, "journal")
+    self.sent = []
+    # how many more sends fail
+    self.down = 0
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def send(self, request):
+    if self.down > 0:
+      self.down -= 1
+      return None
+    self.sent.append(request)
+    return 1
+
+  def test_survives_restart(self):
+    journal = Journal(self.filename)
+    journal.append("POST /1/tooluse/1/22222222")
+    journal.append("POST /1/tooluse/0/22222222")
+    journal.close()
+    journal = Journal(self.filename)
+    self.failUnless([r for seq, r in journal.pending()] == ["POST /1/tooluse/1/22222222", "POST /1/tooluse/0/22222222"])
+    journal.close()
+
+  def test_replay_in_order(self):
+    journal = Journal(self.filename, backoff=0.01)
+    self.down = 3
+    journal.start(self.send)
+    for i in range(10):
+      journal.append("POST /1/tooluse/time/for/22222222/%d" % (i))
+    self.failUnless(journal.wait(10.0))
+    journal.close()
+    self.failUnless(self.sent == ["POST /1/tooluse/time/for/22222222/%d" % (i) for i in range(10)])
+    self.failUnless(Journal(self.filename).pending() == [])
+
+  def test_compact(self):
+    journal = Journal(self.filename, maxsize=4096)
+    journal.start(self.send)
+    for i in range(500):
+      journal.append("POST /1/tooluse/time/for/22222222/%d" % (i))
+    self.failUnless(journal.wait(10.0))
+    journal.close()
+    self.failUnless(len(self.sent) + journal.dropped == 500)
+    self.failUnless(os.path.getsize(self.filename) <= 4096)
+    # acks made while it was being rewritten weren't lost
+    self.failUnless(Journal(self.filename).pending() == [])
+
+  def test_cap(self):
+    # the server never comes back, the oldest go
+    journal = Journal(self.filename, maxsize=1024)
+    for i in range(500):
+      journal.append("POST /1/tooluse/time/for/22222222/%d" % (i))
+    self.failUnless(journal.dropped > 0)
+    self.failUnless(os.path.getsize(self.filename) <= 1024)
+    self.failUnless(journal.pending()[-1][1] == "POST /1/tooluse/time/for/22222222/499")
+    journal.close()
+
+  def test_append_doesnt_wait(self):
+    # the sending thread's busy on the disk, appends carry on regardless
+    journal = Journal(self.filename, maxsize=4096, backoff=30.0)
+    self.down = 10**6
+    journal.start(self.send)
+    with journal.maintaining:
+      start = time.time()
+      for i in range(500):
+        journal.append("POST /1/tooluse/time/for/22222222/%d" % (i))
+      self.failUnless(time.time() - start < 1.0)
+    journal.close()
+    self.failUnless(os.path.getsize(self.filename) <= 4096)
+    # the newest are kept, and nothing in between is lost
+    pending = Journal(self.filename).pending()
+    self.failUnless([r for seq, r in pending] == ["POST /1/tooluse/time/for/22222222/%d" % (i) for i in range(500 - len(pending), 500)])
+
+  def test_cap_is_quick(self):
+    # thousands queued when it goes over, dropping them mustn't hold up
+    # the tool
+    journal = Journal(self.filename, maxsize=256 * 1024)
+    slowest = 0.0
+    for i in range(8000):
+      start = time.time()
+      journal.append("POST /1/tooluse/time/for/22222222/%d" % (i))
+      slowest = max(slowest, time.time() - start)
+    self.failUnless(journal.dropped > 2000)
+    self.failUnless(slowest < 0.5)
+    self.failUnless(journal.queued == sum(len("R %d %s\n" % q) for q in journal.pending()))
+    journal.close()
+
+class CardDBTests(unittest.TestCase):
+  # doesn't need an acserver, uses the same carddb files as DbUpdateTests
+
+  def test_load(self):
+    db = carddb.CardDB.load("0_carddb.json")
+    self.failUnless(db.user(0x00112233445566) == 1)
+    self.failUnless(db.user(0xaabbccdd) == 1)
+    # stored in upper case
+    self.failUnless(db.user(0x5e9b2ed5) == 6)
+    self.failUnless(db.subscribed(0x33333333))
+    self.failIf(db.subscribed(0x44444444))
+    self.failIf(db.subscribed(0x12345678))
+
+  def test_small_chunks(self):
+    users = list(carddb.users("0_carddb.json", chunksize=7))
+    self.failUnless(users == json.load(open("0_carddb.json")))
+
+  def test_diffs(self):
+    db = carddb.CardDB.load("0_carddb.json")
+
+    new = carddb.CardDB.load("1_card_added_carddb.json")
+    d = db.diff(new)
+    self.failUnless(d.added == [(0x33333300, 3)] and len(d) == 1)
+    db.apply(d)
+
+    new = carddb.CardDB.load("2_card_removed_carddb.json")
+    d = db.diff(new)
+    self.failUnless(d.removed == [(0x33333300, 3)] and len(d) == 1)
+    db.apply(d)
+
+    new = carddb.CardDB.load("3_user_unsubscribed_carddb.json")
+    d = db.diff(new)
+    self.failUnless(d.unsubscribed == [3] and len(d) == 1)
+    db.apply(d)
+    self.failIf(db.subscribed(0x33333333))
+
+    new = carddb.CardDB.load("4_user_subscribed_carddb.json")
+    d = db.diff(new)
+    self.failUnless(d.subscribed == [3] and len(d) == 1)
+    db.apply(d)
+    self.failUnless(db.cards == new.cards and db.subscribers == new.subscribers)
+
+class UidTests(unittest.TestCase):
+  # doesn't need an acserver
+
+  def test_parse(self):
+    self.failUnless(parse_uid("5E9B2ED5") == parse_uid("5e9b2ed5") == 0x5e9b2ed5)
+    self.failUnless(parse_uid("040957827B3280") == 0x040957827b3280)
+    for bad in ("", "123", "0x123456", " 1234567", "aabbccdg", "001122334455667"):
+      self.assertRaises(ValueError, parse_uid, bad)
+    for uid in (0x5e9b2ed5, 0x040957827b3280, 0x00112233445566):
+      self.failUnless(uid_str(uid) == str(Card(uid, False, True)))
+
+  def test_index(self):
+    index = UidIndex.from_strings(["5E9B2ED5", "aabbccdd", "5e9b2ed5", "040957827B3280", "junk"])
+    self.failUnless(len(index) == 3 and index.duplicates == 1 and index.invalid == ["junk"])
+    self.failUnless(0x5e9b2ed5 in index and 0x12345678 not in index)
+    self.failUnless(UidIndex.from_bytes(index.to_bytes()).uids == index.uids)
+    other = UidIndex([0xaabbccdd, 0x12345678])
+    self.failUnless(index.diff(other) == ([0x12345678], [0x5e9b2ed5, 0x040957827b3280]))
+
+class LoadgenTests(unittest.TestCase):
+  # doesn't need an acserver
+
+  def test_shards(self):
+    self.failUnless(loadgen.shards(10, 1, 3) == [(1, 4), (5, 3), (8, 3)])
+    self.failUnless(loadgen.shards(2, 5, 4) == [(5, 1), (6, 1)])
+
+class RecorderTests(unittest.TestCase):
+  # doesn't need an acserver
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.filename = os.path.join(self.dir, "traffic.jsonl")
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_rotate(self):
+    recorder = traffic.Recorder(self.filename, maxbytes=1024, backups=2)
+    for i in range(100):
+      recorder.record(1, "localhost", 80, "GET /1/card/22222222", 1, float(i), 0.001)
+    recorder.close()
+    files = traffic.logfiles(self.filename)
+    self.failUnless(files == [self.filename + ".2", self.filename + ".1", self.filename])
+    for f in files:
+      self.failUnless(os.path.getsize(f) <= 1024)
+    records = traffic.load(files)
+    # the oldest are gone, the rest are in order
+    self.failUnless(records[-1]["t"] == 99.0)
+    self.failUnless([r["t"] for r in records] == range(100 - len(records), 100))
+
+  def test_replay_speed(self):
+    records = [{"t": 0.0, "node": 1, "req": "GET /1/status/", "ret": 1},
+               {"t": 0.01, "node": 1, "req": "GET /1/status/", "ret": 1}]
+    server = StubServer(0, ACServer()).start()
+    server.acserver.add_tool(1, "test_tool", 1, "working ok")
+    start = time.time()
+    results = traffic.replay(records, "localhost", server.port, 0.1)
+    server.stop()
+    self.failUnless(results["mismatches"] == 0)
+    # 0.01s of recording at a tenth of the speed
+    self.failUnless(time.time() - start >= 0.1)
+
+class SnapshotTests(unittest.TestCase):
+  # doesn't need an acserver
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.filename = os.path.join(self.dir, "snapshot")
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_roundtrip(self):
+    snapshot = PermissionSnapshot(self.filename)
+    self.failUnless(len(snapshot) == 0 and snapshot.status == None)
+    uids = [0x22222222, 0xaabbccdd, 0x00112233445566] + range(1000, 3000, 7)
+    for uid in uids:
+      snapshot.put(uid, uid % 3)
+    snapshot.set_status(0)
+    snapshot.close()
+
+    snapshot = PermissionSnapshot(self.filename)
+    self.failUnless(snapshot.status == 0 and snapshot.uids() == sorted(uids))
+    for uid in uids:
+      self.failUnless(snapshot.get(uid) == uid % 3)
+    self.failUnless(snapshot.get(0x12345678) == None)
+    # changes are seen straight away, and kept by the next flush
+    snapshot.put(0x22222222, -1)
+    self.failUnless(snapshot.get(0x22222222) == -1)
+    snapshot.flush()
+    self.failUnless(PermissionSnapshot(self.filename).get(0x22222222) == -1)
+
+  def test_flush_doesnt_block(self):
+    snapshot = PermissionSnapshot(self.filename)
+    for uid in range(0, 200000, 2):
+      snapshot.put(uid, 1)
+    snapshot.flush()
+    # a change in the middle and one at each end
+    for uid in (1, 100001, 300000):
+      snapshot.put(uid, 0)
+    snapshot.put(4, 2)
+    snapshot.set_status(0)
+    slowest = []
+    def swipes():
+      while t.is_alive():
+        start = time.time()
+        snapshot.get(100001)
+        slowest.append(time.time() - start)
+    t = threading.Thread(target=snapshot.flush)
+    t.start()
+    swipes()
+    t.join()
+    self.failUnless(max(slowest) < 0.05)
+    snapshot = PermissionSnapshot(self.filename)
+    self.failUnless(len(snapshot) == 100003 and snapshot.status == 0)
+    self.failUnless([snapshot.get(uid) for uid in (0, 1, 2, 4, 100001, 199998, 300000)] == [1, 0, 1, 2, 0, 1, 0])
+
+  def test_other_format(self):
+    open(self.filename, "wb").write("ACPS\0\x02" + "\0" * 30)
+    snapshot = PermissionSnapshot(self.filename)
+    self.failUnless(len(snapshot) == 0 and snapshot.get(0x22222222) == None)
+
+class CardCacheTests(unittest.TestCase):
+  # doesn't need an acserver
+
+  def setUp(self):
+    self.clock = VirtualClock()
+    self.cache = CardCache(size=2, ttl=60, negttl=1, clock=self.clock)
+
+  def test_fresh(self):
+    self.cache.put(0x22222222, 1)
+    self.failUnless(self.cache.get(0x22222222) == (1, True))
+    self.failUnless(self.cache.get(0x33333333) == None)
+
+  def test_negative_expires_first(self):
+    self.cache.put(0x22222222, 1)
+    self.cache.put(0x33333333, 0)
+    self.clock.sleep(2)
+    self.failUnless(self.cache.get(0x22222222) == (1, True))
+    # stale, but still usable
+    self.failUnless(self.cache.get(0x33333333) == (0, False))
+
+  def test_maxstale(self):
+    self.cache.put(0x22222222, 1)
+    self.clock.sleep(self.cache.maxstale + 1)
+    self.failUnless(self.cache.get(0x22222222) == None)
+
+  def test_lru(self):
+    self.cache.put(0x11111111, 2)
+    self.cache.put(0x22222222, 1)
+    # touch the first one so the second is the oldest
+    self.cache.get(0x11111111)
+    self.cache.put(0x33333333, 0)
+    self.failUnless(self.cache.get(0x22222222) == None)
+    self.failUnless(self.cache.get(0x11111111) == (2, True))
+
+  def test_invalidate(self):
+    self.cache.put(0x11111111, 2)
+    self.cache.put(0x22222222, 1)
+    self.cache.invalidate(0x11111111)
+    self.failUnless(self.cache.get(0x11111111) == None)
+    self.failUnless(self.cache.get(0x22222222) == (1, True))
+    self.cache.invalidate()
+    self.failUnless(self.cache.get(0x22222222) == None)
+
+class ResponseParserTests(unittest.TestCase):
+  # doesn't need an acserver
+
+  def feed(self, *chunks):
+    parser = ResponseParser()
+    for chunk in chunks:
+      parser.feed(chunk)
+    return parser
+
+  def test_content_length(self):
+    parser = self.feed("HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n12")
+    self.failUnless(parser.done and not parser.error)
+    self.failUnless(body_result(parser.body) == 12)
+    self.failUnless(parser.keepalive())
+
+  def test_split_headers(self):
+    parser = self.feed("HTTP/1.0 200 OK\r\nContent-Le", "ngth: 1\r", "\n\r", "\n", "1")
+    self.failUnless(parser.done and not parser.error)
+    self.failUnless(body_result(parser.body) == 1)
+    self.failIf(parser.keepalive())
+
+  def test_stops_at_content_length(self):
+    parser = self.feed("HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n-1HTTP/1.1 200 OK")
+    self.failUnless(body_result(parser.body) == -1)
+
+  def test_chunked(self):
+    parser = self.feed("HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n1\r\n2\r",
+      "\n2;x=y\r\n34\r\n0\r\n\r\n")
+    self.failUnless(parser.done and not parser.error)
+    self.failUnless(body_result(parser.body) == 234)
+
+  def test_until_eof(self):
+    parser = self.feed("HTTP/1.0 200 OK\n\n", "0")
+    self.failIf(parser.done)
+    parser.eof()
+    self.failUnless(parser.done and not parser.error)
+    self.failUnless(body_result(parser.body) == 0)
+
+  def test_truncated(self):
+    parser = self.feed("HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\n1")
+    parser.eof()
+    self.failUnless(parser.error)
+    parser = self.feed("HTTP/1.1 200 OK\r\n")
+    parser.eof()
+    self.failUnless(parser.error)
+
+  def test_not_a_number(self):
+    self.failUnless(body_result("<html>oops</html>") == -1)
+    self.failUnless(body_result("") == -1)
+
 if __name__ == '__main__':
   unittest.main()
 #  suite = unittest.TestLoader().loadTestsFromTestCase(AcnodeTests)
@@ -12,10 +12,17 @@ else:
   ACNODE_ACSERVER_HOST="localhost"
 ACNODE_ACSERVER_PORT=1234
 
-# either django or php
-TESTMODE="django"
+# either django, php or stub (an in process acserver, see stubserver.py)
+if 'ACNODE_TESTMODE' in os.environ:
+  TESTMODE=os.environ['ACNODE_TESTMODE']
+else:
+  TESTMODE="django"
 
 if TESTMODE == "django":
   ACNODE_ACSERVER_PORT=8000
   # path to the acserver-django code, if not in ../
   ACNODE_ACSERVER_DJANGO=None
+
+if TESTMODE == "stub":
+  ACNODE_ACSERVER_HOST="localhost"
+  ACNODE_ACSERVER_PORT=8001
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+#
+# Record what acnodes ask the acserver, and replay it.
+#
+#   python traffic.py [--speed N | --max] [--host H] [--port P] traffic.jsonl
+#
+# replays a recording (and its rotated older parts) against a server, N
+# times as fast as it happened, or as fast as it'll go with --max.
+#
+
+import os, sys, time, json, threading, argparse
+from acnode import ACNode, ConnectionPool
+from metrics import Histogram
+import test_config
+
+class Recorder:
+  """
+  Writes each request an ACNode makes to a file, one json object a line,
+  as ACNode(recorder=...):
+
+    {"t": when it started, "node": node id, "server": "host:port",
+     "req": "GET /1/card/22222222", "ret": 1, "latency": seconds}
+
+  ret is null if there was no answer. When the file would go over
+  maxbytes it's moved to filename.1, the old .1 to .2 and so on, keeping
+  backups of them. One can be shared between ACNodes.
+  """
+  def __init__(self, filename, maxbytes=10 * 1024 * 1024, backups=5):
+    self.filename = filename
+    self.maxbytes = maxbytes
+    self.backups = backups
+    self.lock = threading.Lock()
+    self.f = open(filename, "a")
+    self.size = self.f.tell()
+
+  def record(self, nodeid, servername, port, path, ret, started, latency):
+    line = json.dumps({"t": started, "node": nodeid, "server": "%s:%d" % (servername, port),
+                       "req": path, "ret": ret, "latency": latency},
+                      separators=(",", ":"), sort_keys=True) + "\n"
+    with self.lock:
+      if self.size > 0 and self.size + len(line) > self.maxbytes:
+        self.rotate()
+      self.f.write(line)
+      self.f.flush()
+      self.size += len(line)
+
+  def rotate(self):
+    self.f.close()
+    for i in range(self.backups - 1, 0, -1):
+      if os.path.exists("%s.%d" % (self.filename, i)):
+        os.rename("%s.%d" % (self.filename, i), "%s.%d" % (self.filename, i + 1))
+    if self.backups > 0:
+      os.rename(self.filename, self.filename + ".1")
+    self.f = open(self.filename, "w")
+    self.size = 0
+
+  def close(self):
+    with self.lock:
+      self.f.close()
+
+def logfiles(filename):
+  """
+  filename and whatever's left of its rotated parts, oldest first
+  """
+  files = [filename]
+  i = 1
+  while os.path.exists("%s.%d" % (filename, i)):
+    files.insert(0, "%s.%d" % (filename, i))
+    i += 1
+  return files
+
+def load(filenames):
+  """
+  The records in filenames, in the order they were made
+  """
+  records = []
+  for filename in filenames:
+    for line in open(filename):
+      if line.strip():
+        records.append(json.loads(line))
+  records.sort(key=lambda r: r["t"])
+  return records
+
+class ReplayNode(ACNode):
+  """
+  An ACNode that only sends what it's told to, without a status check
+  of its own at startup
+  """
+  def statusloop(self):
+    self.statusready.set()
+
+class Replayer(threading.Thread):
+  """
+  Sends one node's records in order. start is the time.time() that the
+  first record in the whole recording, at t0, is sent at.
+  """
+  def __init__(self, node, records, t0, start, speed):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.node = node
+    self.records = records
+    self.t0 = t0
+    self.start_at = start
+    self.speed = speed
+    self.latency = Histogram()
+    # answers that aren't what was recorded
+    self.mismatches = 0
+    # requests that got no answer
+    self.errors = 0
+
+  def run(self):
+    for r in self.records:
+      if self.speed != None:
+        wait = self.start_at + (r["t"] - self.t0) / self.speed - time.time()
+        if wait > 0:
+          time.sleep(wait)
+      started = time.time()
+      ret = self.node.fetch(str(r["req"]))
+      self.latency.add(time.time() - started)
+      if ret == None:
+        self.errors += 1
+      elif ret != r["ret"]:
+        self.mismatches += 1
+
+def replay(records, host, port, speed=1.0, pool=False):
+  """
+  Send records to host:port, each node's in the order they were made,
+  at speed times as fast as they happened, or as fast as they'll go if
+  speed is None. returns a dict of how it went.
+  """
+  if len(records) == 0:
+    return {"count": 0, "elapsed": 0.0, "errors": 0, "mismatches": 0, "latency": Histogram().to_dict()}
+  bynode = {}
+  for r in records:
+    bynode.setdefault(r["node"], []).append(r)
+  t0 = records[0]["t"]
+  start = time.time() + 0.1
+  fleet = []
+  for nodeid, rs in sorted(bynode.items()):
+    p = None
+    if pool:
+      p = ConnectionPool()
+    fleet.append(Replayer(ReplayNode(nodeid, host, port, pool=p), rs, t0, start, speed))
+  for r in fleet:
+    r.start()
+  for r in fleet:
+    r.join()
+  elapsed = time.time() - start
+
+  latency = Histogram()
+  for r in fleet:
+    latency.merge(r.latency)
+  return {
+    "count": len(records),
+    "elapsed": elapsed,
+    "errors": sum(r.errors for r in fleet),
+    "mismatches": sum(r.mismatches for r in fleet),
+    "latency": latency.to_dict(),
+  }
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="replay recorded acnode traffic")
+  parser.add_argument("--host", default=test_config.ACNODE_ACSERVER_HOST)
+  parser.add_argument("--port", type=int, default=test_config.ACNODE_ACSERVER_PORT)
+  parser.add_argument("--speed", type=float, default=1.0, help="how many times faster than it was recorded")
+  parser.add_argument("--max", action="store_true", help="as fast as it'll go")
+  parser.add_argument("--pool", action="store_true", help="use keep alive connections")
+  parser.add_argument("--json", action="store_true", help="print the results as json")
+  parser.add_argument("recording")
+  args = parser.parse_args()
+
+  speed = args.speed
+  if args.max:
+    speed = None
+  results = replay(load(logfiles(args.recording)), args.host, args.port, speed, args.pool)
+  if args.json:
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+  else:
+    l = results["latency"]
+    print "%d requests in %.2fs, %d errors, %d different answers" % (results["count"],
+      results["elapsed"], results["errors"], results["mismatches"])
+    print "p50 %.2fms  p99 %.2fms  max %.2fms" % (l["p50"] * 1000.0, l["p99"] * 1000.0, l["max"] * 1000.0)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+#
+# Card uids as ints, however they were written down.
+#
+# The carddb has them in both cases ("5E9B2ED5", "aabbccdd") and 4 or 7
+# bytes long, comparing them as strings means knowing that everywhere.
+# Here they're turned into ints once, and everything after that is int
+# comparisons.
+#
+
+import struct, string
+
+HEXDIGITS = string.hexdigits
+
+def parse_uid(s):
+  """
+  "5E9B2ED5", "aabbccdd" or "040957827B3280" -> the uid as an int.
+  Raises ValueError unless it's 4 or 7 bytes of hex.
+  """
+  if len(s) not in (8, 14) or s.strip(HEXDIGITS) != "":
+    raise ValueError("%r isn't a 4 or 7 byte uid" % (s))
+  return int(s, 16)
+
+def uid_str(uid):
+  """
+  The other way, as the acserver wants it, the same as str(Card)
+  """
+  if uid < 2**32:
+    return "%08x" % (uid)
+  return "%014x" % (uid)
+
+class UidIndex:
+  """
+  A set of uids, to find out if a card is one of them in O(1) however
+  many there are, and to compare whole lists of them at once.
+
+  from_strings() is the bulk way in: it checks, normalises and dedupes a
+  list of uid strings in one go. The ones that aren't uids go in invalid,
+  and duplicates counts the repeats. to_bytes() packs the uids as sorted
+  8 byte big endian ints.
+  """
+  def __init__(self, uids=()):
+    self.uids = set(uids)
+    self.invalid = []
+    self.duplicates = 0
+
+  @classmethod
+  def from_strings(cls, strings):
+    index = cls()
+    uids = []
+    for s in strings:
+      try:
+        uids.append(parse_uid(s))
+      except ValueError:
+        index.invalid.append(s)
+    index.uids = set(uids)
+    index.duplicates = len(uids) - len(index.uids)
+    return index
+
+  @classmethod
+  def from_bytes(cls, data):
+    return cls(struct.unpack(">%dQ" % (len(data) // 8), str(data)))
+
+  def to_bytes(self):
+    uids = sorted(self.uids)
+    return struct.pack(">%dQ" % (len(uids)), *uids)
+
+  def __len__(self):
+    return len(self.uids)
+
+  def __iter__(self):
+    return iter(self.uids)
+
+  def __contains__(self, uid):
+    return uid in self.uids
+
+  def add(self, uid):
+    self.uids.add(uid)
+
+  def discard(self, uid):
+    self.uids.discard(uid)
+
+  def diff(self, other):
+    """
+    returns (added, removed), sorted lists of the uids that are in other
+    and not here, and here but not in other
+    """
+    return (sorted(other.uids - self.uids), sorted(self.uids - other.uids))